@@ -5,12 +5,18 @@ from dash import Dash
 from dash.dependencies import Input, Output
 
 import stock_pattern_analyzer as spa
-from dash_app_functions import get_search_window_sizes, get_symbols, search_most_recent
+from dash_app_functions import (METADATA_REFRESH_SECONDS, get_search_window_sizes, get_symbols, search_most_recent,
+                                start_metadata_refresh)
 
 app = Dash(__name__, meta_tags=[{"name": "viewport", "content": "width=device-width"}])
 app.title = "Stock Patterns"
 server = app.server
 
+# Figures are cached by the content of the search response and the options, so e.g. toggling the offset back and forth
+# does not rebuild them
+FIGURE_CACHE_MAX_SIZE = 128
+figure_cache = spa.FigureCache(max_size=FIGURE_CACHE_MAX_SIZE)
+
 ##### Header #####
 
 header_div = html.Div([html.Div([html.H3("📈")], className="one-third column"),
@@ -35,6 +41,10 @@ indication of future price movement for the selected (anchor) stock.""")])
 
 symbol_dropdown_id = "id-symbol-dropdown"
 available_symbols = get_symbols()
+# The options of the dropdowns follow the refreshes of the RestAPI
+start_metadata_refresh()
+metadata_interval_id = "id-metadata-interval"
+metadata_interval = dcc.Interval(id=metadata_interval_id, interval=METADATA_REFRESH_SECONDS * 1000)
 default_symbol = "AAPL" if "AAPL" in available_symbols else available_symbols[0]
 symbol_dropdown = dcc.Dropdown(id=symbol_dropdown_id,
                                options=[{"label": x, "value": x} for x in available_symbols],
@@ -73,7 +83,8 @@ settings_div = html.Div([html.P("Symbol (anchor)", className="control_label"),
                          top_k_input,
                          html.P("Offset the matched patterns for easy comparison (to the anchors last market close)",
                                 className="control_label"),
-                         offset_checkbox],
+                         offset_checkbox,
+                         metadata_interval],
                         className="pretty_container three columns",
                         id="id-settings-div")
 
@@ -131,6 +142,15 @@ app.layout = html.Div([header_div,
 
 ##### Callbacks #####
 
+@app.callback([Output(symbol_dropdown_id, "options"),
+               Output(window_size_dropdown_id, "options")],
+              [Input(metadata_interval_id, "n_intervals")])
+def update_dropdown_options(n_intervals):
+    # These are refreshed in the background, there is no request here
+    return ([{"label": x, "value": x} for x in get_symbols()],
+            [{"label": f"{x} days", "value": x} for x in get_search_window_sizes()])
+
+
 @app.callback([Output(graph_id, "figure"),
                Output(matched_table_id, "data")],
               [Input(symbol_dropdown_id, "value"),
@@ -168,15 +188,25 @@ def update_plot_and_table(symbol_value, window_size_value, future_size_value, to
     offset_traces = False if len(checkbox_value) == 0 else True
 
     # Visualize the data on a graph
-    fig = spa.visualize_graph(match_values_list=values,
-                              match_symbols=symbols,
-                              match_str_dates=start_end_dates,
-                              window_size=window_size_value,
-                              future_size=future_size_value,
-                              anchor_symbol=ret.anchor_symbol,
-                              anchor_values=ret.anchor_values,
-                              show_legend=False,
-                              offset_traces=offset_traces)
+    content_hash = spa.get_content_hash(match_values_list=values,
+                                        match_symbols=symbols,
+                                        match_str_dates=start_end_dates,
+                                        anchor_symbol=ret.anchor_symbol,
+                                        anchor_values=ret.anchor_values)
+    figure_key = (content_hash, window_size_value, future_size_value, offset_traces)
+    fig = figure_cache.get(figure_key)
+    if fig is None:
+        fig = spa.visualize_graph(match_values_list=values,
+                                  match_symbols=symbols,
+                                  match_str_dates=start_end_dates,
+                                  window_size=window_size_value,
+                                  future_size=future_size_value,
+                                  anchor_symbol=ret.anchor_symbol,
+                                  anchor_values=ret.anchor_values,
+                                  show_legend=False,
+                                  offset_traces=offset_traces,
+                                  fast=True)
+        figure_cache.put(figure_key, fig)
 
     return fig, table_rows
 
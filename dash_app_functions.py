@@ -1,35 +1,38 @@
 import os
 
-import requests
-
-from rest_api_models import (TopKSearchResponse, SearchWindowSizeResponse, DataRefreshResponse,
-                             AvailableSymbolsResponse)
+from rest_api_client import RestApiClient
+from rest_api_models import TopKSearchResponse
 
 BASE_URL = os.environ.get("REST_API_URL", default="http://localhost:8001")
+REST_API_TIMEOUT_SECONDS = float(os.environ.get("REST_API_TIMEOUT_SECONDS", 30))
+REST_API_NB_RETRIES = int(os.environ.get("REST_API_NB_RETRIES", 3))
+# The symbols and window sizes are refreshed in the background this often
+METADATA_REFRESH_SECONDS = float(os.environ.get("METADATA_REFRESH_SECONDS", 10 * 60))
+
+# Shared by every callback, so the connections to the RestAPI are reused
+client = RestApiClient(base_url=BASE_URL, timeout=REST_API_TIMEOUT_SECONDS, nb_retries=REST_API_NB_RETRIES)
 
 
 def get_search_window_sizes() -> list:
-    res = requests.get(f"{BASE_URL}/search/sizes")
-    res = SearchWindowSizeResponse.parse_obj(res.json())
-    return res.sizes
+    # Last refreshed value (see start_metadata_refresh), it is requested only if there is none yet
+    if not client.window_sizes:
+        client.refresh_metadata()
+    return client.window_sizes
 
 
 def get_symbols() -> list:
-    res = requests.get(f"{BASE_URL}/data/symbols")
-    res = AvailableSymbolsResponse.parse_obj(res.json())
-    return res.symbols
+    if not client.symbols:
+        client.refresh_metadata()
+    return client.symbols
+
+
+def start_metadata_refresh():
+    client.start_background_refresh(interval=METADATA_REFRESH_SECONDS)
 
 
 def search_most_recent(symbol: str, window_size: int, top_k: int, future_size: int) -> TopKSearchResponse:
-    url = f"{BASE_URL}/search/recent/?symbol={symbol.upper()}&window_size={window_size}&top_k={top_k}&future_size={future_size}"
-    res = requests.get(url)
-    res = TopKSearchResponse.parse_obj(res.json())
-    return res
+    return client.search_most_recent(symbol=symbol, window_size=window_size, top_k=top_k, future_size=future_size)
 
 
 def get_last_refresh_date() -> str:
-    url = f"{BASE_URL}/refresh/when"
-    res = requests.get(url)
-    res = DataRefreshResponse.parse_obj(res)
-    date_str = res.date.strftime("%Y/%m/%d, %H:%M:%S")
-    return date_str
+    return client.get_last_refresh_date()
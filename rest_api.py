@@ -1,23 +1,43 @@
-from datetime import datetime
+import asyncio
+from collections import OrderedDict
+import concurrent.futures
+from datetime import date, datetime
+import functools
 import itertools
+import os
 from pathlib import Path
+import shutil
 import threading
-from typing import Optional, Set, Tuple
+import time
+from typing import Hashable, List, Optional, Set, Tuple
 
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from fastapi import FastAPI, HTTPException, Response
+from fastapi import FastAPI, Header, HTTPException, Query, Response
 import numpy as np
 import pandas as pd
+import psutil
 
 from rest_api_models import (
+    MAX_FUTURE_SIZE,
+    MAX_TOP_K,
+    MAX_WINDOW_SIZE,
     AvailableSymbolsResponse,
+    BatchSearchRequest,
+    BatchSearchResponse,
+    CacheStatsResponse,
     DataRefreshResponse,
+    DataUpdateResponse,
     IsReadyResponse,
-    MatchResponse,
+    MatchTableInfo,
+    MatchTablesResponse,
+    RefreshResponse,
+    SearchBatchingStatsResponse,
+    SearchUpdateResponse,
     SearchWindowSizeResponse,
     SuccessResponse,
     TopKSearchResponse,
 )
+from rest_api_formats import JSON_MEDIA_TYPE, TopKSearchResult, encode_results, select_media_type
 import stock_pattern_analyzer as spa
 
 app = FastAPI()
@@ -63,27 +83,317 @@ if "$CURRENCY_PAIRS" in user_defined_tickers:
 SYMBOL_LIST = sorted(user_defined_tickers)
 
 PERIOD_YEARS = 20
+# If set, the data is read from this folder of <symbol>.parquet / <symbol>.csv files instead of downloading it
+LOCAL_DATA_PATH = os.environ.get("LOCAL_DATA_PATH")
+
+# Most recent search results are precomputed up to these values (the client does not allow more)
+PRECOMPUTED_MAX_TOP_K = 10
+PRECOMPUTED_MAX_FUTURE_SIZE = 10
+
+# Memory (in bytes) which can be used by the concurrent search tree builds, if not set then half of the available
+# memory is used. The number of concurrent builds is limited by the number of CPUs too
+SEARCH_TREE_BUILD_MEMORY_BUDGET = (int(os.environ["SEARCH_TREE_BUILD_MEMORY_BUDGET_MB"]) * 2 ** 20
+                                   if "SEARCH_TREE_BUILD_MEMORY_BUDGET_MB" in os.environ else None)
+SEARCH_TREE_BUILD_MAX_WORKERS = None
+# If the recall target is set, then the index parameters are tuned for every window size (this makes the builds slower)
+SEARCH_INDEX_RECALL_TARGET = (float(os.environ["SEARCH_INDEX_RECALL_TARGET"])
+                              if "SEARCH_INDEX_RECALL_TARGET" in os.environ else None)
+SEARCH_INDEX_LATENCY_BUDGET = (float(os.environ["SEARCH_INDEX_LATENCY_BUDGET_MS"]) / 1000
+                               if "SEARCH_INDEX_LATENCY_BUDGET_MS" in os.environ else None)
+
+# Windows of at least this size are indexed by their PAA reduction (with this many segments), and the candidates are
+# re-ranked with the exact distances
+REDUCED_INDEX_MIN_WINDOW_SIZE = int(os.environ.get("REDUCED_INDEX_MIN_WINDOW_SIZE", 60))
+REDUCED_INDEX_NB_SEGMENTS = int(os.environ.get("REDUCED_INDEX_NB_SEGMENTS", 16))
+# Columns which are matched by the search trees (comma separated, e.g. "Close,Volume"), every channel is min-max scaled
+# separately. The default is the Close only search
+SEARCH_CHANNELS = [x.strip() for x in os.environ.get("SEARCH_CHANNELS", "Close").split(",") if x.strip()]
+
+# DTW search (metric=dtw): this many times more candidates are searched with the index than requested, and they are
+# re-ranked with the DTW distance, where a value can be matched to the values within this fraction of the window size
+DTW_OVERFETCH_FACTOR = int(os.environ.get("DTW_OVERFETCH_FACTOR", 10))
+DTW_BAND_FRACTION = float(os.environ.get("DTW_BAND_FRACTION", 0.1))
+SEARCH_METRICS = ("euclidean", "dtw")
+
+# Single searches which arrive within the batch window (for the same window size and filters) are searched together,
+# on the search worker pool (so the event loop is not blocked)
+SEARCH_BATCH_WINDOW = float(os.environ.get("SEARCH_BATCH_WINDOW_MS", 2)) / 1000
+SEARCH_MAX_BATCH_SIZE = int(os.environ.get("SEARCH_MAX_BATCH_SIZE", 64))
+SEARCH_NB_WORKERS = int(os.environ.get("SEARCH_NB_WORKERS", os.cpu_count() or 1))
+
+# Multi-worker serving: a single builder process refreshes the data and builds the search trees, and it publishes every
+# generation to the generation store. Worker processes never refresh, they load the published generations (memory
+# mapped, so the memory is shared between them) and they swap to the new one when it is published.
+# The default standalone process does everything on its own
+ROLE_STANDALONE = "standalone"
+ROLE_BUILDER = "builder"
+ROLE_WORKER = "worker"
+REST_API_ROLE = os.environ.get("REST_API_ROLE", ROLE_STANDALONE)
+if REST_API_ROLE not in (ROLE_STANDALONE, ROLE_BUILDER, ROLE_WORKER):
+    raise ValueError(f"Unknown REST_API_ROLE: {REST_API_ROLE}")
+GENERATION_STORE_PATH = os.environ.get("GENERATION_STORE_PATH", "generations")
+# Workers check this often if there is a new published generation
+GENERATION_POLL_SECONDS = float(os.environ.get("GENERATION_POLL_SECONDS", 5))
+
+# Names of the metrics of the /metrics endpoint (the metrics are per process, every worker has its own)
+SEARCH_STAGE_METRIC = "spa_search_stage_seconds"
+BUILD_STAGE_METRIC = "spa_build_stage_seconds"
+REFRESH_STAGE_METRIC = "spa_refresh_stage_seconds"
+DOWNLOAD_FAILURES_METRIC = "spa_download_failures_total"
+FAILED_SYMBOLS_METRIC = "spa_failed_symbols"
+INDEX_VECTORS_METRIC = "spa_index_vectors"
+INDEX_BYTES_METRIC = "spa_index_bytes"
+MATCH_TABLE_BYTES_METRIC = "spa_match_table_bytes"
+GENERATION_METRIC = "spa_generation"
+GENERATION_AGE_METRIC = "spa_generation_age_seconds"
+RSS_METRIC = "process_resident_memory_bytes"
+METRICS_MEDIA_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+SEARCH_CACHE_MAX_SIZE = 4096
+# Results can only change with a refresh (which invalidates the cache), this just limits the age of an entry
+SEARCH_CACHE_TTL_SECONDS = 12 * 60 * 60
+
+
+class SearchResultCache:
+    """
+    Bounded LRU cache (with TTL) for the search results. Entries are keyed by the request parameters without the
+    top_k, and only the result with the largest top_k is kept, as smaller top_k requests can be served from it
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.nb_hits = 0
+        self.nb_misses = 0
+
+    def get(self, key: Hashable, top_k: int) -> Optional[TopKSearchResult]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                created_at, response = entry
+                if (time.time() - created_at) > self.ttl_seconds:
+                    del self._entries[key]
+                elif response.top_k >= top_k:
+                    self._entries.move_to_end(key)
+                    self.nb_hits += 1
+                    return response.slice(top_k)
+            self.nb_misses += 1
+            return None
+
+    def put(self, key: Hashable, response: TopKSearchResult):
+        with self._lock:
+            entry = self._entries.get(key)
+            if (entry is not None) and entry[1].top_k > response.top_k:
+                return
+            self._entries[key] = (time.time(), response)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+def _create_metrics() -> spa.MetricsRegistry:
+    registry = spa.MetricsRegistry()
+    registry.describe(SEARCH_STAGE_METRIC, spa.metrics.HISTOGRAM,
+                      "Duration of the search request stages (normalize and index_search are per index query batch)")
+    registry.describe(BUILD_STAGE_METRIC, spa.metrics.HISTOGRAM,
+                      "Duration of the search tree build stages (windowing, tune, train, add, precompute)",
+                      buckets=spa.metrics.BUILD_DURATION_BUCKETS)
+    registry.describe(REFRESH_STAGE_METRIC, spa.metrics.HISTOGRAM,
+                      "Duration of the refresh stages (download, search_trees, match_tables, total)",
+                      buckets=spa.metrics.BUILD_DURATION_BUCKETS)
+    registry.describe(DOWNLOAD_FAILURES_METRIC, spa.metrics.COUNTER,
+                      "Number of fills and updates where the download of the symbol failed")
+    registry.describe(FAILED_SYMBOLS_METRIC, spa.metrics.GAUGE, "Number of failed symbols of the current generation")
+    registry.describe(INDEX_VECTORS_METRIC, spa.metrics.GAUGE, "Number of vectors (windows) in the search index")
+    registry.describe(INDEX_BYTES_METRIC, spa.metrics.GAUGE, "Size of the serialized search index")
+    registry.describe(MATCH_TABLE_BYTES_METRIC, spa.metrics.GAUGE, "Size of the precomputed most recent matches")
+    registry.describe(GENERATION_METRIC, spa.metrics.GAUGE, "Version of the served generation")
+    registry.describe(GENERATION_AGE_METRIC, spa.metrics.GAUGE, "Seconds since the served generation was created")
+    registry.describe(RSS_METRIC, spa.metrics.GAUGE, "Resident memory of the process")
+    return registry
+
+
+def _observe_search_stage(endpoint: str, stage: str, start_time: float):
+    metrics.observe(SEARCH_STAGE_METRIC, time.perf_counter() - start_time, endpoint=endpoint, stage=stage)
+
+
+def _observe_search_stage_times(stage_times: dict, endpoint: str = "recent"):
+    for stage, seconds in stage_times.items():
+        metrics.observe(SEARCH_STAGE_METRIC, seconds, endpoint=endpoint, stage=stage)
+
+
+def _observe_data_refresh(data_holder: spa.RawStockDataHolder):
+    # Loaded data holders were not downloaded now
+    if data_holder.download_time is None:
+        return
+    metrics.observe(REFRESH_STAGE_METRIC, data_holder.download_time, stage="download")
+    for symbol in data_holder.fetch_errors:
+        metrics.inc(DOWNLOAD_FAILURES_METRIC, symbol=symbol)
+
+
+def _observe_search_tree_builds(search_tree_dict: dict):
+    # Loaded search trees do not have build times
+    for w, search_tree in search_tree_dict.items():
+        for stage, seconds in search_tree.build_times.items():
+            metrics.observe(BUILD_STAGE_METRIC, seconds, window_size=w, stage=stage)
+
+
+def _set_generation_metrics(generation: spa.SearchGeneration):
+    for name in (INDEX_VECTORS_METRIC, INDEX_BYTES_METRIC, MATCH_TABLE_BYTES_METRIC):
+        metrics.clear(name)
+    for w, search_tree in generation.search_models.items():
+        metrics.set(INDEX_VECTORS_METRIC, int(search_tree.window_offsets[-1, -1]), window_size=w)
+        index_nbytes = search_tree.get_index_nbytes()
+        if index_nbytes is not None:
+            metrics.set(INDEX_BYTES_METRIC, index_nbytes, window_size=w)
+    for w, match_table in generation.match_tables.items():
+        metrics.set(MATCH_TABLE_BYTES_METRIC, match_table.nbytes, window_size=w)
+    metrics.set(GENERATION_METRIC, generation.version)
+    metrics.set(FAILED_SYMBOLS_METRIC, len(generation.data_holder.fetch_errors))
+
+
+def _create_data_source() -> spa.DataSource:
+    if LOCAL_DATA_PATH is not None:
+        return spa.LocalFileDataSource(folder_path=LOCAL_DATA_PATH)
+    return spa.YahooDataSource()
 
 
 def _prepare_data(force_update: bool = False) -> spa.RawStockDataHolder:
-    return spa.initialize_data_holder(tickers=SYMBOL_LIST, period_years=PERIOD_YEARS, force_update=force_update)
+    return spa.initialize_data_holder(tickers=SYMBOL_LIST, period_years=PERIOD_YEARS, force_update=force_update,
+                                      data_source=data_source)
 
 
-data_holder: spa.RawStockDataHolder = _prepare_data()
-search_tree_dict: dict = {}
+data_source: spa.DataSource = _create_data_source()
+metrics: spa.MetricsRegistry = _create_metrics()
+# Everything used for serving is in the current generation, which is replaced (never modified) by the refreshes
+current_generation: Optional[spa.SearchGeneration] = None
+# Only one new generation is built at a time, the requests are served from the current one in the meantime
+refresh_lock: threading.Lock = threading.Lock()
 refresh_scheduler: AsyncIOScheduler = AsyncIOScheduler()
-last_refreshed: Optional[datetime] = None
+search_result_cache: SearchResultCache = SearchResultCache(max_size=SEARCH_CACHE_MAX_SIZE,
+                                                           ttl_seconds=SEARCH_CACHE_TTL_SECONDS)
+search_executor: concurrent.futures.ThreadPoolExecutor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=SEARCH_NB_WORKERS, thread_name_prefix="search")
+search_batcher: spa.MicroBatchSearcher = spa.MicroBatchSearcher(executor=search_executor,
+                                                                batch_window=SEARCH_BATCH_WINDOW,
+                                                                max_batch_size=SEARCH_MAX_BATCH_SIZE,
+                                                                stage_times_callback=_observe_search_stage_times)
+generation_store: spa.GenerationStore = spa.GenerationStore(folder_path=GENERATION_STORE_PATH)
+
+
+def _get_generation() -> spa.SearchGeneration:
+    # The reference is read only once per request, so a request is served from a single generation
+    generation = current_generation
+    if generation is None:
+        raise HTTPException(status_code=503, detail="Data and search trees are not prepared yet")
+    return generation
+
+
+def _build_generation(data_holder: spa.RawStockDataHolder,
+                      search_models: dict,
+                      match_tables: Optional[dict] = None) -> spa.SearchGeneration:
+    if match_tables is None:
+        with metrics.time(REFRESH_STAGE_METRIC, stage="match_tables"):
+            match_tables = spa.build_match_tables(data_holder=data_holder,
+                                                  search_models=search_models,
+                                                  max_top_k=PRECOMPUTED_MAX_TOP_K,
+                                                  max_future_size=PRECOMPUTED_MAX_FUTURE_SIZE)
+        for w, match_table in match_tables.items():
+            metrics.observe(BUILD_STAGE_METRIC, match_table.build_time, window_size=w, stage="precompute")
+    if current_generation is not None:
+        version = current_generation.version + 1
+    elif REST_API_ROLE == ROLE_BUILDER:
+        # Versions continue after a restart of the builder, so the workers (and the ETags) see a new generation
+        version = (generation_store.get_current_version() or 0) + 1
+    else:
+        version = 1
+    return spa.SearchGeneration(version=version,
+                                data_holder=data_holder,
+                                search_models=search_models,
+                                match_tables=match_tables)
+
+
+def _publish_generation(generation: spa.SearchGeneration):
+    global current_generation
+    if REST_API_ROLE == ROLE_BUILDER:
+        generation_store.publish(generation)
+    # Single reference swap, the previous generation is released when its last in-flight request finishes
+    current_generation = generation
+    search_result_cache.clear()
+    _set_generation_metrics(generation)
+    print(f"Generation {generation.version} is published")
+
+
+def _check_is_refreshable():
+    if REST_API_ROLE == ROLE_WORKER:
+        raise HTTPException(status_code=409, detail="Workers do not refresh, it is done by the builder process")
+
+
+def attach_published_generation():
+    # Workers load the most recent generation of the builder (if it is not loaded yet)
+    version = generation_store.get_current_version()
+    if (version is None) or ((current_generation is not None) and (current_generation.version == version)):
+        return
+    try:
+        generation = generation_store.load(version)
+    except (OSError, ValueError) as e:
+        # E.g. the generation was removed in the meantime, the next one is loaded with the next check
+        print(f"Generation {version} can not be loaded: {e}")
+        return
+    _publish_generation(generation)
 
 
-def _date_to_str(date):
-    return pd.to_datetime(date).strftime("%Y-%m-%d")
+def _find_and_remove_files(folder_path: str, file_pattern: str, keep: Optional[str] = None) -> list:
+    paths = [p for p in Path(folder_path).glob(file_pattern) if p.name != keep]
+    for p in paths:
+        if p.is_dir():
+            shutil.rmtree(p)
+        else:
+            p.unlink()
+    return paths
 
 
-def _find_and_remove_files(folder_path: str, file_pattern: str) -> list:
-    paths = Path(folder_path).glob(file_pattern)
-    for p in paths:
-        p.unlink()
-    return list(paths)
+def _remove_outdated_files(generation: spa.SearchGeneration):
+    # TODO: hardcoded file prefix and folder
+    _find_and_remove_files(".", "data_holder_*", keep=generation.data_holder.create_filename_for_today())
+    for w, search_tree in generation.search_models.items():
+        _find_and_remove_files(".", f"search_tree_{w}win_*", keep=search_tree.create_filename_for_today())
+
+
+def _get_etag(generation: Optional[spa.SearchGeneration], media_type: str = JSON_MEDIA_TYPE) -> str:
+    # The responses of the GET endpoints can only change with a new generation (the rest is determined by the URL and
+    # the Accept header), so the clients can revalidate their cached responses with this. The version starts again
+    # at 1 after a restart without a generation store, so the creation time (which is stored in the manifest of the
+    # published generations, so it is the same for every worker) makes it unique
+    if generation is None:
+        return f'"0-{media_type}"'
+    return f'"{generation.version}-{int(generation.created_at.timestamp() * 1e6)}-{media_type}"'
+
+
+def _is_not_modified(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    # Weak comparison, as the representation of a generation does not change
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag in (etag, "*"):
+            return True
+    return False
+
+
+def _create_not_modified_response(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Vary": "Accept"})
 
 
 @app.get("/")
@@ -93,165 +403,602 @@ def root():
 
 @app.get("/is_ready", response_model=IsReadyResponse)
 def is_read():
-    if (data_holder is None) or not data_holder.is_filled:
+    generation = current_generation
+    if (generation is None) or not generation.data_holder.is_filled:
         return IsReadyResponse(is_ready=False)
 
-    if len(search_tree_dict) == 0:
+    if len(generation.search_models) == 0:
         return IsReadyResponse(is_ready=False)
 
     return IsReadyResponse(is_ready=True)
 
 
 @app.get("/data/symbols", response_model=AvailableSymbolsResponse, tags=["data"])
-def get_available_symbols():
-    return AvailableSymbolsResponse(symbols=SYMBOL_LIST)
-
-
-@app.get("/data/refresh", response_model=SuccessResponse, include_in_schema=False)
-def refresh_data():
-    # TODO: hardcoded file prefix and folder
-    _find_and_remove_files(".", "data_holder_*.pk")
-    global data_holder
-    data_holder = _prepare_data()
-    print("Data refreshed")
-    return SuccessResponse(message="Existing data holder files removed, and a new one is created")
-
-
-@app.get("/refresh", response_model=SuccessResponse, include_in_schema=False)
-def refresh_everything():
-    refresh_data()
-    refresh_search()
-    global last_refreshed
-    last_refreshed = datetime.now()
-    return SuccessResponse()
+def get_available_symbols(response: Response, if_none_match: Optional[str] = Header(None)):
+    generation = current_generation
+    etag = _get_etag(generation)
+    if _is_not_modified(if_none_match, etag):
+        return _create_not_modified_response(etag)
+    response.headers["ETag"] = etag
+    # The failed symbols are not listed
+    symbols = generation.available_symbols if generation is not None else SYMBOL_LIST
+    return AvailableSymbolsResponse(symbols=symbols)
+
+
+def _refresh_data(full: bool) -> Tuple[spa.RawStockDataHolder, DataUpdateResponse]:
+    # The files of the current generation are not removed before the new generation is published
+    if full:
+        data_holder = _prepare_data(force_update=True)
+        nb_of_new_values = data_holder.nb_of_valid_values
+        message = "Data is downloaded, and a new data holder is created"
+    else:
+        data_holder, nb_of_new_values = spa.update_data_holder(tickers=SYMBOL_LIST, period_years=PERIOD_YEARS,
+                                                               data_source=data_source)
+        message = "Data holder is updated with the new values"
+
+    _observe_data_refresh(data_holder)
+    nb_updated_symbols = int(np.count_nonzero(nb_of_new_values))
+    failed_symbols = list(data_holder.fetch_errors.keys())
+    print(f"Data refreshed, {nb_updated_symbols} symbols updated, {len(failed_symbols)} failed")
+    return data_holder, DataUpdateResponse(message=message,
+                                           nb_updated_symbols=nb_updated_symbols,
+                                           nb_new_values=int(np.sum(nb_of_new_values)),
+                                           failed_symbols=failed_symbols)
+
+
+def _create_build_scheduler(data_holder: spa.RawStockDataHolder) -> spa.SearchTreeBuildScheduler:
+    return spa.SearchTreeBuildScheduler(data_holder=data_holder,
+                                        memory_budget=SEARCH_TREE_BUILD_MEMORY_BUDGET,
+                                        max_workers=SEARCH_TREE_BUILD_MAX_WORKERS,
+                                        nb_channels=len(SEARCH_CHANNELS))
+
+
+def _get_nb_segments(window_size: int) -> Optional[int]:
+    return REDUCED_INDEX_NB_SEGMENTS if window_size >= REDUCED_INDEX_MIN_WINDOW_SIZE else None
+
+
+def _prepare_search_trees(data_holder: spa.RawStockDataHolder, force_update: bool = False) -> dict:
+    # The parallel creation of the search windows gave Memory error on Heroku free dynos, so the number of concurrent
+    # builds is limited by the memory budget (with a small budget they are built one after another)
+    build_scheduler = _create_build_scheduler(data_holder)
+    return build_scheduler.run(AVAILABLE_SEARCH_WINDOW_SIZES,
+                               lambda w: spa.initialize_search_tree(data_holder=data_holder,
+                                                                    window_size=w,
+                                                                    force_update=force_update,
+                                                                    recall_target=SEARCH_INDEX_RECALL_TARGET,
+                                                                    latency_budget=SEARCH_INDEX_LATENCY_BUDGET,
+                                                                    nb_segments=_get_nb_segments(w),
+                                                                    channels=SEARCH_CHANNELS))
+
+
+def _refresh_search(data_holder: spa.RawStockDataHolder, full: bool) -> Tuple[dict, SearchUpdateResponse]:
+    start_time = time.perf_counter()
+    nb_added_windows = {}
+    if full:
+        search_tree_dict = _prepare_search_trees(data_holder, force_update=True)
+        for w, search_tree in search_tree_dict.items():
+            nb_added_windows[w] = int(search_tree.window_offsets[-1, -1])
+        message = "Search trees are refreshed"
+    else:
+        # Updates fall back to a full build if the index can not be extended, so they are scheduled the same way
+        build_scheduler = _create_build_scheduler(data_holder)
+        results = build_scheduler.run(AVAILABLE_SEARCH_WINDOW_SIZES,
+                                      lambda w: spa.update_search_tree(data_holder=data_holder,
+                                                                       window_size=w,
+                                                                       recall_target=SEARCH_INDEX_RECALL_TARGET,
+                                                                       latency_budget=SEARCH_INDEX_LATENCY_BUDGET,
+                                                                       nb_segments=_get_nb_segments(w),
+                                                                       channels=SEARCH_CHANNELS))
+        search_tree_dict = {w: search_tree for w, (search_tree, _) in results.items()}
+        nb_added_windows = {w: nb for w, (_, nb) in results.items()}
+        message = "Search trees are updated with the new windows"
+
+    metrics.observe(REFRESH_STAGE_METRIC, time.perf_counter() - start_time, stage="search_trees")
+    _observe_search_tree_builds(search_tree_dict)
+    print(f"{message}, added windows: {nb_added_windows}")
+    return search_tree_dict, SearchUpdateResponse(message=message, nb_added_windows=nb_added_windows)
+
+
+@app.get("/refresh", response_model=RefreshResponse, include_in_schema=False)
+def refresh_everything(full: bool = False):
+    _check_is_refreshable()
+    # The new data, search trees and precomputed matches are prepared next to the current ones (which are still
+    # serving), and they are published together, so a request never sees a partially refreshed state
+    with refresh_lock, metrics.time(REFRESH_STAGE_METRIC, stage="total"):
+        data_holder, data_response = _refresh_data(full=full)
+        search_tree_dict, search_response = _refresh_search(data_holder, full=full)
+        generation = _build_generation(data_holder, search_tree_dict)
+        _publish_generation(generation)
+        _remove_outdated_files(generation)
+    return RefreshResponse(data=data_response, search=search_response)
+
+
+@app.get("/data/refresh", response_model=DataUpdateResponse, include_in_schema=False)
+def refresh_data(full: bool = False):
+    # The search trees are built on the data, so they are refreshed together
+    return refresh_everything(full=full).data
 
 
 @app.get("/refresh/when", response_model=DataRefreshResponse, tags=["refresh"])
 def when_was_data_refreshed():
-    return DataRefreshResponse(date=last_refreshed)
+    generation = current_generation
+    return DataRefreshResponse(date=generation.created_at if generation is not None else None)
 
 
 @app.get("/search/prepare/{window_size}", response_model=SuccessResponse, include_in_schema=False)
 def prepare_search_tree(window_size: int, force_update: bool = False):
-    global search_tree_dict
-    search_tree_dict[window_size] = spa.initialize_search_tree(data_holder=data_holder,
-                                                               window_size=window_size,
-                                                               force_update=force_update)
+    _check_is_refreshable()
+    with refresh_lock:
+        generation = _get_generation()
+        search_tree = spa.initialize_search_tree(data_holder=generation.data_holder,
+                                                 window_size=window_size,
+                                                 force_update=force_update,
+                                                 recall_target=SEARCH_INDEX_RECALL_TARGET,
+                                                 latency_budget=SEARCH_INDEX_LATENCY_BUDGET,
+                                                 nb_segments=_get_nb_segments(window_size),
+                                                 channels=SEARCH_CHANNELS)
+        _observe_search_tree_builds({window_size: search_tree})
+        search_tree_dict = {**generation.search_models, window_size: search_tree}
+        match_tables = {**generation.match_tables,
+                        **spa.build_match_tables(data_holder=generation.data_holder,
+                                                 search_models={window_size: search_tree},
+                                                 max_top_k=PRECOMPUTED_MAX_TOP_K,
+                                                 max_future_size=PRECOMPUTED_MAX_FUTURE_SIZE)}
+        _publish_generation(_build_generation(generation.data_holder, search_tree_dict, match_tables))
     return SuccessResponse()
 
 
 @app.get("/search/prepare", response_model=SuccessResponse, include_in_schema=False)
 def prepare_all_search_trees(force_update: bool = False):
-    # TODO: The parallel creation of the search windows gives Memory error on Heroku free dynos
-    # with concurrent.futures.ThreadPoolExecutor() as pool:
-    #     futures = {}
-    #     for w in AVAILABLE_SEARCH_WINDOW_SIZES:
-    #         f = pool.submit(prepare_search_tree, window_size=w, force_update=force_update)
-    #         futures[f] = w
-    #
-    #     for f in concurrent.futures.as_completed(futures):
-    #         w = futures[f]
-    #         try:
-    #             f.result()
-    #             print(f"Search tree with size {w} prepared")
-    #         except Exception as e:
-    #             print(f"There was a problem with size {w}, could not create it")
-
-    # TODO: Sequential creation is used because this way Heroku won't crash (because of RAM limit)
-    for w in AVAILABLE_SEARCH_WINDOW_SIZES:
-        prepare_search_tree(window_size=w, force_update=force_update)
-        print(f"Search tree with size {w} prepared")
+    _check_is_refreshable()
+    with refresh_lock:
+        generation = _get_generation()
+        search_tree_dict = _prepare_search_trees(generation.data_holder, force_update=force_update)
+        _observe_search_tree_builds(search_tree_dict)
+        _publish_generation(_build_generation(generation.data_holder, search_tree_dict))
     return SuccessResponse()
 
 
-@app.get("/search/refresh", response_model=SuccessResponse, include_in_schema=False)
-def refresh_search():
-    # TODO: hardcoded file prefix and folder
-    _find_and_remove_files(".", "search_tree_*.pk")
-    prepare_all_search_trees()
-    print("Search trees are refreshed")
-    return SuccessResponse()
+@app.get("/search/refresh", response_model=SearchUpdateResponse, include_in_schema=False)
+def refresh_search(full: bool = False):
+    _check_is_refreshable()
+    with refresh_lock:
+        generation = _get_generation()
+        search_tree_dict, search_response = _refresh_search(generation.data_holder, full=full)
+        new_generation = _build_generation(generation.data_holder, search_tree_dict)
+        _publish_generation(new_generation)
+        _remove_outdated_files(new_generation)
+    return search_response
+
+
+def _get_match_tables_response(generation: spa.SearchGeneration, build_time: float) -> MatchTablesResponse:
+    tables = [MatchTableInfo(window_size=w,
+                             max_top_k=t.max_top_k,
+                             max_future_size=t.max_future_size,
+                             build_time=t.build_time,
+                             nbytes=t.nbytes) for w, t in generation.match_tables.items()]
+    return MatchTablesResponse(tables=tables,
+                               build_time=build_time,
+                               nbytes=sum(t.nbytes for t in tables),
+                               generation=generation.version)
+
+
+@app.get("/search/precompute", response_model=MatchTablesResponse, include_in_schema=False)
+def precompute_match_tables():
+    _check_is_refreshable()
+    with refresh_lock:
+        generation = _get_generation()
+        start_time = time.time()
+        new_generation = _build_generation(generation.data_holder, generation.search_models)
+        _publish_generation(new_generation)
+
+    response = _get_match_tables_response(new_generation, build_time=time.time() - start_time)
+    print(f"Most recent matches are precomputed in {response.build_time:.2f} secs, size: {response.nbytes} bytes")
+    return response
+
+
+@app.get("/search/precomputed", response_model=MatchTablesResponse, tags=["search"])
+def get_precomputed_match_tables():
+    generation = _get_generation()
+    return _get_match_tables_response(generation,
+                                      build_time=sum(t.build_time for t in generation.match_tables.values()))
 
 
 @app.get("/search/sizes", response_model=SearchWindowSizeResponse, tags=["search"])
-def get_available_search_window_sizes():
+def get_available_search_window_sizes(response: Response, if_none_match: Optional[str] = Header(None)):
+    etag = _get_etag(current_generation)
+    if _is_not_modified(if_none_match, etag):
+        return _create_not_modified_response(etag)
+    response.headers["ETag"] = etag
     return SearchWindowSizeResponse(sizes=AVAILABLE_SEARCH_WINDOW_SIZES)
 
 
-@app.get("/search/recent/", response_model=TopKSearchResponse, tags=["search"])
-async def search_most_recent(symbol: str, window_size: int = 5, top_k: int = 5, future_size: int = 5):
-    symbol = symbol.upper()
+def _get_label(data_holder: spa.RawStockDataHolder, symbol: str) -> int:
     try:
-        label = data_holder.symbol_to_label[symbol]
+        return data_holder.symbol_to_label[symbol]
     except KeyError:
         raise HTTPException(status_code=400, detail=f"Ticker symbol {symbol} is not supported")
-    most_recent_values = data_holder.values[label][:window_size]
-
-    try:
-        search_tree = search_tree_dict[window_size]
-    except KeyError:
-        raise HTTPException(status_code=400, detail=f"No prepared {window_size} day search window")
-
-    top_k_indices, top_k_distances = search_tree.search(values=most_recent_values, k=top_k + 1)
-    # We need to discard the first item, as that is our search sequence
-    top_k_indices = top_k_indices[1:]
-    top_k_distances = top_k_distances[1:]
 
-    forecast_values = []
-    matches = []
 
-    for index, distance in zip(top_k_indices, top_k_distances):
-        ticker = search_tree.get_window_symbol(index)
-        start_date, end_date = search_tree.get_start_end_date(index)
+def _get_anchor_label(data_holder: spa.RawStockDataHolder, symbol: str) -> int:
+    # The symbols which failed at the fill do not have values to search with
+    label = _get_label(data_holder, symbol)
+    if data_holder.nb_of_valid_values[label] == 0:
+        raise HTTPException(status_code=400, detail=f"There is no data for the ticker symbol {symbol}")
+    return label
 
-        start_date_str = _date_to_str(start_date)
-        end_date_str = _date_to_str(end_date)
 
-        window_with_future_values = search_tree.get_window_values(index=index, future_length=future_size)
-        todays_value = window_with_future_values[-window_size]
-        future_value = window_with_future_values[0]
-        diff_from_today = todays_value - future_value
-
-        match = MatchResponse(symbol=ticker,
-                              distance=distance,
-                              start_date=start_date_str,
-                              end_date=end_date_str,
-                              todays_value=todays_value,
-                              future_value=future_value,
-                              change=diff_from_today,
-                              values=window_with_future_values.tolist())
-
-        matches.append(match)
+def _get_search_tree(generation: spa.SearchGeneration, window_size: int) -> spa.SearchModel:
+    try:
+        return generation.search_models[window_size]
+    except KeyError:
+        raise HTTPException(status_code=400, detail=f"No prepared {window_size} day search window")
 
-        forecast_values.append(diff_from_today)
 
-    tmp = np.where(np.array(forecast_values) < 0, 0, 1)
-    forecast_confidence = np.sum(tmp) / len(tmp)
-    forecast_type = "gain"
-    if forecast_confidence <= 0.5:
-        forecast_type = "loss"
-        forecast_confidence = 1 - forecast_confidence
+def _get_search_filter_key(symbols: Optional[List[str]],
+                           exclude_symbols: Optional[List[str]],
+                           start_date: Optional[date],
+                           end_date: Optional[date]) -> Optional[tuple]:
+    if (not symbols) and (not exclude_symbols) and (start_date is None) and (end_date is None):
+        return None
+    return (tuple(sorted({s.upper() for s in symbols})) if symbols else None,
+            tuple(sorted({s.upper() for s in exclude_symbols})) if exclude_symbols else None,
+            start_date,
+            end_date)
+
+
+def _get_allowed_window_ids(data_holder: spa.RawStockDataHolder,
+                            search_tree: spa.SearchModel,
+                            symbols: Optional[List[str]],
+                            exclude_symbols: Optional[List[str]],
+                            start_date: Optional[date],
+                            end_date: Optional[date]) -> Optional[np.ndarray]:
+    labels = None
+    if symbols or exclude_symbols:
+        allowed_symbols = [s.upper() for s in symbols] if symbols else data_holder.ticker_symbols
+        excluded_labels = {_get_label(data_holder, s.upper()) for s in exclude_symbols or []}
+        labels = np.array([label for label in (_get_label(data_holder, s) for s in allowed_symbols)
+                           if label not in excluded_labels], dtype=np.int64)
+
+    return search_tree.get_allowed_window_ids(labels=labels,
+                                              start_date=np.datetime64(start_date) if start_date else None,
+                                              end_date=np.datetime64(end_date) if end_date else None)
+
+
+def _gather_match_data(data_holder: spa.RawStockDataHolder,
+                       top_k_labels: np.ndarray,
+                       top_k_start_indices: np.ndarray,
+                       window_size: int,
+                       future_size: int) -> tuple:
+    # Same as SearchModel.get_windows_data, but for labels and start indices
+    start_dates, end_dates = data_holder.get_windows_start_end_dates(top_k_labels, top_k_start_indices, window_size)
+    values, nb_future_values = data_holder.get_windows_values(top_k_labels, top_k_start_indices, window_size,
+                                                              future_size)
+    return top_k_labels, top_k_start_indices, start_dates, end_dates, values, nb_future_values
+
+
+def _build_top_k_result(generation: spa.SearchGeneration,
+                        symbol: str,
+                        anchor_label: int,
+                        most_recent_values: np.ndarray,
+                        top_k_distances: np.ndarray,
+                        match_data: tuple,
+                        window_size: int,
+                        top_k: int,
+                        future_size: int) -> TopKSearchResult:
+    """
+    Builds the result from the match data (see SearchModel.get_windows_data), every match is processed at once
+    """
+
+    top_k_labels, top_k_start_indices, top_k_start_dates, top_k_end_dates, top_k_windows, top_k_nb_future_values = \
+        match_data
+
+    # We need to discard our search sequence (the most recent window of the anchor), if it was not filtered out
+    is_match = ~((np.asarray(top_k_labels) == anchor_label) & (np.asarray(top_k_start_indices) == 0))
+    match_ids = np.flatnonzero(is_match)[:top_k]
+
+    # The windows are padded at the beginning if they do not have all the future values (there can be fewer future
+    # columns than future_size, see RawStockDataHolder.get_windows_values)
+    windows = np.asarray(top_k_windows)[match_ids]
+    nb_future_columns = windows.shape[1] - window_size
+    nb_padded_values = nb_future_columns - np.asarray(top_k_nb_future_values)[match_ids]
+    todays_values = windows[:, nb_future_columns]
+    future_values = windows[np.arange(len(match_ids)), nb_padded_values]
+    is_value = np.arange(windows.shape[1])[None, :] >= nb_padded_values[:, None]
+    values_offsets = np.concatenate([[0], np.cumsum(is_value.sum(axis=1))])
+
+    return TopKSearchResult(anchor_symbol=symbol,
+                            anchor_values=np.asarray(most_recent_values),
+                            window_size=window_size,
+                            top_k=top_k,
+                            future_size=future_size,
+                            symbols=generation.symbols_by_label[np.asarray(top_k_labels)[match_ids]],
+                            distances=np.asarray(top_k_distances)[match_ids],
+                            start_dates=generation.date_strings.to_str(np.asarray(top_k_start_dates)[match_ids]),
+                            end_dates=generation.date_strings.to_str(np.asarray(top_k_end_dates)[match_ids]),
+                            todays_values=todays_values,
+                            future_values=future_values,
+                            changes=todays_values - future_values,
+                            values=windows[is_value],
+                            values_offsets=values_offsets)
+
+
+def _create_search_response(results: List[TopKSearchResult],
+                            media_type: str,
+                            is_batch: bool = False,
+                            etag: Optional[str] = None) -> Response:
+    # The response is encoded directly in the negotiated format (the response model is not validated)
+    headers = {"Vary": "Accept"}
+    if etag is not None:
+        headers["ETag"] = etag
+    return Response(content=encode_results(results, media_type=media_type, is_batch=is_batch),
+                    media_type=media_type,
+                    headers=headers)
+
+
+def _search_dtw(search_tree: spa.SearchModel, label: int, k: int, allowed_ids: Optional[np.ndarray]) -> tuple:
+    stats = spa.DTWSearchStats()
+    top_k_indices, top_k_distances = search_tree.search_dtw_batch(values=search_tree.get_query_values([label]), k=k,
+                                                                  allowed_ids=allowed_ids,
+                                                                  band_fraction=DTW_BAND_FRACTION,
+                                                                  overfetch_factor=DTW_OVERFETCH_FACTOR,
+                                                                  stats=stats)
+    _observe_search_stage_times({stage if stage == "dtw" else f"dtw_{stage}": seconds
+                                 for stage, seconds in stats.stage_times.items()})
+    is_found = top_k_indices[0] >= 0
+    return top_k_indices[0][is_found], top_k_distances[0][is_found]
 
-    top_k_match = TopKSearchResponse(matches=matches,
-                                     forecast_type=forecast_type,
-                                     forecast_confidence=forecast_confidence,
-                                     anchor_symbol=symbol,
-                                     window_size=window_size,
-                                     top_k=top_k,
-                                     future_size=future_size,
-                                     anchor_values=most_recent_values.tolist())
 
-    return top_k_match
+@app.get("/search/recent/", response_model=TopKSearchResponse, tags=["search"])
+async def search_most_recent(symbol: str,
+                             window_size: int = Query(5, ge=1, le=MAX_WINDOW_SIZE),
+                             top_k: int = Query(5, ge=1, le=MAX_TOP_K),
+                             future_size: int = Query(5, ge=0, le=MAX_FUTURE_SIZE),
+                             symbols: Optional[List[str]] = Query(None),
+                             exclude_symbols: Optional[List[str]] = Query(None),
+                             start_date: Optional[date] = None,
+                             end_date: Optional[date] = None,
+                             metric: str = "euclidean",
+                             accept: Optional[str] = Header(None),
+                             if_none_match: Optional[str] = Header(None)):
+    # The matches can be restricted to a list of symbols (or exclude some) and to a date range
+    # The response format depends on the Accept header: JSON (default), MessagePack or Arrow IPC (see rest_api_formats)
+    # With the dtw metric the matches can be slightly shifted in time (see SearchModel.search_dtw_batch)
+    symbol = symbol.upper()
+    if metric not in SEARCH_METRICS:
+        raise HTTPException(status_code=400, detail=f"Unknown metric {metric}, available metrics: {SEARCH_METRICS}")
+    generation = _get_generation()
+    media_type = select_media_type(accept)
+    etag = _get_etag(generation, media_type)
+    if _is_not_modified(if_none_match, etag):
+        return _create_not_modified_response(etag)
+    data_holder = generation.data_holder
+    search_filter = _get_search_filter_key(symbols, exclude_symbols, start_date, end_date)
+    cache_key = ("recent", symbol, window_size, future_size, search_filter, metric, generation.version)
+    cached_result = search_result_cache.get(cache_key, top_k)
+    if cached_result is not None:
+        return _create_search_response([cached_result], media_type, etag=etag)
+
+    label = _get_anchor_label(data_holder, symbol)
+    # The window size is checked before the anchor values are gathered
+    search_tree = _get_search_tree(generation, window_size)
+    most_recent_values = data_holder.get_most_recent_values([label], window_size)[0]
+    # Only the grouping of the requests runs on the event loop, everything else runs on the search workers
+    loop = asyncio.get_running_loop()
+
+    # Most of the (not filtered) requests can be served from the precomputed results
+    match_table = generation.match_tables.get(window_size)
+    table_data = None
+    if (match_table is not None) and (search_filter is None) and (metric == "euclidean"):
+        start_time = time.perf_counter()
+        table_data = match_table.get(label, top_k=top_k, future_size=future_size)
+        _observe_search_stage("recent", "table_lookup", start_time)
+
+    if table_data is not None:
+        top_k_labels, top_k_start_indices, top_k_distances, *window_data = table_data
+        assembly_start_time = time.perf_counter()
+        match_data = (top_k_labels, top_k_start_indices, *window_data)
+    else:
+        allowed_ids = None
+        if search_filter is not None:
+            start_time = time.perf_counter()
+            allowed_ids = await loop.run_in_executor(search_executor, _get_allowed_window_ids, data_holder,
+                                                     search_tree, symbols, exclude_symbols, start_date, end_date)
+            _observe_search_stage("recent", "filter", start_time)
+        if metric == "dtw":
+            top_k_indices, top_k_distances = await loop.run_in_executor(
+                search_executor, functools.partial(_search_dtw, search_tree, label, top_k + 1, allowed_ids))
+        else:
+            top_k_indices, top_k_distances = await search_batcher.search(
+                key=(generation.version, window_size, search_filter),
+                search_model=search_tree,
+                values=search_tree.get_query_values([label])[0],
+                k=top_k + 1,
+                allowed_ids=allowed_ids)
+        assembly_start_time = time.perf_counter()
+        match_data = await loop.run_in_executor(search_executor, search_tree.get_windows_data, top_k_indices,
+                                                future_size)
+
+    result = await loop.run_in_executor(search_executor,
+                                        functools.partial(_build_top_k_result,
+                                                          generation=generation,
+                                                          symbol=symbol,
+                                                          anchor_label=label,
+                                                          most_recent_values=most_recent_values,
+                                                          top_k_distances=top_k_distances,
+                                                          match_data=match_data,
+                                                          window_size=window_size,
+                                                          top_k=top_k,
+                                                          future_size=future_size))
+    _observe_search_stage("recent", "response_assembly", assembly_start_time)
+    search_result_cache.put(cache_key, result)
+    serialization_start_time = time.perf_counter()
+    response = await loop.run_in_executor(search_executor,
+                                          functools.partial(_create_search_response, [result], media_type, etag=etag))
+    _observe_search_stage("recent", "serialization", serialization_start_time)
+    return response
+
+
+@app.get("/search/recent/exact", response_model=TopKSearchResponse, tags=["search"])
+def search_most_recent_exact(symbol: str,
+                             window_size: int = Query(5, ge=1, le=MAX_WINDOW_SIZE),
+                             top_k: int = Query(5, ge=1, le=MAX_TOP_K),
+                             future_size: int = Query(5, ge=0, le=MAX_FUTURE_SIZE),
+                             accept: Optional[str] = Header(None),
+                             if_none_match: Optional[str] = Header(None)):
+    # Index-free search, so any window size can be used (not only the prepared ones)
+    symbol = symbol.upper()
+    generation = _get_generation()
+    media_type = select_media_type(accept)
+    etag = _get_etag(generation, media_type)
+    if _is_not_modified(if_none_match, etag):
+        return _create_not_modified_response(etag)
+    data_holder = generation.data_holder
+    cache_key = ("exact", symbol, window_size, future_size, generation.version)
+    cached_result = search_result_cache.get(cache_key, top_k)
+    if cached_result is not None:
+        return _create_search_response([cached_result], media_type, etag=etag)
+
+    label = _get_anchor_label(data_holder, symbol)
+    # The window size is checked before the anchor values are gathered
+    try:
+        generation.exact_search_model.check_window_size(window_size)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    most_recent_values = data_holder.get_most_recent_values([label], window_size)[0]
+
+    start_time = time.perf_counter()
+    top_k_labels, top_k_start_indices, top_k_distances = generation.exact_search_model.search(
+        values=most_recent_values, k=top_k + 1)
+    _observe_search_stage("exact", "exact_search", start_time)
+
+    start_time = time.perf_counter()
+    match_data = _gather_match_data(data_holder, top_k_labels, top_k_start_indices, window_size, future_size)
+    result = _build_top_k_result(generation=generation,
+                                 symbol=symbol,
+                                 anchor_label=label,
+                                 most_recent_values=most_recent_values,
+                                 top_k_distances=top_k_distances,
+                                 match_data=match_data,
+                                 window_size=window_size,
+                                 top_k=top_k,
+                                 future_size=future_size)
+    _observe_search_stage("exact", "response_assembly", start_time)
+    search_result_cache.put(cache_key, result)
+    start_time = time.perf_counter()
+    response = _create_search_response([result], media_type, etag=etag)
+    _observe_search_stage("exact", "serialization", start_time)
+    return response
+
+
+@app.get("/search/cache", response_model=CacheStatsResponse, tags=["search"])
+def get_search_cache_stats():
+    return CacheStatsResponse(nb_hits=search_result_cache.nb_hits,
+                              nb_misses=search_result_cache.nb_misses,
+                              size=len(search_result_cache),
+                              max_size=search_result_cache.max_size,
+                              generation=current_generation.version if current_generation is not None else 0)
+
+
+@app.get("/search/batching", response_model=SearchBatchingStatsResponse, tags=["search"])
+def get_search_batching_stats():
+    batch_size_histogram = search_batcher.get_batch_size_histogram()
+    return SearchBatchingStatsResponse(batch_window_ms=search_batcher.batch_window * 1000,
+                                       max_batch_size=search_batcher.max_batch_size,
+                                       nb_workers=SEARCH_NB_WORKERS,
+                                       nb_batches=sum(batch_size_histogram.values()),
+                                       nb_queries=sum(size * count for size, count in batch_size_histogram.items()),
+                                       batch_size_histogram=batch_size_histogram)
+
+
+@app.post("/search/recent/batch", response_model=BatchSearchResponse, tags=["search"])
+def search_most_recent_batch(request: BatchSearchRequest, accept: Optional[str] = Header(None)):
+    queries = request.queries
+    generation = _get_generation()
+    data_holder = generation.data_holder
+    labels = [_get_anchor_label(data_holder, q.symbol.upper()) for q in queries]
+
+    # Queries with the same window size (and filters) are searched together, with a single (multi-threaded) index query
+    search_key_to_query_ids = {}
+    for i, q in enumerate(queries):
+        search_filter = _get_search_filter_key(q.symbols, q.exclude_symbols, q.start_date, q.end_date)
+        search_key_to_query_ids.setdefault((q.window_size, search_filter), []).append(i)
+
+    results = [None] * len(queries)
+    for (window_size, _), query_ids in search_key_to_query_ids.items():
+        search_tree = _get_search_tree(generation, window_size)
+        q = queries[query_ids[0]]
+        allowed_ids = _get_allowed_window_ids(data_holder, search_tree, q.symbols, q.exclude_symbols, q.start_date,
+                                              q.end_date)
+        most_recent_values = data_holder.get_most_recent_values([labels[i] for i in query_ids], window_size)
+        max_top_k = max(queries[i].top_k for i in query_ids)
+
+        stage_times = {}
+        top_k_indices, top_k_distances = search_tree.search_batch(
+            values=search_tree.get_query_values([labels[i] for i in query_ids]), k=max_top_k + 1,
+            allowed_ids=allowed_ids, stage_times=stage_times)
+        _observe_search_stage_times(stage_times, endpoint="batch")
+
+        start_time = time.perf_counter()
+        for row, i in enumerate(query_ids):
+            is_found = top_k_indices[row] >= 0
+            match_data = search_tree.get_windows_data(top_k_indices[row][is_found], queries[i].future_size)
+            results[i] = _build_top_k_result(generation=generation,
+                                             symbol=queries[i].symbol.upper(),
+                                             anchor_label=labels[i],
+                                             most_recent_values=most_recent_values[row],
+                                             top_k_distances=top_k_distances[row][is_found],
+                                             match_data=match_data,
+                                             window_size=window_size,
+                                             top_k=queries[i].top_k,
+                                             future_size=queries[i].future_size)
+        _observe_search_stage("batch", "response_assembly", start_time)
+
+    start_time = time.perf_counter()
+    response = _create_search_response(results, select_media_type(accept), is_batch=True)
+    _observe_search_stage("batch", "serialization", start_time)
+    return response
+
+
+@app.get("/metrics", tags=["metrics"])
+def get_metrics():
+    # Prometheus text format. The process and generation gauges are updated at the scrape, the rest as it happens
+    metrics.set(RSS_METRIC, psutil.Process().memory_info().rss)
+    generation = current_generation
+    if generation is not None:
+        metrics.set(GENERATION_AGE_METRIC, (datetime.now() - generation.created_at).total_seconds())
+    return Response(content=metrics.render(), media_type=METRICS_MEDIA_TYPE)
+
+
+def warm_start():
+    # Today's serialized data and search trees are loaded (built only if missing), so a restart does not rebuild
+    # every index
+    with refresh_lock:
+        data_holder = _prepare_data()
+        _observe_data_refresh(data_holder)
+        search_tree_dict = _prepare_search_trees(data_holder)
+        _observe_search_tree_builds(search_tree_dict)
+        _publish_generation(_build_generation(data_holder, search_tree_dict))
 
 
 @app.on_event("startup")
 def startup_event():
-    # Download and prepare new data when app starts
+    if REST_API_ROLE == ROLE_WORKER:
+        # Workers only load the published generations, the first one as soon as it is available
+        refresh_scheduler.add_job(func=attach_published_generation, trigger="interval", seconds=GENERATION_POLL_SECONDS,
+                                  max_instances=1, coalesce=True, next_run_time=datetime.now())
+        refresh_scheduler.start()
+        return
+
+    # Load (or download and prepare, if there is nothing for today) the data when app starts
     # This is started in the bg as app needs to start-up in less than 60secs (for Heroku)
-    threading.Thread(target=refresh_everything).start()
+    threading.Thread(target=warm_start).start()
 
-    # Refresh data after every market close
+    # Refresh data after every market close (only the new values are downloaded and indexed)
     # TODO: set the timezones and add multiple refresh jobs for the multiple market closes
     refresh_scheduler.add_job(func=refresh_everything, trigger="cron", day="*", hour=8, minute=35)
     refresh_scheduler.add_job(func=refresh_everything, trigger="cron", day="*", hour=15, minute=35)
+    # Everything is downloaded and built from scratch once a week (e.g. to re-train the IVF indices)
+    refresh_scheduler.add_job(func=refresh_everything, kwargs={"full": True}, trigger="cron", day_of_week="sun",
+                              hour=2, minute=0)
     refresh_scheduler.start()
@@ -0,0 +1,179 @@
+from collections import OrderedDict
+import threading
+from typing import Hashable, List, Optional, Tuple, Union
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from rest_api_formats import decode_top_k_response, get_accept_header
+from rest_api_models import AvailableSymbolsResponse, DataRefreshResponse, SearchWindowSizeResponse, TopKSearchResponse
+
+# Responses which are worth retrying (e.g. the RestAPI is restarting or it is not ready yet)
+RETRY_STATUS_CODES = (502, 503, 504)
+
+
+class RestApiClient:
+    """
+    Client of the RestAPI. Every request goes through a single session, which keeps a pool of keep-alive connections
+    (so a request does not open a new connection), and it can be used from multiple threads (e.g. Dash callbacks).
+    The requests have timeouts, and the failed requests are retried with backoff.
+
+    The responses with an ETag are cached, and they are revalidated with the server: while the data of the RestAPI
+    does not change (there is no refresh), the server answers with an empty "not modified" response, and it does not
+    search again.
+
+    The symbols and the search window sizes can be refreshed in the background, so they are always available without a
+    request, and they follow the refreshes of the RestAPI
+    """
+
+    def __init__(self,
+                 base_url: str,
+                 timeout: Union[float, Tuple[float, float]] = (3.05, 30),
+                 nb_retries: int = 3,
+                 backoff_factor: float = 0.2,
+                 pool_size: int = 32,
+                 cache_max_size: int = 1024):
+        """
+        Args:
+            base_url: base URL of the RestAPI
+            timeout: timeout of the requests in seconds, or a (connect, read) tuple
+            nb_retries: maximum number of retries of a request
+            backoff_factor: the n-th retry waits backoff_factor * 2^(n-1) seconds
+            pool_size: maximum number of connections which are kept alive
+            cache_max_size: maximum number of cached responses
+        """
+
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+        retry = Retry(total=nb_retries,
+                      backoff_factor=backoff_factor,
+                      status_forcelist=RETRY_STATUS_CODES,
+                      allowed_methods=frozenset({"GET"}),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self._session = requests.Session()
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+
+        # (url, params, accept) -> (etag, content, content type)
+        self.cache_max_size = cache_max_size
+        self._cache: OrderedDict = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self.nb_not_modified = 0
+
+        self.symbols: List[str] = []
+        self.window_sizes: List[int] = []
+        self._refresh_thread: Optional[threading.Thread] = None
+        self._stop_refresh = threading.Event()
+
+    def _get_cached(self, key: Hashable) -> Optional[tuple]:
+        with self._cache_lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                self._cache.move_to_end(key)
+            return entry
+
+    def _put_cached(self, key: Hashable, entry: tuple):
+        with self._cache_lock:
+            self._cache[key] = entry
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_max_size:
+                self._cache.popitem(last=False)
+
+    def get(self, path: str, params: Optional[dict] = None, accept: Optional[str] = None) -> Tuple[bytes, str]:
+        """
+        GET request with the cache of the responses
+        Args:
+            path: path of the endpoint (e.g. /search/sizes)
+            params: query parameters
+            accept: value of the Accept header
+
+        Returns:
+            content and content type of the response
+        """
+
+        url = f"{self.base_url}{path}"
+        key = (url, tuple(sorted(params.items())) if params else (), accept)
+        headers = {}
+        if accept is not None:
+            headers["Accept"] = accept
+        cached = self._get_cached(key)
+        if cached is not None:
+            headers["If-None-Match"] = cached[0]
+
+        res = self._session.get(url, params=params, headers=headers, timeout=self.timeout)
+        if (res.status_code == 304) and (cached is not None):
+            self.nb_not_modified += 1
+            return cached[1], cached[2]
+        res.raise_for_status()
+
+        content_type = res.headers.get("Content-Type", "application/json")
+        etag = res.headers.get("ETag")
+        if etag is not None:
+            self._put_cached(key, (etag, res.content, content_type))
+        return res.content, content_type
+
+    def get_search_window_sizes(self) -> List[int]:
+        content, _ = self.get("/search/sizes")
+        return SearchWindowSizeResponse.parse_raw(content).sizes
+
+    def get_symbols(self) -> List[str]:
+        content, _ = self.get("/data/symbols")
+        return AvailableSymbolsResponse.parse_raw(content).symbols
+
+    def search_most_recent(self, symbol: str, window_size: int, top_k: int, future_size: int,
+                           metric: str = "euclidean") -> TopKSearchResponse:
+        # The fastest available response format is requested (binary formats carry the values as float32 buffers)
+        params = {"symbol": symbol.upper(), "window_size": window_size, "top_k": top_k, "future_size": future_size,
+                  "metric": metric}
+        content, content_type = self.get("/search/recent/", params=params, accept=get_accept_header())
+        return decode_top_k_response(content, content_type)
+
+    def get_last_refresh_date(self) -> str:
+        content, _ = self.get("/refresh/when")
+        res = DataRefreshResponse.parse_raw(content)
+        return res.date.strftime("%Y/%m/%d, %H:%M:%S")
+
+    def refresh_metadata(self):
+        """
+        Refreshes the symbols and the search window sizes, the previous values are kept if the RestAPI can not be
+        reached
+
+        Returns:
+            None
+        """
+
+        try:
+            self.symbols = self.get_symbols()
+            self.window_sizes = self.get_search_window_sizes()
+        except requests.RequestException as e:
+            print(f"Could not refresh the symbols and window sizes: {e}")
+
+    def _refresh_metadata_periodically(self, interval: float):
+        while not self._stop_refresh.wait(interval):
+            self.refresh_metadata()
+
+    def start_background_refresh(self, interval: float):
+        """
+        Refreshes the symbols and the search window sizes periodically in a background thread
+        Args:
+            interval: seconds between the refreshes
+
+        Returns:
+            None
+        """
+
+        if (self._refresh_thread is not None) and self._refresh_thread.is_alive():
+            return
+        self._stop_refresh.clear()
+        self._refresh_thread = threading.Thread(target=self._refresh_metadata_periodically, args=(interval,),
+                                                daemon=True)
+        self._refresh_thread.start()
+
+    def stop_background_refresh(self):
+        self._stop_refresh.set()
+        if self._refresh_thread is not None:
+            self._refresh_thread.join()
+            self._refresh_thread = None
@@ -0,0 +1,394 @@
+import json
+from typing import List, Optional, Tuple
+
+import numpy as np
+
+from rest_api_models import BatchSearchResponse, TopKSearchResponse
+
+# The binary formats (and the fast JSON encoder) are optional, only the installed ones are offered
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import pyarrow
+    import pyarrow.ipc
+except ImportError:
+    pyarrow = None
+
+JSON_MEDIA_TYPE = "application/json"
+MSGPACK_MEDIA_TYPE = "application/msgpack"
+ARROW_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+MEDIA_TYPE_ALIASES = {"application/x-msgpack": MSGPACK_MEDIA_TYPE,
+                      "application/vnd.msgpack": MSGPACK_MEDIA_TYPE}
+
+# The match arrays are packed as little-endian buffers in the binary formats
+FLOAT_DTYPE = np.dtype("<f4")
+OFFSET_DTYPE = np.dtype("<i4")
+
+
+def get_available_media_types() -> List[str]:
+    """
+    Supported response formats, from the fastest to the slowest to decode
+    """
+
+    media_types = []
+    if msgpack is not None:
+        media_types.append(MSGPACK_MEDIA_TYPE)
+    if pyarrow is not None:
+        media_types.append(ARROW_MEDIA_TYPE)
+    media_types.append(JSON_MEDIA_TYPE)
+    return media_types
+
+
+def get_accept_header() -> str:
+    # The fastest available format is preferred by the client
+    media_types = get_available_media_types()
+    return ", ".join(f"{media_type};q={1 - i / 10:.1f}" for i, media_type in enumerate(media_types))
+
+
+def select_media_type(accept: Optional[str]) -> str:
+    """
+    Content negotiation: selects the supported media type with the highest quality from the Accept header
+    Args:
+        accept: value of the Accept header of the request
+
+    Returns:
+        selected media type, JSON if there is no supported media type in the header
+    """
+
+    if not accept:
+        return JSON_MEDIA_TYPE
+
+    candidates = []
+    for i, accepted in enumerate(accept.split(",")):
+        media_type, *params = [x.strip() for x in accepted.split(";")]
+        quality = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    pass
+        if quality > 0:
+            candidates.append((-quality, i, media_type.lower()))
+
+    available_media_types = get_available_media_types()
+    for _, _, media_type in sorted(candidates):
+        media_type = MEDIA_TYPE_ALIASES.get(media_type, media_type)
+        if media_type in available_media_types:
+            return media_type
+    return JSON_MEDIA_TYPE
+
+
+def calculate_forecast(forecast_values: np.ndarray) -> Tuple[str, float]:
+    if len(forecast_values) == 0:
+        # E.g. the filters of the search did not allow any match
+        return "gain", 0.0
+    tmp = np.where(np.array(forecast_values) < 0, 0, 1)
+    forecast_confidence = np.sum(tmp) / len(tmp)
+    forecast_type = "gain"
+    if forecast_confidence <= 0.5:
+        forecast_type = "loss"
+        forecast_confidence = 1 - forecast_confidence
+    return forecast_type, float(forecast_confidence)
+
+
+class TopKSearchResult:
+    """
+    Columnar version of the TopKSearchResponse: the fields of the matches are arrays, and the values of the matches
+    (which have different lengths, as not every match has all the future values) are concatenated.
+    The search endpoints create and cache these, and they are encoded to the requested format at the end, so there is
+    no object created (and validated) for every match
+    """
+
+    def __init__(self,
+                 anchor_symbol: str,
+                 anchor_values: np.ndarray,
+                 window_size: int,
+                 top_k: int,
+                 future_size: int,
+                 symbols: np.ndarray,
+                 distances: np.ndarray,
+                 start_dates: np.ndarray,
+                 end_dates: np.ndarray,
+                 todays_values: np.ndarray,
+                 future_values: np.ndarray,
+                 changes: np.ndarray,
+                 values: np.ndarray,
+                 values_offsets: np.ndarray):
+        """
+        Args:
+            anchor_symbol: symbol of the searched window
+            anchor_values: values of the searched window
+            window_size: size of the searched window
+            top_k: requested number of matches (there can be less matches)
+            future_size: requested number of future values
+            symbols: symbols of the matches (str array)
+            distances: distances of the matches
+            start_dates: start dates of the matches (str array, "%Y-%m-%d")
+            end_dates: end dates of the matches (str array, "%Y-%m-%d")
+            todays_values: most recent value of the matched windows
+            future_values: last available future value of the matches
+            changes: todays_values - future_values
+            values: concatenated values (with the future values) of the matches
+            values_offsets: values of the i-th match are values[values_offsets[i]:values_offsets[i + 1]]
+        """
+
+        self.anchor_symbol = anchor_symbol
+        self.anchor_values = anchor_values
+        self.window_size = window_size
+        self.top_k = top_k
+        self.future_size = future_size
+        self.symbols = symbols
+        self.distances = distances
+        self.start_dates = start_dates
+        self.end_dates = end_dates
+        self.todays_values = todays_values
+        self.future_values = future_values
+        self.changes = changes
+        self.values = values
+        self.values_offsets = values_offsets
+        self.forecast_type, self.forecast_confidence = calculate_forecast(changes)
+
+    def __len__(self) -> int:
+        return len(self.symbols)
+
+    def slice(self, top_k: int) -> "TopKSearchResult":
+        # Result with the first top_k matches (e.g. a smaller top_k request is served from the cache)
+        if top_k == self.top_k:
+            return self
+        offsets = self.values_offsets[:top_k + 1]
+        return TopKSearchResult(anchor_symbol=self.anchor_symbol,
+                                anchor_values=self.anchor_values,
+                                window_size=self.window_size,
+                                top_k=top_k,
+                                future_size=self.future_size,
+                                symbols=self.symbols[:top_k],
+                                distances=self.distances[:top_k],
+                                start_dates=self.start_dates[:top_k],
+                                end_dates=self.end_dates[:top_k],
+                                todays_values=self.todays_values[:top_k],
+                                future_values=self.future_values[:top_k],
+                                changes=self.changes[:top_k],
+                                values=self.values[:offsets[-1]],
+                                values_offsets=offsets)
+
+    def to_dict(self) -> dict:
+        """
+        Same structure as the TopKSearchResponse
+        """
+
+        values = self.values.tolist()
+        offsets = self.values_offsets.tolist()
+        matches = [{"symbol": symbol,
+                    "distance": distance,
+                    "start_date": start_date,
+                    "end_date": end_date,
+                    "todays_value": todays_value,
+                    "future_value": future_value,
+                    "change": change,
+                    "values": values[offsets[i]:offsets[i + 1]]}
+                   for i, (symbol, distance, start_date, end_date, todays_value, future_value, change) in
+                   enumerate(zip(self.symbols.tolist(), self.distances.tolist(), self.start_dates.tolist(),
+                                 self.end_dates.tolist(), self.todays_values.tolist(), self.future_values.tolist(),
+                                 self.changes.tolist()))]
+        return {"matches": matches,
+                "forecast_type": self.forecast_type,
+                "forecast_confidence": self.forecast_confidence,
+                "anchor_symbol": self.anchor_symbol,
+                "anchor_values": self.anchor_values.tolist(),
+                "window_size": self.window_size,
+                "top_k": self.top_k,
+                "future_size": self.future_size}
+
+    def to_model(self) -> TopKSearchResponse:
+        return TopKSearchResponse(**self.to_dict())
+
+    def _get_header(self) -> dict:
+        # Fields which are not per match
+        return {"anchor_symbol": self.anchor_symbol,
+                "window_size": self.window_size,
+                "top_k": self.top_k,
+                "future_size": self.future_size,
+                "forecast_type": self.forecast_type,
+                "forecast_confidence": self.forecast_confidence}
+
+    def to_columns(self) -> dict:
+        """
+        Columnar payload (of the MessagePack format): the numeric arrays are packed float32 buffers
+        """
+
+        columns = self._get_header()
+        columns.update({"anchor_values": self.anchor_values.astype(FLOAT_DTYPE).tobytes(),
+                        "symbols": self.symbols.tolist(),
+                        "distances": self.distances.astype(FLOAT_DTYPE).tobytes(),
+                        "start_dates": self.start_dates.tolist(),
+                        "end_dates": self.end_dates.tolist(),
+                        "todays_values": self.todays_values.astype(FLOAT_DTYPE).tobytes(),
+                        "future_values": self.future_values.astype(FLOAT_DTYPE).tobytes(),
+                        "changes": self.changes.astype(FLOAT_DTYPE).tobytes(),
+                        "values": self.values.astype(FLOAT_DTYPE).tobytes(),
+                        "values_offsets": self.values_offsets.astype(OFFSET_DTYPE).tobytes()})
+        return columns
+
+    @classmethod
+    def from_columns(cls, columns: dict) -> "TopKSearchResult":
+        return cls(anchor_symbol=columns["anchor_symbol"],
+                   anchor_values=np.frombuffer(columns["anchor_values"], dtype=FLOAT_DTYPE),
+                   window_size=columns["window_size"],
+                   top_k=columns["top_k"],
+                   future_size=columns["future_size"],
+                   symbols=np.array(columns["symbols"], dtype=str),
+                   distances=np.frombuffer(columns["distances"], dtype=FLOAT_DTYPE),
+                   start_dates=np.array(columns["start_dates"], dtype=str),
+                   end_dates=np.array(columns["end_dates"], dtype=str),
+                   todays_values=np.frombuffer(columns["todays_values"], dtype=FLOAT_DTYPE),
+                   future_values=np.frombuffer(columns["future_values"], dtype=FLOAT_DTYPE),
+                   changes=np.frombuffer(columns["changes"], dtype=FLOAT_DTYPE),
+                   values=np.frombuffer(columns["values"], dtype=FLOAT_DTYPE),
+                   values_offsets=np.frombuffer(columns["values_offsets"], dtype=OFFSET_DTYPE))
+
+
+def _concatenate(arrays: list, dtype) -> np.ndarray:
+    return np.concatenate(arrays).astype(dtype) if arrays else np.zeros(0, dtype=dtype)
+
+
+def _encode_arrow(results: List[TopKSearchResult]) -> bytes:
+    # The matches of every result are in a single table (with the index of the result), the rest of the fields are in
+    # the metadata of the schema
+    headers = [dict(r._get_header(), anchor_values=r.anchor_values.tolist()) for r in results]
+
+    values_offsets = [np.zeros(1, dtype=np.int64)]
+    nb_values = 0
+    for r in results:
+        values_offsets.append(r.values_offsets[1:] + nb_values)
+        nb_values += int(r.values_offsets[-1])
+    values = pyarrow.ListArray.from_arrays(pyarrow.array(_concatenate(values_offsets, np.int32)),
+                                           pyarrow.array(_concatenate([r.values for r in results], np.float32)))
+
+    table = pyarrow.table(
+        [pyarrow.array(np.repeat(np.arange(len(results), dtype=np.int32), [len(r) for r in results])),
+         pyarrow.array(_concatenate([r.symbols for r in results], str).tolist(), type=pyarrow.string()),
+         pyarrow.array(_concatenate([r.distances for r in results], np.float32)),
+         pyarrow.array(_concatenate([r.start_dates for r in results], str).tolist(), type=pyarrow.string()),
+         pyarrow.array(_concatenate([r.end_dates for r in results], str).tolist(), type=pyarrow.string()),
+         pyarrow.array(_concatenate([r.todays_values for r in results], np.float32)),
+         pyarrow.array(_concatenate([r.future_values for r in results], np.float32)),
+         pyarrow.array(_concatenate([r.changes for r in results], np.float32)),
+         values],
+        names=["result_index", "symbol", "distance", "start_date", "end_date", "todays_value", "future_value",
+               "change", "values"])
+    table = table.replace_schema_metadata({"results": json.dumps(headers)})
+
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def _decode_arrow(content: bytes) -> List[TopKSearchResult]:
+    table = pyarrow.ipc.open_stream(content).read_all().combine_chunks()
+    headers = json.loads(table.schema.metadata[b"results"])
+
+    result_indices = table.column("result_index").to_numpy()
+    columns = {name: table.column(name).to_numpy(zero_copy_only=False)
+               for name in ["symbol", "distance", "start_date", "end_date", "todays_value", "future_value", "change"]}
+    values_column = table.column("values").chunk(0) if table.num_rows > 0 else None
+    all_values = values_column.flatten().to_numpy() if values_column is not None else np.zeros(0, np.float32)
+    all_offsets = values_column.offsets.to_numpy() - values_column.offsets[0].as_py() if values_column is not None \
+        else np.zeros(1, np.int32)
+
+    results = []
+    # The rows are ordered by the result index
+    bounds = np.searchsorted(result_indices, np.arange(len(headers) + 1))
+    for i, header in enumerate(headers):
+        start, end = bounds[i], bounds[i + 1]
+        offsets = all_offsets[start:end + 1]
+        results.append(TopKSearchResult(anchor_symbol=header["anchor_symbol"],
+                                        anchor_values=np.array(header["anchor_values"], dtype=np.float32),
+                                        window_size=header["window_size"],
+                                        top_k=header["top_k"],
+                                        future_size=header["future_size"],
+                                        symbols=columns["symbol"][start:end].astype(str),
+                                        distances=columns["distance"][start:end],
+                                        start_dates=columns["start_date"][start:end].astype(str),
+                                        end_dates=columns["end_date"][start:end].astype(str),
+                                        todays_values=columns["todays_value"][start:end],
+                                        future_values=columns["future_value"][start:end],
+                                        changes=columns["change"][start:end],
+                                        values=all_values[offsets[0]:offsets[-1]],
+                                        values_offsets=offsets - offsets[0]))
+    return results
+
+
+def _dump_json(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+
+def encode_results(results: List[TopKSearchResult], media_type: str, is_batch: bool = False) -> bytes:
+    """
+    Encodes the search results, the JSON format is the same as the response models (without validation)
+    Args:
+        results: search results
+        media_type: one of the available media types (see get_available_media_types)
+        is_batch: if True, then it is a BatchSearchResponse, otherwise a TopKSearchResponse (of the first result)
+
+    Returns:
+        encoded content
+    """
+
+    if media_type == ARROW_MEDIA_TYPE:
+        # The same layout is used for a single and for multiple results
+        return _encode_arrow(results)
+    if media_type == MSGPACK_MEDIA_TYPE:
+        payload = {"results": [r.to_columns() for r in results]} if is_batch else results[0].to_columns()
+        return msgpack.packb(payload, use_bin_type=True)
+    payload = {"results": [r.to_dict() for r in results]} if is_batch else results[0].to_dict()
+    return _dump_json(payload)
+
+
+def decode_results(content: bytes, media_type: str) -> List[TopKSearchResult]:
+    """
+    Decodes the content of the binary formats (see encode_results)
+    Args:
+        content: content of the response
+        media_type: content type of the response
+
+    Returns:
+        list of the results (a single search has a single result)
+    """
+
+    media_type = MEDIA_TYPE_ALIASES.get(media_type, media_type)
+    if media_type == ARROW_MEDIA_TYPE:
+        return _decode_arrow(content)
+    if media_type == MSGPACK_MEDIA_TYPE:
+        payload = msgpack.unpackb(content, raw=False)
+        if "results" in payload:
+            return [TopKSearchResult.from_columns(columns) for columns in payload["results"]]
+        return [TopKSearchResult.from_columns(payload)]
+    raise ValueError(f"Media type {media_type} is not a binary format")
+
+
+def _get_media_type(content_type: Optional[str]) -> str:
+    return (content_type or JSON_MEDIA_TYPE).split(";")[0].strip().lower()
+
+
+def decode_top_k_response(content: bytes, content_type: Optional[str]) -> TopKSearchResponse:
+    media_type = _get_media_type(content_type)
+    if media_type == JSON_MEDIA_TYPE:
+        return TopKSearchResponse.parse_raw(content)
+    return decode_results(content, media_type)[0].to_model()
+
+
+def decode_batch_search_response(content: bytes, content_type: Optional[str]) -> BatchSearchResponse:
+    media_type = _get_media_type(content_type)
+    if media_type == JSON_MEDIA_TYPE:
+        return BatchSearchResponse.parse_raw(content)
+    return BatchSearchResponse(results=[r.to_model() for r in decode_results(content, media_type)])
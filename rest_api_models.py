@@ -1,13 +1,34 @@
-from datetime import datetime
-from typing import List, Optional
+from datetime import date, datetime
+from typing import Dict, List, Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
+
+# Limits of the search parameters, larger values are rejected (the responses would not fit to the memory)
+MAX_WINDOW_SIZE = 10000
+MAX_TOP_K = 1000
+MAX_FUTURE_SIZE = 1000
 
 
 class SuccessResponse(BaseModel):
     message: str = "Successful"
 
 
+class DataUpdateResponse(SuccessResponse):
+    nb_updated_symbols: int
+    nb_new_values: int
+    # Symbols which could not be fetched (they are not searchable if they do not have earlier values)
+    failed_symbols: List[str] = []
+
+
+class SearchUpdateResponse(SuccessResponse):
+    nb_added_windows: Dict[int, int]
+
+
+class RefreshResponse(SuccessResponse):
+    data: DataUpdateResponse
+    search: SearchUpdateResponse
+
+
 class SearchWindowSizeResponse(BaseModel):
     sizes: List[int]
 
@@ -38,6 +59,59 @@ class TopKSearchResponse(BaseModel):
     future_size: int
 
 
+class SearchQuery(BaseModel):
+    symbol: str
+    window_size: int = Field(5, ge=1, le=MAX_WINDOW_SIZE)
+    top_k: int = Field(5, ge=1, le=MAX_TOP_K)
+    future_size: int = Field(5, ge=0, le=MAX_FUTURE_SIZE)
+    # Optional filters of the matches
+    symbols: Optional[List[str]] = None
+    exclude_symbols: Optional[List[str]] = None
+    start_date: Optional[date] = None
+    end_date: Optional[date] = None
+
+
+class BatchSearchRequest(BaseModel):
+    queries: List[SearchQuery]
+
+
+class BatchSearchResponse(BaseModel):
+    results: List[TopKSearchResponse]
+
+
+class CacheStatsResponse(BaseModel):
+    nb_hits: int
+    nb_misses: int
+    size: int
+    max_size: int
+    generation: int
+
+
+class SearchBatchingStatsResponse(BaseModel):
+    batch_window_ms: float
+    max_batch_size: int
+    nb_workers: int
+    nb_batches: int
+    nb_queries: int
+    # Batch size -> number of batches
+    batch_size_histogram: Dict[int, int]
+
+
+class MatchTableInfo(BaseModel):
+    window_size: int
+    max_top_k: int
+    max_future_size: int
+    build_time: float
+    nbytes: int
+
+
+class MatchTablesResponse(BaseModel):
+    tables: List[MatchTableInfo]
+    build_time: float
+    nbytes: int
+    generation: int
+
+
 class DataRefreshResponse(BaseModel):
     message: str = "Last (most recent) refresh"
     date: datetime
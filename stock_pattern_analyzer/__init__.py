@@ -1,4 +1,13 @@
-from .data import RawStockDataHolder, initialize_data_holder
+from .build_scheduler import SearchTreeBuildScheduler
+from .data import RawStockDataHolder, initialize_data_holder, update_data_holder
+from .data_sources import DataSource, FetchResult, LocalFileDataSource, YahooDataSource
+from .dtw import DTWSearchStats
+from .exact_search import ExactSearchModel
+from .generation import SearchGeneration, build_match_tables
+from .generation_store import GenerationStore
+from .metrics import MetricsRegistry
+from .micro_batching import MicroBatchSearcher
+from .precompute import MostRecentMatchTable
 from .search_index import MemoryEfficientIndex, cKDTreeIndex, FastIndex
-from .search_model import SearchModel, initialize_search_tree
-from .visualization import visualize_graph
+from .search_model import SearchModel, initialize_search_tree, update_search_tree
+from .visualization import FigureCache, get_content_hash, visualize_graph
@@ -0,0 +1,122 @@
+import concurrent.futures
+import os
+from typing import Callable, Dict, Iterable, Optional, TypeVar
+
+import numpy as np
+import psutil
+
+from .data import RawStockDataHolder
+
+T = TypeVar("T")
+
+# Bytes per window value at the peak of a build: the float32 window matrix, the NaN mask of it and the PQ code (which
+# is at most one byte per value, even with tuned index parameters)
+BYTES_PER_WINDOW_VALUE = 4 + 1 + 1
+# Bytes per window in the index: the id
+BYTES_PER_INDEXED_WINDOW = 8
+# Temporary arrays of faiss (training, residuals of the added batches) are covered with this factor
+MEMORY_SAFETY_FACTOR = 1.25
+# Used when there is no budget set: this fraction of the available memory can be used by the builds
+DEFAULT_MEMORY_BUDGET_FRACTION = 0.5
+
+
+class SearchTreeBuildScheduler:
+    """
+    Builds the search trees of multiple window sizes in parallel, but only as many at once as fit in the memory
+    budget. The peak memory of a build is estimated from the number of windows and the window size, and a build is
+    started only when the estimated memory of the running builds and the new one is within the budget.
+
+    On a small machine (or with a small budget) this is the same as building them one after another, while on a large
+    machine the total time is close to the time of the slowest build
+    """
+
+    def __init__(self,
+                 data_holder: RawStockDataHolder,
+                 memory_budget: Optional[int] = None,
+                 max_workers: Optional[int] = None,
+                 nb_channels: int = 1):
+        """
+        Args:
+            data_holder: the data holder which is used for the search trees
+            memory_budget: bytes which can be used by the concurrent builds. If not set, then it is a fraction of the
+                available memory
+            max_workers: maximum number of concurrent builds. If not set, then it is the number of CPUs
+            nb_channels: number of channels of the search trees (see SearchModel), the windows are this many times
+                larger
+        """
+
+        self._data_holder = data_holder
+        self.nb_channels = nb_channels
+        if memory_budget is None:
+            memory_budget = int(psutil.virtual_memory().available * DEFAULT_MEMORY_BUDGET_FRACTION)
+        self.memory_budget = memory_budget
+        self.max_workers = max_workers if max_workers is not None else (os.cpu_count() or 1)
+
+    def estimate_peak_memory(self, window_size: int) -> int:
+        """
+        Estimates the peak memory (in bytes) of building the search tree for a given window size
+        Args:
+            window_size: size of the search windows
+
+        Returns:
+            estimated peak memory in bytes
+        """
+
+        nb_of_valid_values = self._data_holder.nb_of_valid_values.astype(np.int64)
+        nb_windows = int(np.maximum(nb_of_valid_values - window_size + 1, 0).sum())
+        # Positions of the windows (the windows themselves are only a strided view)
+        positions_size = nb_windows * np.dtype(np.int64).itemsize
+        peak_memory = (nb_windows * (self.nb_channels * window_size * BYTES_PER_WINDOW_VALUE + BYTES_PER_INDEXED_WINDOW)
+                       + positions_size)
+        return int(peak_memory * MEMORY_SAFETY_FACTOR)
+
+    def run(self, window_sizes: Iterable[int], build_func: Callable[[int], T]) -> Dict[int, T]:
+        """
+        Runs the builds within the memory budget
+        Args:
+            window_sizes: window sizes to build
+            build_func: builds (or loads, updates) the search tree of a window size, it is called from worker threads
+
+        Returns:
+            results of the build_func for every window size
+        """
+
+        window_sizes = list(window_sizes)
+        # The largest builds are started first, so the smaller ones can fill the remaining budget
+        estimates = {w: self.estimate_peak_memory(w) for w in window_sizes}
+        pending = sorted(estimates, key=lambda w: estimates[w], reverse=True)
+
+        results = {}
+        errors = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            running = {}
+            used_memory = 0
+            while pending or running:
+                # A build which is larger than the whole budget is started only when nothing else is running
+                startable = [w for w in pending if used_memory + estimates[w] <= self.memory_budget]
+                if (not running) and pending and (not startable):
+                    print(f"Search tree with size {pending[0]} needs more memory ({estimates[pending[0]]} bytes) "
+                          f"than the budget ({self.memory_budget} bytes), it is built alone")
+                    startable = [pending[0]]
+                for w in startable[:self.max_workers - len(running)]:
+                    if (used_memory + estimates[w] > self.memory_budget) and running:
+                        continue
+                    pending.remove(w)
+                    running[pool.submit(build_func, w)] = w
+                    used_memory += estimates[w]
+
+                done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for f in done:
+                    w = running.pop(f)
+                    used_memory -= estimates[w]
+                    try:
+                        results[w] = f.result()
+                        print(f"Search tree with size {w} prepared")
+                    except Exception as e:
+                        print(f"There was a problem with size {w}, could not create it: {e}")
+                        errors[w] = e
+
+        if errors:
+            # Builds are not retried, the caller decides what to do (e.g. the previous search trees are kept)
+            raise next(iter(errors.values()))
+        return {w: results[w] for w in window_sizes}
@@ -1,48 +1,196 @@
-import concurrent.futures
-import pickle
+import json
+import os
+import shutil
+import time
 from datetime import datetime
 from pathlib import Path
-from typing import Tuple
+from typing import Dict, List, Optional, Tuple
 
 import numpy as np
-import pandas as pd
-import yfinance
-from tqdm import tqdm
+
+from .data_sources import DataSource, YahooDataSource
+
+# Arrays of the data holder which are stored as separate .npy files
+ARRAY_NAMES = ("values", "dates", "offsets")
+# Column of the values array, the other (extra) columns are stored in separate files, and they are loaded lazily
+VALUE_COLUMN = "Close"
+MANIFEST_FILE_NAME = "manifest.json"
+# Layout of the arrays, serialized data holders with a different layout can not be loaded
+LAYOUT = "csr"
+
+
+def to_day_numbers(dates: np.ndarray) -> np.ndarray:
+    """
+    Args:
+        dates: datetime64 dates (of any unit) or day numbers
+
+    Returns:
+        day numbers (days since 1970-01-01) as int32
+    """
+
+    return np.asarray(dates).astype("datetime64[D]").astype(np.int32)
+
+
+def _get_column_file_name(column: str) -> str:
+    return f"column_{column.lower()}.npy"
+
+
+def concatenate_ranges(starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """
+    Same as np.concatenate([np.arange(start, start + length) for start, length in zip(starts, lengths)]), but without
+    the python loop
+    """
+
+    starts = np.asarray(starts, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    range_offsets = np.concatenate([[0], np.cumsum(lengths)])
+    return np.repeat(starts - range_offsets[:-1], lengths) + np.arange(range_offsets[-1])
+
+
+class DateStringTable:
+    """
+    Formatted ("%Y-%m-%d") strings of every day between the first and the last date of a data holder, so the dates (of
+    any shape) are formatted with a single lookup instead of formatting them one by one
+    """
+
+    def __init__(self, data_holder: "RawStockDataHolder"):
+        dates = np.asarray(data_holder.dates)
+        first_day, last_day = (int(dates.min()), int(dates.max())) if len(dates) > 0 else (0, 0)
+        self._first_day = first_day
+        self._strings = np.datetime_as_string(np.arange(first_day, last_day + 1).astype("datetime64[D]"), unit="D")
+
+    def to_str(self, dates: np.ndarray) -> np.ndarray:
+        """
+        Args:
+            dates: dates of the data holder (as day numbers)
+
+        Returns:
+            date strings with the same shape
+        """
+
+        days = np.asarray(dates).astype(np.int64) - self._first_day
+        return self._strings[np.clip(days, 0, len(self._strings) - 1)]
 
 
 class RawStockDataHolder:
-    def __init__(self, ticker_symbols: list, period_years: int = 5, interval: int = 1):
+    def __init__(self,
+                 ticker_symbols: list,
+                 period_years: int = 5,
+                 interval: int = 1,
+                 data_source: Optional[DataSource] = None):
         self.ticker_symbols = ticker_symbols
         self.period_years = period_years
         self.interval = interval
+        # Source of the fills and updates, Yahoo Finance by default
+        self.data_source = data_source if data_source is not None else YahooDataSource()
 
-        max_values_per_stock = self.period_years * self.interval * 365
-        nb_ticker_symbols = len(self.ticker_symbols)
-
-        self.dates = np.zeros((nb_ticker_symbols, max_values_per_stock))
-        self.values = np.zeros((nb_ticker_symbols, max_values_per_stock), dtype=np.float32)
-        self.nb_of_valid_values = np.zeros(nb_ticker_symbols, dtype=np.int32)
+        # Ragged (CSR) layout: the values of the symbols are concatenated, and the values of a label are
+        # values[offsets[label]:offsets[label + 1]], with the most recent value first. Dates are day numbers (days
+        # since 1970-01-01), so they fit to int32
+        self.values = np.zeros(0, dtype=np.float32)
+        self.dates = np.zeros(0, dtype=np.int32)
+        self.offsets = np.zeros(len(self.ticker_symbols) + 1, dtype=np.int64)
+        self.nb_of_valid_values = np.zeros(len(self.ticker_symbols), dtype=np.int32)
+        # Extra columns (e.g. Open, Volume) with the same layout as the values (float32, NaN if missing). Only the
+        # columns which are used are loaded (see get_column), so the Close only serving does not touch them
+        self.extra_column_names: List[str] = []
+        self._extra_columns: Dict[str, np.ndarray] = {}
+        self._mmap_mode: Optional[str] = None
 
         self.symbol_to_label = {symbol: label for label, symbol in enumerate(ticker_symbols)}
         self.label_to_symbol = {label: symbol for symbol, label in self.symbol_to_label.items()}
 
         self.is_filled = False
+        # Time of the (full) fill, this is kept by the incremental updates, so it identifies the layout of the arrays
+        self.filled_at = None
+        # Folder of the serialized data holder (set by serialize and load)
+        self.file_path = None
+        # Errors of the symbols which failed at the last fill or update (symbol -> error message). The failed symbols
+        # of a fill do not have values, so there are no windows for them
+        self.fetch_errors: Dict[str, str] = {}
+        # Most recent stored values which were overwritten by the last update (label -> day number of the value), e.g.
+        # a close which was stored before the end of the session. The windows with these values are re-indexed (see
+        # SearchModel.add_new_windows)
+        self.revised_bars: Dict[int, int] = {}
+        # Seconds of the download of the last fill or update, None if the data holder was only loaded
+        self.download_time: Optional[float] = None
+
+    def set_data(self,
+                 data: Dict[str, Tuple[np.ndarray, np.ndarray]],
+                 columns: Optional[Dict[str, Dict[str, np.ndarray]]] = None):
+        """
+        Replaces the values of the data holder
+        Args:
+            data: symbol -> (values, dates), with the most recent value first. Dates are datetime64 values or day
+                numbers. The missing symbols do not have values
+            columns: symbol -> column name -> values of the extra columns, in the same order as the data. The missing
+                columns of a symbol are NaNs
+
+        Returns:
+            None
+        """
+
+        columns = columns or {}
+
+        nb_of_valid_values = np.zeros(len(self.ticker_symbols), dtype=np.int32)
+        for symbol, (values, _) in data.items():
+            nb_of_valid_values[self.symbol_to_label[symbol]] = len(values)
+        offsets = np.concatenate([[0], np.cumsum(nb_of_valid_values, dtype=np.int64)])
 
-    def _download_stock_data(self, symbol: str) -> pd.DataFrame:
-        ticker = yfinance.Ticker(symbol)
-        period_str = f"{self.period_years}y"
-        interval_str = f"{self.interval}d"
-        ticker_df = ticker.history(period=period_str, interval=interval_str, rounding=True)[::-1]
-        if ticker_df.empty or len(ticker_df) == 0:
-            raise ValueError(f"{symbol} does not have enough data")
-        return ticker_df
-
-    def _get_stock_data_for_symbol(self, symbol: str) -> Tuple[np.ndarray, np.ndarray, int]:
-        ticker_df = self._download_stock_data(symbol=symbol)
-        close_values = ticker_df["Close"].values
-        dates = ticker_df.index.values
-        label = self.symbol_to_label[symbol]
-        return close_values, dates, label
+        all_values = np.zeros(offsets[-1], dtype=np.float32)
+        all_dates = np.zeros(offsets[-1], dtype=np.int32)
+        for symbol, (values, dates) in data.items():
+            label = self.symbol_to_label[symbol]
+            all_values[offsets[label]:offsets[label + 1]] = values
+            all_dates[offsets[label]:offsets[label + 1]] = to_day_numbers(dates)
+
+        extra_column_names = list(dict.fromkeys(x for symbol_columns in columns.values() for x in symbol_columns))
+        extra_columns = {x: np.full(offsets[-1], np.nan, dtype=np.float32) for x in extra_column_names}
+        for symbol, symbol_columns in columns.items():
+            label = self.symbol_to_label[symbol]
+            for column, column_values in symbol_columns.items():
+                extra_columns[column][offsets[label]:offsets[label + 1]] = column_values
+
+        self.values = all_values
+        self.dates = all_dates
+        self.offsets = offsets
+        self.nb_of_valid_values = nb_of_valid_values
+        self.extra_column_names = extra_column_names
+        self._extra_columns = extra_columns
+
+    def get_column_names(self) -> List[str]:
+        """
+        Returns:
+            names of the available columns (the value column first)
+        """
+
+        return [VALUE_COLUMN] + self.extra_column_names
+
+    def get_column(self, column: str = VALUE_COLUMN) -> np.ndarray:
+        """
+        Values of a column, with the same layout as the values array. The extra columns of a loaded data holder are
+        loaded (memory mapped) at their first use
+        Args:
+            column: name of the column
+
+        Returns:
+            values of the column
+        """
+
+        if column == VALUE_COLUMN:
+            return self.values
+        if column not in self.extra_column_names:
+            raise ValueError(f"There is no {column} column, available columns: {self.get_column_names()}")
+        if column not in self._extra_columns:
+            column_values = np.load(Path(self.file_path) / _get_column_file_name(column), mmap_mode=self._mmap_mode)
+            self._extra_columns.setdefault(column, column_values)
+        return self._extra_columns[column]
+
+    def get_row_values(self, label: int, column: str = VALUE_COLUMN) -> np.ndarray:
+        return self.get_column(column)[self.offsets[label]:self.offsets[label + 1]]
+
+    def get_row_dates(self, label: int) -> np.ndarray:
+        return self.dates[self.offsets[label]:self.offsets[label + 1]]
 
     def fill(self):
         """
@@ -51,61 +199,364 @@ class RawStockDataHolder:
             None
         """
 
-        pbar = tqdm(desc="Symbol data download", total=len(self.ticker_symbols))
+        start_time = time.perf_counter()
+        result = self.data_source.fetch(self.ticker_symbols, period_years=self.period_years, interval=self.interval,
+                                        progress_desc="Symbol data download")
+        self.download_time = time.perf_counter() - start_time
+        self.set_data(result.data, result.columns)
+        self._set_fetch_errors(result.errors)
+        self.revised_bars = {}
+        self.is_filled = True
+        self.filled_at = datetime.now().isoformat()
 
-        with concurrent.futures.ThreadPoolExecutor() as pool:
-            future_to_symbol = {}
-            for symbol in self.ticker_symbols:
-                future = pool.submit(self._get_stock_data_for_symbol, symbol=symbol)
-                future_to_symbol[future] = symbol
+    def _set_fetch_errors(self, errors: Dict[str, str]):
+        self.fetch_errors = dict(sorted(errors.items()))
+        for symbol, error in self.fetch_errors.items():
+            print(f"ERROR with {symbol}: {error}")
 
-            for future in concurrent.futures.as_completed(future_to_symbol):
-                completed_symbol = future_to_symbol[future]
-                try:
-                    close_values, dates, label = future.result()
-                    self.values[label, :len(close_values)] = close_values
-                    self.dates[label, :len(dates)] = dates
-                    self.nb_of_valid_values[label] = len(dates)
-                except ValueError as e:
-                    print(f"ERROR with {completed_symbol}: {e}")
-                    continue
+    def get_available_symbols(self) -> List[str]:
+        """
+        Returns:
+            symbols with values (the ones which did not fail)
+        """
 
-                pbar.update(1)
-        self.is_filled = True
-        pbar.close()
+        nb_of_valid_values = np.asarray(self.nb_of_valid_values)
+        return [x for x in self.ticker_symbols if nb_of_valid_values[self.symbol_to_label[x]] > 0]
+
+    def update(self) -> np.ndarray:
+        """
+        Incremental update of a filled data holder: only the values from the date of the most recent stored value are
+        downloaded for every symbol, and the newer ones are inserted to the beginning of the rows (as the most recent
+        values are the first ones). The most recent stored value is overwritten if it changed (e.g. it was stored
+        before the end of the session), these are listed in revised_bars. The symbols which fail keep their values
+        Returns:
+            number of new values for every label
+        """
+
+        if not self.is_filled:
+            raise ValueError("You need to fill the class with data first")
+
+        starts = {}
+        for symbol in self.ticker_symbols:
+            label = self.symbol_to_label[symbol]
+            if self.nb_of_valid_values[label] > 0:
+                starts[symbol] = str(np.datetime64(int(self.dates[self.offsets[label]]), "D"))
+        start_time = time.perf_counter()
+        result = self.data_source.fetch(self.ticker_symbols, period_years=self.period_years, interval=self.interval,
+                                        starts=starts, progress_desc="Symbol data update")
+        self.download_time = time.perf_counter() - start_time
+
+        # The extra columns of the data source are kept, the missing old values of a new column are NaNs
+        extra_column_names = list(self.data_source.extra_columns)
+        nb_of_new_values = np.zeros(len(self.ticker_symbols), dtype=np.int32)
+        revised_bars = {}
+        data = {}
+        columns = {}
+        for symbol in self.ticker_symbols:
+            label = self.symbol_to_label[symbol]
+            values = self.get_row_values(label)
+            dates = self.get_row_dates(label)
+            symbol_columns = {x: (self.get_row_values(label, x) if x in self.extra_column_names
+                                  else np.full(len(values), np.nan, dtype=np.float32))
+                              for x in extra_column_names}
+            if symbol in result.data:
+                new_values, new_dates = result.data[symbol]
+                new_dates = to_day_numbers(new_dates)
+                is_new = (new_dates > dates[0]) if len(dates) > 0 else np.ones(len(new_dates), dtype=bool)
+                nb_of_new_values[label] = np.count_nonzero(is_new)
+                # The new values are placed at the beginning of the row
+                values = np.concatenate([new_values[is_new].astype(np.float32), values])
+                dates = np.concatenate([new_dates[is_new], dates])
+                new_columns = result.columns.get(symbol, {})
+                symbol_columns = {x: np.concatenate([new_columns[x][is_new] if x in new_columns
+                                                     else np.full(nb_of_new_values[label], np.nan, dtype=np.float32),
+                                                     column_values])
+                                  for x, column_values in symbol_columns.items()}
+
+                # The new download of the most recent stored value overwrites it
+                position = nb_of_new_values[label]
+                revised_ids = np.flatnonzero(new_dates == dates[position]) if len(dates) > position else []
+                if len(revised_ids) > 0:
+                    revised_values = {x: new_columns[x][revised_ids[0]] for x in symbol_columns if x in new_columns}
+                    revised_values[VALUE_COLUMN] = new_values[revised_ids[0]]
+                    stored_values = {x: symbol_columns[x] for x in revised_values if x != VALUE_COLUMN}
+                    stored_values[VALUE_COLUMN] = values
+                    if any(not np.array_equal(np.float32(value), stored_values[x][position], equal_nan=True)
+                           for x, value in revised_values.items()):
+                        for x, value in revised_values.items():
+                            stored_values[x][position] = value
+                        revised_bars[label] = int(dates[position])
+            data[symbol] = (values, dates)
+            columns[symbol] = symbol_columns
+
+        self.set_data(data, columns)
+        self._set_fetch_errors(result.errors)
+        self.revised_bars = revised_bars
+        return nb_of_new_values
+
+    def _get_window_slice(self, start_index: int, window_size: int, future_length: int) -> slice:
+        # The most recent values are the first ones, so the "future" of a window is before it
+        return slice(max(start_index - future_length, 0), start_index + window_size)
+
+    def get_window_values(self, label: int, start_index: int, window_size: int, future_length: int = 0,
+                          column: str = VALUE_COLUMN) -> np.ndarray:
+        return self.get_row_values(label, column)[self._get_window_slice(start_index, window_size, future_length)]
+
+    def get_window_dates(self, label: int, start_index: int, window_size: int, future_length: int = 0) -> np.ndarray:
+        return self.get_row_dates(label)[self._get_window_slice(start_index, window_size, future_length)]
+
+    def get_windows_values(self,
+                           labels: np.ndarray,
+                           start_indices: np.ndarray,
+                           window_size: int,
+                           future_length: int = 0,
+                           column: str = VALUE_COLUMN) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Vectorized version of get_window_values (a single fancy indexing for all the windows)
+        Args:
+            labels: labels of the windows
+            start_indices: start indices of the windows
+            window_size: size of the windows
+            future_length: number of future values before the windows
+            column: the values of this column are returned
+
+        Returns:
+            tuple: values [n_windows, future_length + window_size] (the missing future values of the windows close to
+            the most recent value are padded with 0 at the beginning, and the values after the oldest value with 0 at
+            the end), number of future values of the windows. The lengths are limited by the values which exist, so
+            there are at most max(start_indices) future values and at most max(nb_of_valid_values) window values
+        """
+
+        labels = np.asarray(labels, dtype=np.int64)
+        start_indices = np.asarray(start_indices, dtype=np.int64)
+        # The lengths come from the requests, the columns which could only be padding are not created
+        future_length = min(future_length, int(start_indices.max(initial=0)))
+        window_size = min(window_size, int(self.nb_of_valid_values.max(initial=0)))
+        value_indices = start_indices[:, None] + np.arange(-future_length, window_size)
+        is_value = (value_indices >= 0) & (value_indices < self.nb_of_valid_values[labels][:, None])
+        values = np.zeros(value_indices.shape, dtype=np.float32)
+        values[is_value] = self.get_column(column)[(self.offsets[labels][:, None] + value_indices)[is_value]]
+        return values, np.minimum(start_indices, future_length)
+
+    def get_most_recent_values(self, labels: np.ndarray, window_size: int, column: str = VALUE_COLUMN) -> np.ndarray:
+        """
+        Returns:
+            the most recent values of the labels [n_labels, window_size] (padded with 0 if there are not enough values)
+        """
+
+        labels = np.asarray(labels, dtype=np.int64)
+        values, _ = self.get_windows_values(labels, np.zeros(len(labels), dtype=np.int64), window_size,
+                                            column=column)
+        return values
+
+    def get_padded_values(self, labels: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Dense copy of the rows
+        Args:
+            labels: labels of the rows, all of them if None
+
+        Returns:
+            values [n_labels, max number of values of the labels], the rows are padded with 0 at the end
+        """
+
+        labels = np.arange(len(self.ticker_symbols)) if labels is None else np.asarray(labels, dtype=np.int64)
+        nb_of_valid_values = self.nb_of_valid_values[labels]
+        values = np.zeros((len(labels), int(nb_of_valid_values.max(initial=0))), dtype=np.float32)
+        is_value = np.arange(values.shape[1])[None, :] < nb_of_valid_values[:, None]
+        values[is_value] = self.values[concatenate_ranges(self.offsets[labels], nb_of_valid_values)]
+        return values
+
+    def get_windows_start_end_dates(self,
+                                    labels: np.ndarray,
+                                    start_indices: np.ndarray,
+                                    window_size: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Vectorized start and end dates (day numbers) of the windows (the start date is the most recent one, as in
+        get_window_dates)
+        """
+
+        start_positions = self.offsets[np.asarray(labels, dtype=np.int64)] + np.asarray(start_indices, dtype=np.int64)
+        return self.dates[start_positions], self.dates[start_positions + window_size - 1]
 
     def create_filename_for_today(self) -> str:
         current_date = datetime.now().strftime("%Y_%m_%d")
-        file_name = f"data_holder_{self.period_years}y_{self.interval}d_{current_date}.pk"
+        file_name = f"data_holder_{self.period_years}y_{self.interval}d_{current_date}"
         return file_name
 
+    def create_file_pattern(self) -> str:
+        return f"data_holder_{self.period_years}y_{self.interval}d_*"
+
     def serialize(self) -> str:
+        """
+        Saves the data holder as a folder of raw .npy arrays (one for every array) and a small json manifest,
+        so it can be memory mapped when it is loaded
+        Returns:
+            path of the created folder
+        """
+
         if not self.is_filled:
             raise ValueError("You need to fill the class with data first")
 
-        file_name = self.create_filename_for_today()
-        with open(file_name, "wb") as f:
-            pickle.dump(self, f)
+        folder_path = Path(self.create_filename_for_today())
+        # Everything is written to a temporary folder first, so other processes never see a half-written data holder
+        tmp_folder_path = folder_path.with_name(f"{folder_path.name}.tmp{os.getpid()}")
+        tmp_folder_path.mkdir()
 
-        return file_name
+        for array_name in ARRAY_NAMES:
+            np.save(tmp_folder_path / f"{array_name}.npy", getattr(self, array_name))
+        for column in self.extra_column_names:
+            np.save(tmp_folder_path / _get_column_file_name(column), self.get_column(column))
+
+        manifest = {"ticker_symbols": self.ticker_symbols,
+                    "labels": [self.symbol_to_label[x] for x in self.ticker_symbols],
+                    "period_years": self.period_years,
+                    "interval": self.interval,
+                    "filled_at": self.filled_at,
+                    "fetch_errors": self.fetch_errors,
+                    "extra_column_names": self.extra_column_names,
+                    "revised_bars": self.revised_bars,
+                    "layout": LAYOUT}
+        (tmp_folder_path / MANIFEST_FILE_NAME).write_text(json.dumps(manifest))
+
+        if folder_path.exists():
+            shutil.rmtree(folder_path)
+        tmp_folder_path.rename(folder_path)
+
+        self.file_path = str(folder_path)
+        return str(folder_path)
 
     @staticmethod
-    def load(file_name: str) -> "RawStockDataHolder":
-        with open(file_name, "rb") as f:
-            obj = pickle.load(f)
+    def load(file_name: str,
+             mmap_mode: Optional[str] = "r",
+             data_source: Optional[DataSource] = None) -> "RawStockDataHolder":
+        """
+        Loads a serialized data holder
+        Args:
+            file_name: folder created with the serialize method
+            mmap_mode: numpy memory map mode for the arrays. With the default read-only mode the page cache is shared
+                       between the processes which are using the same data holder. Use None to load to the memory
+            data_source: source of the updates, Yahoo Finance if None
+
+        Returns:
+            the loaded data holder
+        """
+
+        folder_path = Path(file_name)
+        manifest = json.loads((folder_path / MANIFEST_FILE_NAME).read_text())
+        if manifest.get("layout") != LAYOUT:
+            raise ValueError("The data holder was serialized with a different layout")
+
+        obj = RawStockDataHolder(ticker_symbols=manifest["ticker_symbols"],
+                                 period_years=manifest["period_years"],
+                                 interval=manifest["interval"],
+                                 data_source=data_source)
+        obj.symbol_to_label = dict(zip(manifest["ticker_symbols"], manifest["labels"]))
+        obj.label_to_symbol = {label: symbol for symbol, label in obj.symbol_to_label.items()}
+
+        for array_name in ARRAY_NAMES:
+            setattr(obj, array_name, np.load(folder_path / f"{array_name}.npy", mmap_mode=mmap_mode))
+        obj.nb_of_valid_values = np.diff(obj.offsets).astype(np.int32)
+        # The extra columns are loaded only when they are used
+        obj.extra_column_names = manifest.get("extra_column_names", [])
+        obj._mmap_mode = mmap_mode
+
+        obj.is_filled = True
+        obj.filled_at = manifest.get("filled_at")
+        obj.fetch_errors = manifest.get("fetch_errors", {})
+        # The keys of json objects are strings
+        obj.revised_bars = {int(label): day for label, day in manifest.get("revised_bars", {}).items()}
+        obj.file_path = str(folder_path)
         return obj
 
 
-def initialize_data_holder(tickers: list, period_years: int, force_update: bool = False):
+def _check_extra_columns(data_holder: RawStockDataHolder):
+    # Data holders without some columns of the data source (e.g. serialized before those were fetched) are downloaded
+    # again, so the new columns have the whole history
+    missing_columns = set(data_holder.data_source.extra_columns) - set(data_holder.extra_column_names)
+    if len(missing_columns) > 0:
+        raise ValueError(f"the {sorted(missing_columns)} columns are missing")
+
+
+def initialize_data_holder(tickers: list,
+                           period_years: int,
+                           force_update: bool = False,
+                           data_source: Optional[DataSource] = None):
     data_holder = RawStockDataHolder(ticker_symbols=tickers,
                                      period_years=period_years,
-                                     interval=1)
+                                     interval=1,
+                                     data_source=data_source)
 
     file_path = Path(data_holder.create_filename_for_today())
 
-    if (not file_path.exists()) or force_update:
-        data_holder.fill()
-        data_holder.serialize()
-    else:
-        data_holder = RawStockDataHolder.load(str(file_path))
-    return data_holder
+    if file_path.exists() and (not force_update):
+        try:
+            loaded_data_holder = RawStockDataHolder.load(str(file_path), data_source=data_source)
+            _check_extra_columns(loaded_data_holder)
+            return loaded_data_holder
+        except ValueError as e:
+            print(f"Data holder can not be loaded, it is created again: {e}")
+
+    data_holder.fill()
+    data_holder.serialize()
+
+    # Even after a fresh download we load it back as memory mapped arrays, so the memory can be shared between workers
+    loaded_data_holder = RawStockDataHolder.load(str(file_path), data_source=data_source)
+    loaded_data_holder.download_time = data_holder.download_time
+    return loaded_data_holder
+
+
+def find_latest_serialized(file_pattern: str, folder_path: str = ".") -> Optional[Path]:
+    """
+    Finds the most recent serialized object (data holder or search model), as the file names end with the date
+    Args:
+        file_pattern: glob pattern for the file names (e.g. "data_holder_20y_1d_*")
+        folder_path: folder to search in
+
+    Returns:
+        path of the most recent one or None if there is nothing serialized
+    """
+
+    # Temporary folders (which are still being written) are not considered
+    paths = [p for p in Path(folder_path).glob(file_pattern) if ".tmp" not in p.name]
+    if len(paths) == 0:
+        return None
+    return max(paths, key=lambda p: p.name)
+
+
+def update_data_holder(tickers: list,
+                       period_years: int,
+                       data_source: Optional[DataSource] = None) -> Tuple[RawStockDataHolder, np.ndarray]:
+    """
+    Incremental version of initialize_data_holder: the most recent serialized data holder is extended with the new
+    values and serialized for today. If there is nothing to start from (or the symbols changed), then all the data is
+    downloaded
+    Args:
+        tickers: ticker symbols
+        period_years: period of the data in years
+        data_source: source of the data, Yahoo Finance if None
+
+    Returns:
+        the (memory mapped) data holder and the number of new values for every label
+    """
+
+    data_holder = RawStockDataHolder(ticker_symbols=tickers, period_years=period_years, interval=1,
+                                     data_source=data_source)
+    latest_file_path = find_latest_serialized(data_holder.create_file_pattern())
+
+    if latest_file_path is not None:
+        try:
+            data_holder = RawStockDataHolder.load(str(latest_file_path), data_source=data_source)
+            if data_holder.ticker_symbols != list(tickers):
+                raise ValueError("the symbols changed")
+            _check_extra_columns(data_holder)
+            nb_of_new_values = data_holder.update()
+            file_path = data_holder.serialize()
+            loaded_data_holder = RawStockDataHolder.load(file_path, data_source=data_source)
+            loaded_data_holder.download_time = data_holder.download_time
+            return loaded_data_holder, nb_of_new_values
+        except ValueError as e:
+            print(f"Incremental update is not possible: {e}")
+
+    data_holder = initialize_data_holder(tickers=tickers, period_years=period_years, force_update=True,
+                                         data_source=data_source)
+    return data_holder, data_holder.nb_of_valid_values.copy()
@@ -0,0 +1,302 @@
+import concurrent.futures
+from pathlib import Path
+import threading
+import time
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+import yfinance
+from tqdm import tqdm
+
+# File types of the local data source, in the order of preference
+LOCAL_FILE_SUFFIXES = (".parquet", ".csv")
+# Columns of the daily price data
+OHLCV_COLUMNS = ("Open", "High", "Low", "Close", "Volume")
+
+
+class FetchResult:
+    """
+    Result of a fetch: the data of the successful symbols and the error of the failed ones
+    """
+
+    def __init__(self):
+        # symbol -> (close values, dates as datetime64[ns]), both with the most recent value first
+        self.data: Dict[str, Tuple[np.ndarray, np.ndarray]] = {}
+        # symbol -> column name -> values of the extra columns (e.g. Volume), in the same order as the data
+        self.columns: Dict[str, Dict[str, np.ndarray]] = {}
+        # symbol -> error message of the last attempt
+        self.errors: Dict[str, str] = {}
+        # symbol -> number of attempts
+        self.nb_attempts: Dict[str, int] = {}
+
+
+def _get_error_message(e: Exception) -> str:
+    # Only the first line, some errors (e.g. of pyarrow) contain the whole schema
+    lines = str(e).strip().splitlines()
+    return f"{type(e).__name__}: {lines[0] if lines else ''}"
+
+
+def _to_arrays(df: pd.DataFrame, value_column: str,
+               extra_columns: Sequence[str]) -> Tuple[np.ndarray, np.ndarray, Dict[str, np.ndarray]]:
+    # Only the value column is required, the missing values of the extra columns (or missing columns) are NaNs
+    df = df.dropna(subset=[value_column])
+    df = df[~df.index.isna()].sort_index(ascending=False)
+    columns = {x: (df[x].values.astype(np.float32) if x in df.columns else np.full(len(df), np.nan, dtype=np.float32))
+               for x in extra_columns}
+    return df[value_column].values, df.index.values.astype("datetime64[ns]"), columns
+
+
+class DataSource:
+    """
+    Base class of the data sources. A fetch splits the symbols into batches (a batch is a single call of the source),
+    the batches are fetched with bounded concurrency (and optionally with a limited request rate), and the failed
+    symbols are retried with exponential backoff. The symbols which fail after all the retries are reported in the
+    result, so they can be excluded instead of being stored as empty rows.
+
+    Subclasses implement the _fetch_batch method
+    """
+
+    def __init__(self,
+                 batch_size: int = 1,
+                 max_workers: int = 8,
+                 nb_retries: int = 0,
+                 backoff_factor: float = 0.5,
+                 max_requests_per_second: Optional[float] = None,
+                 value_column: str = "Close",
+                 extra_columns: Sequence[str] = ()):
+        """
+        Args:
+            batch_size: maximum number of symbols in a single call of the source
+            max_workers: maximum number of concurrent calls
+            nb_retries: the failed symbols are retried this many times
+            backoff_factor: the n-th retry waits backoff_factor * 2^(n-1) seconds
+            max_requests_per_second: rate limit of the calls, not limited if None
+            value_column: the values of this column are stored
+            extra_columns: the values of these columns are fetched too (see FetchResult.columns)
+        """
+
+        self.batch_size = batch_size
+        self.max_workers = max_workers
+        self.nb_retries = nb_retries
+        self.backoff_factor = backoff_factor
+        self.max_requests_per_second = max_requests_per_second
+        self.value_column = value_column
+        self.extra_columns = tuple(extra_columns)
+
+        self._rate_limit_lock = threading.Lock()
+        self._next_request_time = 0.0
+
+    def _fetch_batch(self, symbols: List[str], period_years: int, interval: int,
+                     start: Optional[str]) -> Dict[str, pd.DataFrame]:
+        """
+        Fetches the data of a batch of symbols
+        Args:
+            symbols: symbols of the batch
+            period_years: period of the data in years (used if start is None)
+            interval: interval of the values in days
+            start: only the values from this date ("%Y-%m-%d") are fetched
+
+        Returns:
+            symbol -> dataframe with a date index and the value column. The missing symbols are failed
+        """
+
+        raise NotImplementedError()
+
+    def _wait_for_rate_limit(self):
+        if self.max_requests_per_second is None:
+            return
+        with self._rate_limit_lock:
+            now = time.monotonic()
+            wait_time = self._next_request_time - now
+            self._next_request_time = max(now, self._next_request_time) + 1 / self.max_requests_per_second
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+    def _fetch_batch_with_retries(self, symbols: List[str], period_years: int, interval: int, start: Optional[str],
+                                  result: FetchResult, result_lock: threading.Lock) -> List[str]:
+        remaining_symbols = list(symbols)
+        for attempt in range(self.nb_retries + 1):
+            if attempt > 0:
+                time.sleep(self.backoff_factor * 2 ** (attempt - 1))
+            self._wait_for_rate_limit()
+
+            errors = {}
+            data = {}
+            columns = {}
+            try:
+                batch_data = self._fetch_batch(remaining_symbols, period_years=period_years, interval=interval,
+                                               start=start)
+            except Exception as e:
+                batch_data = {}
+                errors = {symbol: _get_error_message(e) for symbol in remaining_symbols}
+
+            for symbol in remaining_symbols:
+                if symbol in errors:
+                    continue
+                df = batch_data.get(symbol)
+                try:
+                    close_values, dates, symbol_columns = (_to_arrays(df, self.value_column, self.extra_columns)
+                                                           if df is not None else ([], [], {}))
+                except (KeyError, TypeError, ValueError) as e:
+                    errors[symbol] = f"Invalid data, {_get_error_message(e)}"
+                    continue
+                if len(dates) == 0:
+                    errors[symbol] = "No data"
+                else:
+                    data[symbol] = (close_values, dates)
+                    columns[symbol] = symbol_columns
+
+            with result_lock:
+                for symbol in remaining_symbols:
+                    result.nb_attempts[symbol] = attempt + 1
+                result.data.update(data)
+                result.columns.update(columns)
+                result.errors.update(errors)
+                for symbol in data:
+                    result.errors.pop(symbol, None)
+
+            remaining_symbols = [x for x in remaining_symbols if x in errors]
+            if len(remaining_symbols) == 0:
+                break
+        return symbols
+
+    def fetch(self,
+              symbols: List[str],
+              period_years: int,
+              interval: int = 1,
+              starts: Optional[Dict[str, Optional[str]]] = None,
+              progress_desc: Optional[str] = None) -> FetchResult:
+        """
+        Fetches the data of the symbols
+        Args:
+            symbols: symbols to fetch
+            period_years: period of the data in years (for the symbols without a start date)
+            interval: interval of the values in days
+            starts: symbol -> start date ("%Y-%m-%d"), only the values from this date are fetched (e.g. for an
+                incremental update). Symbols which are not in it are fetched for the whole period
+            progress_desc: description of the progress bar, there is no progress bar if None
+
+        Returns:
+            data and errors of the symbols
+        """
+
+        starts = starts or {}
+        # Symbols are batched only with the same start date
+        start_to_symbols = {}
+        for symbol in symbols:
+            start_to_symbols.setdefault(starts.get(symbol), []).append(symbol)
+
+        result = FetchResult()
+        result_lock = threading.Lock()
+        pbar = tqdm(desc=progress_desc, total=len(symbols)) if progress_desc is not None else None
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = []
+            for start, start_symbols in start_to_symbols.items():
+                for batch_start in range(0, len(start_symbols), self.batch_size):
+                    batch = start_symbols[batch_start:batch_start + self.batch_size]
+                    futures.append(pool.submit(self._fetch_batch_with_retries, batch, period_years, interval, start,
+                                               result, result_lock))
+
+            for future in concurrent.futures.as_completed(futures):
+                batch = future.result()
+                if pbar is not None:
+                    pbar.update(len(batch))
+
+        if pbar is not None:
+            pbar.close()
+        return result
+
+
+class YahooDataSource(DataSource):
+    """
+    Yahoo Finance (with yfinance), multiple symbols are downloaded with a single call. The defaults are conservative,
+    as Yahoo throttles (and fails) the too frequent requests. Every OHLCV column is fetched by default
+    """
+
+    def __init__(self,
+                 batch_size: int = 50,
+                 max_workers: int = 4,
+                 nb_retries: int = 3,
+                 backoff_factor: float = 1.0,
+                 max_requests_per_second: Optional[float] = 2.0,
+                 extra_columns: Sequence[str] = ("Open", "High", "Low", "Volume")):
+        super().__init__(batch_size=batch_size,
+                         max_workers=max_workers,
+                         nb_retries=nb_retries,
+                         backoff_factor=backoff_factor,
+                         max_requests_per_second=max_requests_per_second,
+                         extra_columns=extra_columns)
+
+    def _fetch_batch(self, symbols: List[str], period_years: int, interval: int,
+                     start: Optional[str]) -> Dict[str, pd.DataFrame]:
+        period_kwargs = {"period": f"{period_years}y"} if start is None else {"start": start}
+        df = yfinance.download(symbols,
+                               interval=f"{interval}d",
+                               group_by="ticker",
+                               auto_adjust=True,
+                               rounding=True,
+                               threads=False,
+                               progress=False,
+                               **period_kwargs)
+        if (df is None) or df.empty:
+            return {}
+        if not isinstance(df.columns, pd.MultiIndex):
+            # Older yfinance versions do not group a single symbol
+            return {symbols[0]: df} if len(symbols) == 1 else {}
+
+        available_symbols = set(df.columns.get_level_values(0))
+        return {symbol: df[symbol] for symbol in symbols if symbol in available_symbols}
+
+
+class LocalFileDataSource(DataSource):
+    """
+    Local folder of files (e.g. vendor dumps), one file for every symbol: <symbol>.parquet or <symbol>.csv with a date
+    column and the value column. The period is counted back from the most recent value of a file (not from today),
+    so old dumps can be used too. The extra columns are optional, the missing ones are NaNs
+    """
+
+    def __init__(self,
+                 folder_path: str,
+                 date_column: str = "Date",
+                 value_column: str = "Close",
+                 max_workers: int = 8,
+                 extra_columns: Sequence[str] = ("Open", "High", "Low", "Volume")):
+        super().__init__(batch_size=1, max_workers=max_workers, nb_retries=0, value_column=value_column,
+                         extra_columns=extra_columns)
+        self.folder_path = Path(folder_path)
+        self.date_column = date_column
+
+    def _get_file_path(self, symbol: str) -> Optional[Path]:
+        for suffix in LOCAL_FILE_SUFFIXES:
+            file_path = self.folder_path / f"{symbol}{suffix}"
+            if file_path.exists():
+                return file_path
+        return None
+
+    def _read_file(self, file_path: Path) -> pd.DataFrame:
+        columns = [self.date_column, self.value_column, *self.extra_columns]
+        if file_path.suffix == ".parquet":
+            df = pd.read_parquet(file_path)
+            df = df[[x for x in columns if x in df.columns]]
+        else:
+            df = pd.read_csv(file_path, usecols=lambda x: x in columns)
+        df.index = pd.to_datetime(df.pop(self.date_column))
+        return df
+
+    def _fetch_batch(self, symbols: List[str], period_years: int, interval: int,
+                     start: Optional[str]) -> Dict[str, pd.DataFrame]:
+        data = {}
+        for symbol in symbols:
+            file_path = self._get_file_path(symbol)
+            if file_path is None:
+                continue
+            df = self._read_file(file_path)
+            if start is None:
+                if len(df) > 0:
+                    df = df[df.index > df.index.max() - pd.DateOffset(years=period_years)]
+            else:
+                df = df[df.index >= pd.Timestamp(start)]
+            data[symbol] = df
+        return data
@@ -0,0 +1,87 @@
+import numpy as np
+
+
+class DTWSearchStats:
+    """
+    Counters and stage times (in seconds) of DTW searches, accumulated over the searches
+    """
+
+    STAGES = ("candidates", "dtw")
+
+    def __init__(self):
+        self.nb_queries = 0
+        self.nb_candidates = 0
+        self.stage_times = {stage: 0.0 for stage in self.STAGES}
+
+    def to_dict(self) -> dict:
+        return {"nb_queries": self.nb_queries,
+                "nb_candidates": self.nb_candidates,
+                "stage_times": dict(self.stage_times)}
+
+
+def get_band(window_size: int, band_fraction: float) -> int:
+    """
+    Width of the Sakoe-Chiba band: a value can be matched to the values at most this many steps away
+    """
+
+    return max(1, int(round(window_size * band_fraction)))
+
+
+def to_time_major(X: np.ndarray) -> np.ndarray:
+    """
+    The functions below use the time-major layout, where the candidates are the last axis, so the operations of a time
+    step are on contiguous arrays of every candidate
+    Args:
+        X: candidates [n_candidates, n_channels, window_size]
+
+    Returns:
+        float64 candidates [window_size, n_channels, n_candidates]
+    """
+
+    return np.ascontiguousarray(X.astype(np.float64).transpose(2, 1, 0))
+
+
+def dtw_distances(q: np.ndarray, X: np.ndarray, band: int) -> np.ndarray:
+    """
+    DTW distances (sum of the squared differences along the warping path, so it is never larger than the squared
+    euclidean distance) of the candidates, with a Sakoe-Chiba band. The candidates are processed together, row by row
+    of the cost matrix. There is no pruning: the candidates are the nearest windows of the index, so lower bounds
+    (LB_Kim, LB_Keogh) and early abandoning remove only a few of them, which does not pay for the extra passes
+    Args:
+        q: query [window_size, n_channels, 1], or a separate query for every candidate [window_size, n_channels,
+            n_candidates] (so the candidates of several queries are processed together)
+        X: candidates [window_size, n_channels, n_candidates] (see to_time_major)
+        band: width of the Sakoe-Chiba band
+
+    Returns:
+        distances [n_candidates]
+    """
+
+    window_size = len(q)
+    # Only the cells within the band are stored: cell d of row i is the column i + d - band of the cost matrix, so the
+    # values are padded to have every column of the band
+    X = np.pad(X, ((band, band), (0, 0), (0, 0)))
+
+    # The last cell is never valid, so it is the (inf) vertical predecessor of the last cell of the band
+    previous_row = np.full((2 * band + 2, X.shape[-1]), np.inf)
+    previous_row[band] = 0
+    for i in range(window_size):
+        # Cells of the row which are inside the cost matrix
+        start, end = max(band - i, 0), min(window_size - 1 - i + band, 2 * band) + 1
+        costs = ((X[i + start:i + end] - q[i]) ** 2).sum(axis=1)
+
+        # Best of the diagonal (same cell of the previous row) and the vertical (next cell of the previous row)
+        # predecessors. The first row starts the path, which is the zero in the initial previous row
+        row = np.full(previous_row.shape, np.inf)
+        np.minimum(previous_row[start:end], previous_row[start + 1:end + 1], out=row[start:end])
+        if i == 0:
+            row[start + 1:end] = np.inf
+        # The horizontal predecessors are added cell by cell (the cells are only a few, the candidates are many)
+        row[start] += costs[0]
+        for d in range(start + 1, end):
+            np.minimum(row[d], row[d - 1], out=row[d])
+            row[d] += costs[d - start]
+        previous_row = row
+
+    # The last cell of the cost matrix is the middle of the band in the last row
+    return previous_row[band]
@@ -0,0 +1,165 @@
+from typing import Tuple
+
+import numpy as np
+from scipy import fft
+from scipy.ndimage import maximum_filter1d, minimum_filter1d
+
+from .data import RawStockDataHolder
+from .search_model import MINIMUM_WINDOW_SIZE
+
+NORMALIZATIONS = ("minmax", "znorm")
+
+
+class ExactSearchModel:
+    """
+    Index-free exact search (in the style of the MASS algorithm). The distances between the query and every
+    subsequence of every symbol are calculated with FFT based sliding dot products and rolling statistics, so any
+    window size can be searched in O(n log n) per symbol, without creating windows or building an index.
+
+    The distances are the same (squared L2) distances as with a SearchModel using a flat index
+    """
+
+    def __init__(self, data_holder: RawStockDataHolder, normalization: str = "minmax", chunk_size: int = 256):
+        if normalization not in NORMALIZATIONS:
+            raise ValueError(f"Normalization {normalization} is not supported, use one of {NORMALIZATIONS}")
+
+        self._data_holder = data_holder
+        self.normalization = normalization
+        # This many symbols are processed at once, it limits the memory of the temporary arrays
+        self.chunk_size = chunk_size
+
+        # The FFT of the values does not depend on the query (nor on the window size), so it is calculated only once
+        self._fft_length = None
+        self._values_fft = None
+
+    def _prepare(self):
+        values = np.nan_to_num(self._data_holder.get_padded_values().astype(np.float64))
+        # Circular correlation is exact for every (valid) subsequence if the FFT is at least as long as the rows
+        self._fft_length = fft.next_fast_len(values.shape[1], real=True)
+        self._values_fft = fft.rfft(values, n=self._fft_length, axis=1)
+
+    def _normalize_query(self, values: np.ndarray) -> np.ndarray:
+        values = np.nan_to_num(np.asarray(values, dtype=np.float64))
+        if self.normalization == "minmax":
+            value_range = values.max() - values.min()
+            return (values - values.min()) / (value_range if value_range > 0 else 1)
+        std = values.std()
+        return (values - values.mean()) / (std if std > 0 else 1)
+
+    def _calculate_distances(self, query: np.ndarray, values: np.ndarray, values_fft: np.ndarray) -> np.ndarray:
+        """
+        Distances of the normalized query from every (normalized) subsequence of the given rows
+        Args:
+            query: normalized query [window_size]
+            values: rows of the data holder [n_rows, n_values]
+            values_fft: FFT of the rows
+
+        Returns:
+            distances [n_rows, n_values - window_size + 1]
+        """
+
+        window_size = len(query)
+        nb_positions = values.shape[1] - window_size + 1
+
+        # Sliding dot products: sum_j(s[i + j] * q[j]) for every start index i
+        query_fft = fft.rfft(query, n=self._fft_length)
+        dot_products = fft.irfft(values_fft * np.conj(query_fft), n=self._fft_length, axis=1)[:, :nb_positions]
+
+        if self.normalization == "minmax":
+            cumsum = np.zeros((len(values), values.shape[1] + 1))
+            np.cumsum(values, axis=1, out=cumsum[:, 1:])
+            sums = cumsum[:, window_size:] - cumsum[:, :nb_positions]
+            np.cumsum(values ** 2, axis=1, out=cumsum[:, 1:])
+            squared_sums = cumsum[:, window_size:] - cumsum[:, :nb_positions]
+
+            # The filters are centered, window starting at i is at the position i + window_size // 2
+            offset = window_size // 2
+            mins = minimum_filter1d(values, window_size, axis=1)[:, offset:offset + nb_positions]
+            ranges = maximum_filter1d(values, window_size, axis=1)[:, offset:offset + nb_positions] - mins
+            is_constant = ranges == 0
+            ranges[is_constant] = 1
+
+            # ||(s - min) / range - q||^2 expanded, so only the rolling statistics and the dot products are needed
+            distances = (squared_sums - 2 * mins * sums + window_size * mins ** 2) / ranges ** 2
+            distances -= 2 * (dot_products - mins * query.sum()) / ranges
+            distances += np.sum(query ** 2)
+            # Constant windows are normalized to all zeros
+            distances[is_constant] = np.sum(query ** 2)
+        else:
+            cumsum = np.zeros((len(values), values.shape[1] + 1))
+            np.cumsum(values, axis=1, out=cumsum[:, 1:])
+            means = (cumsum[:, window_size:] - cumsum[:, :nb_positions]) / window_size
+            np.cumsum(values ** 2, axis=1, out=cumsum[:, 1:])
+            variances = (cumsum[:, window_size:] - cumsum[:, :nb_positions]) / window_size - means ** 2
+            stds = np.sqrt(np.maximum(variances, 0))
+            is_constant = stds < 1e-8
+            stds[is_constant] = 1
+
+            # The normalized query has zero mean, so the mean of the subsequences does not affect the dot products
+            distances = 2 * window_size - 2 * dot_products / stds
+            distances[is_constant] = np.sum(query ** 2)
+
+        return np.maximum(distances, 0)
+
+    def check_window_size(self, window_size: int):
+        """
+        Raises a ValueError if the window size can not be searched (it is too small, or there are no windows of this
+        size in the data)
+        """
+
+        if window_size < MINIMUM_WINDOW_SIZE:
+            raise ValueError(f"Window size is too small. Minimum is {MINIMUM_WINDOW_SIZE}")
+        max_window_size = int(self._data_holder.nb_of_valid_values.max(initial=0))
+        if window_size > max_window_size:
+            raise ValueError(f"Window size is too large. Maximum is {max_window_size}")
+
+    def search(self, values: np.ndarray, k: int = 5) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Search in the data
+        Args:
+            values: "query" data - not normalized, any window size (min. MINIMUM_WINDOW_SIZE) can be used
+            k: This is how many matches will be returned
+
+        Returns:
+            tuple: labels, start indices (in the data holder rows), distances
+        """
+
+        window_size = len(values)
+        self.check_window_size(window_size)
+
+        if self._values_fft is None:
+            self._prepare()
+
+        query = self._normalize_query(values)
+        nb_windows_per_label = np.maximum(self._data_holder.nb_of_valid_values.astype(np.int64) - window_size + 1, 0)
+
+        top_k_labels = np.zeros(0, dtype=np.int64)
+        top_k_start_indices = np.zeros(0, dtype=np.int64)
+        top_k_distances = np.zeros(0)
+
+        for chunk_start in range(0, len(nb_windows_per_label), self.chunk_size):
+            chunk_labels = np.arange(chunk_start, min(chunk_start + self.chunk_size, len(nb_windows_per_label)))
+            # Rows shorter than the window do not have windows (and the padded rows of the chunk can be shorter than
+            # the window, if every row of it is)
+            chunk_labels = chunk_labels[nb_windows_per_label[chunk_labels] > 0]
+            if len(chunk_labels) == 0:
+                continue
+            chunk_values = np.nan_to_num(self._data_holder.get_padded_values(chunk_labels).astype(np.float64))
+            distances = self._calculate_distances(query, chunk_values, self._values_fft[chunk_labels])
+
+            # Windows reaching into the zero padded (not valid) part of the rows can not be matches
+            is_valid = np.arange(distances.shape[1])[None, :] < nb_windows_per_label[chunk_labels, None]
+            distances[~is_valid] = np.inf
+
+            # Only the top k of the chunk is kept, and merged with the previous chunks
+            chunk_k = min(k, distances.size)
+            flat_indices = np.argpartition(distances, chunk_k - 1, axis=None)[:chunk_k]
+            labels, start_indices = np.unravel_index(flat_indices, distances.shape)
+
+            top_k_labels = np.concatenate([top_k_labels, chunk_labels[labels]])
+            top_k_start_indices = np.concatenate([top_k_start_indices, start_indices])
+            top_k_distances = np.concatenate([top_k_distances, distances[labels, start_indices]])
+
+        order = np.argsort(top_k_distances, kind="stable")[:k]
+        order = order[np.isfinite(top_k_distances[order])]
+        return top_k_labels[order], top_k_start_indices[order], top_k_distances[order].astype(np.float32)
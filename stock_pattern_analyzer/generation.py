@@ -0,0 +1,52 @@
+from datetime import datetime
+from typing import Dict, Optional
+
+import numpy as np
+
+from .data import DateStringTable, RawStockDataHolder
+from .exact_search import ExactSearchModel
+from .precompute import MostRecentMatchTable
+from .search_model import SearchModel
+
+
+class SearchGeneration:
+    """
+    Consistent snapshot of everything which is used for serving: the data holder, the search models (for every window
+    size) built on it, the exact search model and the precomputed most recent matches.
+
+    A generation is not modified after it is created. A refresh builds a completely new generation while the old one
+    is still serving, then it is published with a single reference swap. Requests keep a reference to the generation
+    they started with, so the old one is released when the last in-flight request (using it) finishes
+    """
+
+    def __init__(self,
+                 version: int,
+                 data_holder: RawStockDataHolder,
+                 search_models: Dict[int, SearchModel],
+                 match_tables: Optional[Dict[int, MostRecentMatchTable]] = None):
+        self.version = version
+        self.data_holder = data_holder
+        self.search_models = search_models
+        self.match_tables = match_tables if match_tables is not None else {}
+        self.exact_search_model = ExactSearchModel(data_holder=data_holder)
+        # Lookup tables of the response building
+        self.date_strings = DateStringTable(data_holder)
+        self.symbols_by_label = np.array([data_holder.label_to_symbol[label]
+                                          for label in range(len(data_holder.ticker_symbols))])
+        self.available_symbols = data_holder.get_available_symbols()
+        self.created_at = datetime.now()
+
+
+def build_match_tables(data_holder: RawStockDataHolder,
+                       search_models: Dict[int, SearchModel],
+                       max_top_k: int,
+                       max_future_size: int) -> Dict[int, MostRecentMatchTable]:
+    match_tables = {}
+    for window_size, search_model in search_models.items():
+        match_table = MostRecentMatchTable(data_holder=data_holder,
+                                           search_model=search_model,
+                                           max_top_k=max_top_k,
+                                           max_future_size=max_future_size)
+        match_table.build()
+        match_tables[window_size] = match_table
+    return match_tables
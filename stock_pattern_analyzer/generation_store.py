@@ -0,0 +1,150 @@
+from datetime import datetime
+import json
+import os
+from pathlib import Path
+import shutil
+from typing import Optional
+
+from .data import MANIFEST_FILE_NAME, RawStockDataHolder
+from .generation import SearchGeneration
+from .precompute import MostRecentMatchTable
+from .search_model import SearchModel
+
+CURRENT_FILE_NAME = "CURRENT"
+DATA_HOLDER_FOLDER_NAME = "data_holder"
+
+
+def _link_or_copy_folder(source_path: str, target_path: Path):
+    # Hard links are free and the files of the source are never modified (serialize always writes new files), so the
+    # linked files stay the same even if the source folder is replaced. Copy is the fallback (e.g. other filesystem)
+    target_path.mkdir()
+    for p in Path(source_path).iterdir():
+        try:
+            os.link(p, target_path / p.name)
+        except OSError:
+            shutil.copy2(p, target_path / p.name)
+
+
+class GenerationStore:
+    """
+    Published generations on the disk, so multiple (worker) processes can serve the same generation while only one
+    (builder) process downloads the data and builds the search trees.
+
+    Every generation is an immutable folder (named by its version) with the data holder, the search models and the
+    precomputed match tables, and the CURRENT file points to the latest one. The folders are complete before CURRENT
+    is (atomically) replaced, so a reader never sees a partially published generation.
+
+    The generations are loaded with memory mapped arrays and indices, so the processes share the page cache, and the
+    memory does not grow with the number of workers
+    """
+
+    def __init__(self, folder_path: str, nb_kept_generations: int = 2):
+        """
+        Args:
+            folder_path: folder of the generations
+            nb_kept_generations: this many of the most recent generations are kept, the older ones are removed when a
+                new one is published (processes which still use a removed one can finish with it, as the files are
+                memory mapped)
+        """
+
+        self.folder_path = Path(folder_path)
+        self.nb_kept_generations = nb_kept_generations
+
+    def _get_generation_path(self, version: int) -> Path:
+        return self.folder_path / f"generation_{version}"
+
+    def get_current_version(self) -> Optional[int]:
+        """
+        Returns:
+            version of the latest published generation or None if nothing is published yet
+        """
+
+        try:
+            return int((self.folder_path / CURRENT_FILE_NAME).read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def publish(self, generation: SearchGeneration) -> str:
+        """
+        Publishes a generation. The data holder and the search models should be serialized already, their files are
+        linked to the generation folder
+        Args:
+            generation: the generation to publish
+
+        Returns:
+            path of the generation folder
+        """
+
+        generation_path = self._get_generation_path(generation.version)
+        tmp_generation_path = generation_path.with_name(f"{generation_path.name}.tmp{os.getpid()}")
+        self.folder_path.mkdir(parents=True, exist_ok=True)
+        tmp_generation_path.mkdir()
+
+        data_holder = generation.data_holder
+        if data_holder.file_path is None:
+            raise ValueError("The data holder needs to be serialized first")
+        _link_or_copy_folder(data_holder.file_path, tmp_generation_path / DATA_HOLDER_FOLDER_NAME)
+
+        for window_size, search_model in generation.search_models.items():
+            if search_model.file_path is None:
+                raise ValueError(f"The search model (window size {window_size}) needs to be serialized first")
+            _link_or_copy_folder(search_model.file_path, tmp_generation_path / f"search_tree_{window_size}win")
+        for window_size, match_table in generation.match_tables.items():
+            match_table.serialize(str(tmp_generation_path / f"match_table_{window_size}win"))
+
+        manifest = {"version": generation.version,
+                    "window_sizes": sorted(generation.search_models.keys()),
+                    "match_table_window_sizes": sorted(generation.match_tables.keys()),
+                    "created_at": generation.created_at.isoformat()}
+        (tmp_generation_path / MANIFEST_FILE_NAME).write_text(json.dumps(manifest))
+
+        if generation_path.exists():
+            shutil.rmtree(generation_path)
+        tmp_generation_path.rename(generation_path)
+
+        tmp_current_path = self.folder_path / f"{CURRENT_FILE_NAME}.tmp{os.getpid()}"
+        tmp_current_path.write_text(str(generation.version))
+        os.replace(tmp_current_path, self.folder_path / CURRENT_FILE_NAME)
+
+        self._remove_old_generations(generation.version)
+        return str(generation_path)
+
+    def _remove_old_generations(self, current_version: int):
+        paths = [p for p in self.folder_path.glob("generation_*") if ".tmp" not in p.name]
+        versions = sorted(int(p.name.split("_")[-1]) for p in paths)
+        for version in versions:
+            if version <= current_version - self.nb_kept_generations:
+                shutil.rmtree(self._get_generation_path(version), ignore_errors=True)
+
+    def load(self, version: Optional[int] = None) -> SearchGeneration:
+        """
+        Loads a published generation with memory mapped arrays and indices
+        Args:
+            version: version to load, the latest one if None
+
+        Returns:
+            the loaded generation
+        """
+
+        if version is None:
+            version = self.get_current_version()
+            if version is None:
+                raise FileNotFoundError(f"There is no published generation in {self.folder_path}")
+
+        generation_path = self._get_generation_path(version)
+        manifest = json.loads((generation_path / MANIFEST_FILE_NAME).read_text())
+
+        data_holder = RawStockDataHolder.load(str(generation_path / DATA_HOLDER_FOLDER_NAME))
+        search_models = {w: SearchModel.load(str(generation_path / f"search_tree_{w}win"), data_holder=data_holder)
+                         for w in manifest["window_sizes"]}
+        match_tables = {w: MostRecentMatchTable.load(str(generation_path / f"match_table_{w}win"),
+                                                     data_holder=data_holder,
+                                                     search_model=search_models[w])
+                        for w in manifest["match_table_window_sizes"]}
+        generation = SearchGeneration(version=manifest["version"],
+                                      data_holder=data_holder,
+                                      search_models=search_models,
+                                      match_tables=match_tables)
+        # Every process shows the time of the refresh, not the time of the load
+        generation.created_at = datetime.fromisoformat(manifest["created_at"])
+        return generation
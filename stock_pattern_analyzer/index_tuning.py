@@ -0,0 +1,160 @@
+import itertools
+import time
+from typing import Optional
+
+import faiss
+import numpy as np
+
+# Number of held-out queries and the maximum number of indexed rows which are used for the tuning
+NB_TUNING_QUERIES = 200
+MAX_TUNING_SIZE = 100_000
+# faiss needs at least this many training points per centroid
+MIN_POINTS_PER_CENTROID = 39
+# Candidate nlist values are these multiples of sqrt(n)
+NLIST_SQRT_MULTIPLIERS = (1, 4)
+NBITS_CANDIDATES = (4, 8)
+# Sub-quantizers with more dimensions than this are not tried (the code would be too lossy)
+MAX_SUB_QUANTIZER_DIMENSION = 16
+
+
+def create_ivfpq_index(d: int, nlist: int, m: int, nbits: int) -> faiss.IndexIVFPQ:
+    quantizer = faiss.IndexFlatL2(d)
+    return faiss.IndexIVFPQ(quantizer, d, nlist, m, nbits)
+
+
+def _get_sub_quantizer_counts(d: int) -> list:
+    # The number of sub-quantizers has to be a divisor of the dimension
+    return [m for m in range(1, d + 1) if (d % m == 0) and (d // m <= MAX_SUB_QUANTIZER_DIMENSION)]
+
+
+def default_ivfpq_parameters(n: int, d: int) -> dict:
+    """
+    Parameters which are used without tuning
+    Args:
+        n: number of rows
+        d: dimension of the rows
+
+    Returns:
+        dict of nlist, m, nbits, nprobe
+    """
+
+    # Same as the previous fixed selection for the dimensions it handled, otherwise the smallest divisor
+    for m in (4, 5, 2):
+        if d % m == 0:
+            break
+    else:
+        m = next(m for m in range(2, d + 1) if d % m == 0)
+    nlist = min(max(1, n // MIN_POINTS_PER_CENTROID), 100)
+    return {"nlist": nlist, "m": m, "nbits": 8, "nprobe": 1}
+
+
+def _calculate_recall(X: np.ndarray, Q: np.ndarray, indices: np.ndarray, kth_exact_distances: np.ndarray) -> float:
+    # Distance based recall, so a result with the same distance as an exact result (e.g. the same shape at a different
+    # date) is counted as a hit
+    is_found = indices >= 0
+    true_distances = np.sum((X[np.maximum(indices, 0)] - Q[:, None, :]) ** 2, axis=2)
+    is_hit = is_found & (true_distances <= kth_exact_distances[:, None] * (1 + 1e-5) + 1e-6)
+    return float(is_hit.mean())
+
+
+def _measure_latency(index: faiss.Index, Q: np.ndarray, k: int) -> float:
+    # The service queries one vector at a time, so this is measured the same way
+    start_time = time.perf_counter()
+    for q in Q:
+        index.search(q[None], k)
+    return (time.perf_counter() - start_time) / len(Q)
+
+
+def tune_ivfpq_parameters(X: np.ndarray,
+                          recall_target: float,
+                          latency_budget: Optional[float] = None,
+                          k: int = 10,
+                          seed: int = 0) -> dict:
+    """
+    Selects the IVF-PQ parameters (nlist, m, nbits, nprobe) for the data by measuring the recall@k (against exact
+    search) and the latency on held-out queries. The configurations are tried from the smallest code size, and the
+    first one (with the smallest nprobe) which reaches the recall target within the latency budget is selected.
+    If there is no such configuration, then the one with the highest recall is used.
+
+    For large data the tuning is done on a sample, nlist and nprobe are then scaled to the size of the data (the number
+    of points per list and the probed fraction of the lists are kept)
+    Args:
+        X: Data [n_rows, n_features]
+        recall_target: minimum recall@k (between 0 and 1)
+        latency_budget: maximum latency of a single query (in seconds), not limited if not set
+        k: number of matches used for the recall
+        seed: seed of the sampling
+
+    Returns:
+        dict of nlist, m, nbits, nprobe and the measured recall and latency (latency is scaled to the size of the data)
+    """
+
+    n, d = X.shape
+    rng = np.random.default_rng(seed)
+    nb_queries = min(NB_TUNING_QUERIES, n // 10)
+    if nb_queries == 0:
+        raise ValueError("There is not enough data to tune the index parameters")
+
+    sample = rng.choice(n, size=min(n, MAX_TUNING_SIZE + nb_queries), replace=False)
+    Q = np.ascontiguousarray(X[sample[:nb_queries]])
+    X_tune = np.ascontiguousarray(X[sample[nb_queries:]])
+    n_tune = len(X_tune)
+    # More rows are scanned in the full index, this scales the latencies measured on the sample
+    size_ratio = n / n_tune
+
+    exact_index = faiss.IndexFlatL2(d)
+    exact_index.add(X_tune)
+    exact_distances, _ = exact_index.search(Q, k)
+    kth_exact_distances = exact_distances[:, -1]
+
+    nlist_candidates = sorted({int(np.clip(c * np.sqrt(n), 1, max(1, n // MIN_POINTS_PER_CENTROID)))
+                               for c in NLIST_SQRT_MULTIPLIERS})
+    configurations = sorted(itertools.product(_get_sub_quantizer_counts(d), NBITS_CANDIDATES),
+                            key=lambda x: (x[0] * x[1], x[1]))
+
+    best = None
+    for m, nbits in configurations:
+        # The PQ codebooks can not be trained with less points than centroids
+        if n_tune < 2 ** nbits:
+            continue
+
+        selected = None
+        for nlist in nlist_candidates:
+            nlist_tune = max(1, min(int(round(nlist / size_ratio)), n_tune // MIN_POINTS_PER_CENTROID))
+            index = create_ivfpq_index(d, nlist_tune, m, nbits)
+            index.train(X_tune)
+            index.add(X_tune)
+
+            nprobe = 1
+            while True:
+                index.nprobe = nprobe
+                _, indices = index.search(Q, k)
+                recall = _calculate_recall(X_tune, Q, indices, kth_exact_distances)
+                latency = _measure_latency(index, Q, k) * size_ratio
+                if (latency_budget is not None) and (latency > latency_budget):
+                    break
+
+                params = {"nlist": nlist,
+                          "m": m,
+                          "nbits": nbits,
+                          "nprobe": min(nlist, int(np.ceil(nprobe * nlist / nlist_tune))),
+                          "recall": recall,
+                          "latency": latency}
+                if (best is None) or (recall > best["recall"]):
+                    best = params
+                if recall >= recall_target:
+                    if (selected is None) or (latency < selected["latency"]):
+                        selected = params
+                    break
+                if nprobe >= nlist_tune:
+                    break
+                nprobe = min(nprobe * 2, nlist_tune)
+
+        if selected is not None:
+            print(f"Index parameters are tuned: {selected}")
+            return selected
+
+    if best is None:
+        raise ValueError("There is no index configuration within the latency budget")
+    print(f"Recall target {recall_target} can not be reached, using the highest recall configuration: {best}")
+    return best
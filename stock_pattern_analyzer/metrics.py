@@ -0,0 +1,157 @@
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Upper bounds (in seconds) of the histogram buckets of the request stages
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# Upper bounds (in seconds) of the histogram buckets of the builds and refreshes
+BUILD_DURATION_BUCKETS = (0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1800.0, 3600.0)
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+
+class _Histogram:
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        # The last count is the +Inf bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class _Metric:
+
+    def __init__(self, name: str, metric_type: str, description: str, buckets: Optional[Sequence[float]]):
+        self.name = name
+        self.metric_type = metric_type
+        self.description = description
+        self.buckets = tuple(buckets) if buckets is not None else None
+        # Sorted (label name, label value) pairs -> value (or _Histogram)
+        self.series: Dict[tuple, object] = {}
+
+
+def _format_labels(labels: tuple, extra_label: Optional[Tuple[str, str]] = None) -> str:
+    if extra_label is not None:
+        labels = labels + (extra_label,)
+    if len(labels) == 0:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class MetricsRegistry:
+    """
+    Counters, gauges and histograms with labels, rendered in the Prometheus text format. The metrics are declared once
+    (see describe), then the updates are only a dictionary lookup (and a bucket search for the histograms) under a
+    lock, so they can be used on the request path
+    """
+
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name: str, metric_type: str, description: str, buckets: Optional[Sequence[float]] = None):
+        """
+        Declares a metric
+        Args:
+            name: name of the metric (counters should end with _total)
+            metric_type: COUNTER, GAUGE or HISTOGRAM
+            description: help text of the metric
+            buckets: upper bounds of the buckets (only for histograms, LATENCY_BUCKETS if not set)
+        """
+
+        if metric_type not in (COUNTER, GAUGE, HISTOGRAM):
+            raise ValueError(f"Unknown metric type {metric_type}")
+        if metric_type == HISTOGRAM:
+            buckets = sorted(buckets if buckets is not None else LATENCY_BUCKETS)
+        with self._lock:
+            self._metrics[name] = _Metric(name, metric_type, description, buckets)
+
+    def _get_metric(self, name: str, metric_type: str) -> _Metric:
+        metric = self._metrics.get(name)
+        if metric is None:
+            raise KeyError(f"Metric {name} is not described")
+        if metric.metric_type != metric_type:
+            raise ValueError(f"Metric {name} is a {metric.metric_type}, not a {metric_type}")
+        return metric
+
+    def inc(self, name: str, value: float = 1, **labels):
+        metric = self._get_metric(name, COUNTER)
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            metric.series[key] = metric.series.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels):
+        metric = self._get_metric(name, GAUGE)
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            metric.series[key] = value
+
+    def observe(self, name: str, value: float, **labels):
+        metric = self._get_metric(name, HISTOGRAM)
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            histogram = metric.series.get(key)
+            if histogram is None:
+                histogram = metric.series[key] = _Histogram(metric.buckets)
+            histogram.observe(value)
+
+    @contextmanager
+    def time(self, name: str, **labels) -> Iterator[None]:
+        """
+        Observes the duration (in seconds) of the with block in a histogram
+        """
+
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start_time, **labels)
+
+    def clear(self, name: str):
+        """
+        Removes every series of a metric (e.g. the gauges of the window sizes which are not served any more)
+        """
+
+        metric = self._metrics[name]
+        with self._lock:
+            metric.series.clear()
+
+    def render(self) -> str:
+        """
+        Returns:
+            every metric in the Prometheus text exposition format (version 0.0.4)
+        """
+
+        lines: List[str] = []
+        with self._lock:
+            for metric in self._metrics.values():
+                lines.append(f"# HELP {metric.name} {metric.description}")
+                lines.append(f"# TYPE {metric.name} {metric.metric_type}")
+                for labels, value in sorted(metric.series.items()):
+                    if metric.metric_type != HISTOGRAM:
+                        lines.append(f"{metric.name}{_format_labels(labels)} {_format_value(value)}")
+                        continue
+                    cumulative_count = 0
+                    for bound, count in zip(metric.buckets + (math.inf,), value.counts):
+                        cumulative_count += count
+                        bucket_labels = _format_labels(labels, ("le", _format_value(bound)))
+                        lines.append(f"{metric.name}_bucket{bucket_labels} {cumulative_count}")
+                    lines.append(f"{metric.name}_sum{_format_labels(labels)} {_format_value(value.sum)}")
+                    lines.append(f"{metric.name}_count{_format_labels(labels)} {cumulative_count}")
+        return "\n".join(lines) + "\n"
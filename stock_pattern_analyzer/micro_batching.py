@@ -0,0 +1,131 @@
+import asyncio
+import concurrent.futures
+import functools
+import threading
+from typing import Callable, Dict, Hashable, List, Optional
+
+import numpy as np
+
+from .search_model import SearchModel
+
+
+class _PendingBatch:
+
+    def __init__(self, search_model: SearchModel, allowed_ids: Optional[np.ndarray]):
+        self.search_model = search_model
+        self.allowed_ids = allowed_ids
+        # (values, k, future) of the waiting requests
+        self.queries: List[tuple] = []
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+
+class MicroBatchSearcher:
+    """
+    Collects the single searches which arrive within a short time window (with the same key, e.g. the same window
+    size and filters) and runs them as one batched index query on a worker pool. The event loop only groups the
+    requests and distributes the results, the CPU-bound work (normalization, index search) runs on the workers.
+
+    Under low load a request waits at most the batch window, under high load the batches fill up and the index is
+    queried with many vectors at once, which has a much higher throughput than one query at a time
+    """
+
+    def __init__(self,
+                 executor: concurrent.futures.Executor,
+                 batch_window: float,
+                 max_batch_size: int,
+                 stage_times_callback: Optional[Callable[[Dict[str, float]], None]] = None):
+        """
+        Args:
+            executor: worker pool of the batched searches
+            batch_window: seconds while the queries are collected after the first query of a batch
+            max_batch_size: a batch is searched immediately when it reaches this size
+            stage_times_callback: if set, then it is called with the stage times of every batch (see
+                SearchModel.search_batch), on the worker
+        """
+
+        self._executor = executor
+        self.batch_window = batch_window
+        self.max_batch_size = max(1, max_batch_size)
+        # Only used from the event loop
+        self._pending_batches: Dict[Hashable, _PendingBatch] = {}
+        self._stage_times_callback = stage_times_callback
+
+        # Batch size -> number of batches
+        self._stats_lock = threading.Lock()
+        self.batch_size_counts: Dict[int, int] = {}
+
+    async def search(self,
+                     key: Hashable,
+                     search_model: SearchModel,
+                     values: np.ndarray,
+                     k: int,
+                     allowed_ids: Optional[np.ndarray] = None) -> tuple:
+        """
+        Same as SearchModel.search, but the query is searched together with the other queries of the same key
+        Args:
+            key: queries with the same key are batched, they must use the same search model and allowed ids
+            search_model: search model of the query
+            values: "query" data - not (min-max) scaled
+            k: This is how many matches will be returned
+            allowed_ids: boolean mask of the windows which can be matches (see SearchModel.get_allowed_window_ids)
+
+        Returns:
+            tuple: indices, distances (if there are less than k allowed matches, then they are shorter)
+        """
+
+        loop = asyncio.get_running_loop()
+        batch = self._pending_batches.get(key)
+        if batch is None:
+            batch = _PendingBatch(search_model=search_model, allowed_ids=allowed_ids)
+            self._pending_batches[key] = batch
+            batch.timer = loop.call_later(self.batch_window, self._flush, key, batch)
+
+        future = loop.create_future()
+        batch.queries.append((values, k, future))
+        if len(batch.queries) >= self.max_batch_size:
+            batch.timer.cancel()
+            self._flush(key, batch)
+        return await future
+
+    def _flush(self, key: Hashable, batch: _PendingBatch):
+        # The timer can fire after the batch was already flushed because it was full
+        if self._pending_batches.get(key) is batch:
+            del self._pending_batches[key]
+            asyncio.ensure_future(self._run_batch(batch))
+
+    async def _run_batch(self, batch: _PendingBatch):
+        loop = asyncio.get_running_loop()
+        values = np.stack([values for values, _, _ in batch.queries])
+        # Every query is searched with the largest k, and the results are truncated
+        max_k = max(k for _, k, _ in batch.queries)
+        with self._stats_lock:
+            batch_size = len(batch.queries)
+            self.batch_size_counts[batch_size] = self.batch_size_counts.get(batch_size, 0) + 1
+
+        try:
+            top_k_indices, top_k_distances = await loop.run_in_executor(
+                self._executor, functools.partial(self._search_batch, batch, values, max_k))
+        except Exception as e:
+            for _, _, future in batch.queries:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for row, (_, k, future) in enumerate(batch.queries):
+            # The request could have been cancelled (e.g. the client disconnected) in the meantime
+            if future.done():
+                continue
+            is_found = top_k_indices[row] >= 0
+            future.set_result((top_k_indices[row][is_found][:k], top_k_distances[row][is_found][:k]))
+
+    def _search_batch(self, batch: _PendingBatch, values: np.ndarray, k: int) -> tuple:
+        stage_times = {} if self._stage_times_callback is not None else None
+        result = batch.search_model.search_batch(values=values, k=k, allowed_ids=batch.allowed_ids,
+                                                 stage_times=stage_times)
+        if stage_times is not None:
+            self._stage_times_callback(stage_times)
+        return result
+
+    def get_batch_size_histogram(self) -> Dict[int, int]:
+        with self._stats_lock:
+            return dict(sorted(self.batch_size_counts.items()))
@@ -0,0 +1,192 @@
+import json
+from pathlib import Path
+import time
+from typing import Optional, Tuple
+
+import numpy as np
+
+from .data import MANIFEST_FILE_NAME, RawStockDataHolder
+from .search_model import SearchModel
+
+# Arrays of the match table which are stored as separate .npy files
+ARRAY_NAMES = ("labels", "start_indices", "distances", "start_dates", "end_dates", "values", "nb_matches")
+
+
+class MostRecentMatchTable:
+    """
+    Precomputed search results for the most recent window of every symbol (for a given window size). As only the
+    most recent windows are searched, the set of results is finite, so it can be computed (with batched searches)
+    after every refresh, and then a request is just a lookup and slicing
+    """
+
+    def __init__(self, data_holder: RawStockDataHolder, search_model: SearchModel, max_top_k: int,
+                 max_future_size: int):
+        self._data_holder = data_holder
+        self._search_model = search_model
+        self.window_size = search_model.window_size
+        # The first match is the search sequence itself, so there is one more match for every symbol
+        self.max_top_k = max_top_k
+        self.max_future_size = max_future_size
+
+        # These are [n_symbols, max_top_k + 1] arrays, only the first nb_matches[label] entries of a row are matches
+        self.labels = None
+        self.start_indices = None
+        self.distances = None
+        self.start_dates = None
+        self.end_dates = None
+        # Window values with max_future_size future values [n_symbols, max_top_k + 1, max_future_size + window_size]
+        # (the missing future values are padded at the beginning)
+        self.values = None
+        # Number of found matches of every symbol [n_symbols], an index (e.g. IVF-PQ with a small nprobe) can find less
+        # than max_top_k + 1
+        self.nb_matches = None
+
+        self.build_time = None
+        self.is_built = False
+
+    def build(self, batch_size: int = 1024):
+        """
+        Computes the table with batched searches
+
+        Returns:
+            None
+        """
+
+        start_time = time.time()
+
+        window_size = self.window_size
+        k = self.max_top_k + 1
+        anchor_values = self._search_model.get_query_values(np.arange(len(self._data_holder.ticker_symbols)))
+
+        indices = []
+        distances = []
+        for batch_start in range(0, len(anchor_values), batch_size):
+            batch_indices, batch_distances = self._search_model.search_batch(
+                values=anchor_values[batch_start:batch_start + batch_size], k=k)
+            indices.append(batch_indices)
+            distances.append(batch_distances)
+        indices = np.concatenate(indices)
+        distances = np.concatenate(distances).astype(np.float32)
+
+        # The missing matches (-1 indices) are moved to the end of the rows, and only the found ones are filled
+        is_found = indices >= 0
+        order = np.argsort(~is_found, axis=1, kind="stable")
+        indices = np.take_along_axis(indices, order, axis=1)
+        is_found = np.take_along_axis(is_found, order, axis=1)
+        self.nb_matches = is_found.sum(axis=1).astype(np.int32)
+        self.distances = np.take_along_axis(distances, order, axis=1)
+        self.distances[~is_found] = np.finfo(np.float32).max
+
+        labels, start_indices = self._search_model.get_window_labels_and_start_indices(indices[is_found])
+        self.labels = np.zeros(indices.shape, dtype=np.int32)
+        self.labels[is_found] = labels
+        self.start_indices = np.zeros(indices.shape, dtype=np.int32)
+        self.start_indices[is_found] = start_indices
+
+        start_dates, end_dates = self._data_holder.get_windows_start_end_dates(labels, start_indices, window_size)
+        self.start_dates = np.zeros(indices.shape, dtype=start_dates.dtype)
+        self.start_dates[is_found] = start_dates
+        self.end_dates = np.zeros(indices.shape, dtype=end_dates.dtype)
+        self.end_dates[is_found] = end_dates
+
+        values, _ = self._data_holder.get_windows_values(labels, start_indices, window_size, self.max_future_size)
+        self.values = np.zeros(indices.shape + (window_size + self.max_future_size,), dtype=values.dtype)
+        # There can be fewer future values than max_future_size (the rest is padding at the beginning)
+        self.values[is_found, self.values.shape[-1] - values.shape[1]:] = values
+
+        self.build_time = time.time() - start_time
+        self.is_built = True
+
+    @property
+    def nbytes(self) -> int:
+        return sum(getattr(self, x).nbytes for x in ARRAY_NAMES if getattr(self, x) is not None)
+
+    def serialize(self, folder_path: str):
+        """
+        Saves the table as a folder of raw .npy arrays and a small json manifest, so it can be memory mapped when it
+        is loaded
+        Args:
+            folder_path: folder to create
+
+        Returns:
+            None
+        """
+
+        if not self.is_built:
+            raise ValueError("You need to build the table first")
+
+        folder_path = Path(folder_path)
+        folder_path.mkdir()
+        for array_name in ARRAY_NAMES:
+            np.save(folder_path / f"{array_name}.npy", getattr(self, array_name))
+
+        manifest = {"window_size": self.window_size,
+                    "max_top_k": self.max_top_k,
+                    "max_future_size": self.max_future_size,
+                    "build_time": self.build_time}
+        (folder_path / MANIFEST_FILE_NAME).write_text(json.dumps(manifest))
+
+    @staticmethod
+    def load(folder_path: str,
+             data_holder: RawStockDataHolder,
+             search_model: SearchModel,
+             mmap_mode: Optional[str] = "r") -> "MostRecentMatchTable":
+        """
+        Loads a serialized table
+        Args:
+            folder_path: folder created with the serialize method
+            data_holder: the data holder which was used to build the table
+            search_model: the search model which was used to build the table
+            mmap_mode: numpy memory map mode for the arrays (see RawStockDataHolder.load)
+
+        Returns:
+            the loaded table
+        """
+
+        folder_path = Path(folder_path)
+        manifest = json.loads((folder_path / MANIFEST_FILE_NAME).read_text())
+        if manifest["window_size"] != search_model.window_size:
+            raise ValueError("The match table was built with a different window size")
+
+        obj = MostRecentMatchTable(data_holder=data_holder,
+                                   search_model=search_model,
+                                   max_top_k=manifest["max_top_k"],
+                                   max_future_size=manifest["max_future_size"])
+        for array_name in ARRAY_NAMES:
+            file_path = folder_path / f"{array_name}.npy"
+            if file_path.exists():
+                setattr(obj, array_name, np.load(file_path, mmap_mode=mmap_mode))
+        if obj.nb_matches is None:
+            # Tables of the previous versions mark the missing matches only with the largest distance
+            obj.nb_matches = (np.asarray(obj.distances) < np.finfo(np.float32).max).sum(axis=1).astype(np.int32)
+        obj.build_time = manifest["build_time"]
+        obj.is_built = True
+        return obj
+
+    def get(self, label: int, top_k: int, future_size: int) -> Optional[Tuple]:
+        """
+        Looks up the results of a symbol
+        Args:
+            label: label of the symbol
+            top_k: number of matches (without the search sequence itself)
+            future_size: number of future values of the matches
+
+        Returns:
+            None if the request can not be served from the table, otherwise a tuple of (at most top_k + 1 length, only
+            the found matches) arrays:
+            labels, start indices, distances, start dates, end dates, window values with future values
+            [top_k + 1, future_size + window_size] (padded as RawStockDataHolder.get_windows_values), number of future
+            values
+        """
+
+        if (not self.is_built) or (top_k > self.max_top_k) or (future_size > self.max_future_size):
+            return None
+
+        k = min(top_k + 1, int(self.nb_matches[label]))
+        start_indices = self.start_indices[label, :k]
+        # Windows close to the most recent value do not have all the future values
+        nb_future_values = np.minimum(start_indices, future_size)
+        values = self.values[label, :k, self.max_future_size - future_size:]
+
+        return (self.labels[label, :k], start_indices, self.distances[label, :k], self.start_dates[label, :k],
+                self.end_dates[label, :k], values, nb_future_values)
@@ -0,0 +1,99 @@
+import numpy as np
+from scipy.ndimage import maximum_filter1d, minimum_filter1d
+
+from .data import concatenate_ranges
+
+
+def get_paa_segment_bounds(window_size: int, nb_segments: int) -> np.ndarray:
+    """
+    Bounds of the PAA segments. If the window size is not divisible by the number of segments, then the lengths of the
+    segments differ by at most one
+    Args:
+        window_size: size of the windows
+        nb_segments: number of segments
+
+    Returns:
+        bounds [nb_segments + 1], the i-th segment is [bounds[i], bounds[i + 1])
+    """
+
+    if not (1 <= nb_segments <= window_size):
+        raise ValueError(f"Number of segments should be between 1 and the window size ({window_size})")
+    return np.round(np.linspace(0, window_size, nb_segments + 1)).astype(np.int64)
+
+
+def paa_transform(X: np.ndarray, nb_segments: int) -> np.ndarray:
+    """
+    Piecewise Aggregate Approximation of the rows. The segment means are weighted with the square root of the segment
+    lengths, so the L2 distance of the transformed rows is a lower bound of the L2 distance of the original rows
+    Args:
+        X: Data [n_rows, n_features]
+        nb_segments: number of segments
+
+    Returns:
+        transformed data [n_rows, nb_segments]
+    """
+
+    bounds = get_paa_segment_bounds(X.shape[1], nb_segments)
+    cumsum = np.zeros((len(X), X.shape[1] + 1))
+    np.cumsum(X, axis=1, out=cumsum[:, 1:])
+    segment_sums = cumsum[:, bounds[1:]] - cumsum[:, bounds[:-1]]
+    return (segment_sums / np.sqrt(np.diff(bounds))).astype(np.float32)
+
+
+def create_paa_windows(values: np.ndarray,
+                       offsets: np.ndarray,
+                       window_size: int,
+                       nb_segments: int,
+                       nb_windows_per_label: np.ndarray,
+                       chunk_size: int = 64) -> np.ndarray:
+    """
+    Same as the paa_transform of the min-max scaled sliding windows (see SearchModel._create_windows), but it is
+    calculated from the rolling sums, minimums and maximums of the rows, so the windows themselves are never created.
+    Windows with missing (NaN) values are all zeros, as in SearchModel._create_windows
+    Args:
+        values: concatenated values of the data holder
+        offsets: offsets of the rows in the values (see RawStockDataHolder)
+        window_size: size of the windows
+        nb_segments: number of segments
+        nb_windows_per_label: number of (most recent) windows to create for every label
+        chunk_size: this many labels are processed at once, it limits the memory of the temporary arrays
+
+    Returns:
+        transformed windows [nb_windows_per_label.sum(), nb_segments], label after label
+    """
+
+    bounds = get_paa_segment_bounds(window_size, nb_segments)
+    segment_lengths = np.diff(bounds)
+    # The filters are centered, window starting at i is at the position i + window_size // 2
+    offset = window_size // 2
+
+    reduced_windows = [np.zeros((0, nb_segments), dtype=np.float32)]
+    for chunk_start in range(0, len(nb_windows_per_label), chunk_size):
+        nb_windows = nb_windows_per_label[chunk_start:chunk_start + chunk_size]
+        if nb_windows.sum() == 0:
+            continue
+
+        # The rows of the chunk are contiguous, and the windows never reach into the next row
+        chunk_offsets = np.asarray(offsets[chunk_start:chunk_start + len(nb_windows) + 1], dtype=np.int64)
+        rows = np.asarray(values[chunk_offsets[0]:chunk_offsets[-1]], dtype=np.float64)
+        positions = concatenate_ranges(chunk_offsets[:-1] - chunk_offsets[0], nb_windows)
+        is_nan = np.isnan(rows)
+        rows[is_nan] = 0
+
+        cumsum = np.zeros(len(rows) + 1)
+        np.cumsum(rows, out=cumsum[1:])
+        segment_sums = cumsum[positions[:, None] + bounds[1:]] - cumsum[positions[:, None] + bounds[:-1]]
+
+        np.cumsum(is_nan, out=cumsum[1:])
+        has_nan = (cumsum[positions + window_size] - cumsum[positions]) > 0
+
+        mins = minimum_filter1d(rows, window_size)[positions + offset]
+        ranges = maximum_filter1d(rows, window_size)[positions + offset] - mins
+        ranges[ranges == 0] = 1
+
+        # Mean of the min-max scaled values of a segment is (segment mean - min) / range
+        reduced = (segment_sums - mins[:, None] * segment_lengths) / ranges[:, None] / np.sqrt(segment_lengths)
+        reduced[has_nan] = 0
+        reduced_windows.append(reduced.astype(np.float32))
+
+    return np.concatenate(reduced_windows)
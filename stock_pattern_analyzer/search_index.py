@@ -1,16 +1,33 @@
 import abc
 import pickle
-from typing import Tuple
+import time
+from typing import Dict, Optional, Tuple
 
 import faiss
 import numpy as np
 from scipy.spatial.ckdtree import cKDTree
 
+from .index_tuning import create_ivfpq_index, default_ivfpq_parameters, tune_ivfpq_parameters
+
+
+def _read_faiss_index(file_path: str, mmap: bool) -> faiss.Index:
+    io_flags = faiss.IO_FLAG_MMAP if mmap else 0
+    return faiss.read_index(str(file_path), io_flags)
+
+
+def _create_id_selector(allowed_ids: np.ndarray) -> Tuple[faiss.IDSelector, np.ndarray]:
+    # faiss does not keep a reference to the bitmap, so it is returned as well, and it has to be kept alive until the
+    # search is done
+    bitmap = np.packbits(allowed_ids, bitorder="little")
+    return faiss.IDSelectorBitmap(len(allowed_ids), faiss.swig_ptr(bitmap)), bitmap
+
 
 class _BaseIndex:
 
     def __init__(self):
         self.index = None
+        # Stage (e.g. train, add) -> seconds of the last create
+        self.build_times: Dict[str, float] = {}
 
     @abc.abstractmethod
     def create(self, X: np.ndarray) -> None:
@@ -24,6 +41,31 @@ class _BaseIndex:
         """
         raise NotImplementedError()
 
+    @abc.abstractmethod
+    def add(self, X: np.ndarray) -> None:
+        """
+        This method adds new rows to an already created index. The new rows get the next indices (after the existing
+        ones)
+        Args:
+            X: Data [n_rows, n_features]
+
+        Returns:
+            None
+        """
+        raise NotImplementedError()
+
+    def replace(self, ids: np.ndarray, X: np.ndarray) -> None:
+        """
+        Replaces rows of the index (e.g. windows with revised values), the indices of the rows do not change
+        Args:
+            ids: indices of the rows
+            X: new rows [len(ids), n_features]
+
+        Returns:
+            None
+        """
+        raise NotImplementedError(f"Rows of {type(self).__name__} can not be replaced")
+
     @abc.abstractmethod
     def query(self, q: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
         """
@@ -37,9 +79,34 @@ class _BaseIndex:
         """
         raise NotImplementedError()
 
+    @abc.abstractmethod
+    def query_batch(self, Q: np.ndarray, k: int,
+                    allowed_ids: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        This method allows us to query multiple vectors at once from the index
+        Args:
+            Q: query vectors [n_queries, n_features]
+            k: number of matches to return for every query
+            allowed_ids: boolean mask of the indices (from X) which can be returned, all of them if not set.
+                If there are less than k allowed matches, then the missing indices are -1
+
+        Returns:
+            Results as a tuple: distances [n_queries, k], indices (from X) [n_queries, k]
+        """
+        raise NotImplementedError()
+
     @classmethod
     @abc.abstractmethod
-    def load(cls, file_path: str) -> "_BaseIndex":
+    def load(cls, file_path: str, mmap: bool = False) -> "_BaseIndex":
+        """
+        Loads a serialized index
+        Args:
+            file_path: path of the serialized index
+            mmap: memory map the index data instead of reading it to the memory (if the index type supports it)
+
+        Returns:
+            the loaded index
+        """
         raise NotImplementedError()
 
     @abc.abstractmethod
@@ -53,16 +120,29 @@ class FastIndex(_BaseIndex):
         super().__init__()
 
     def create(self, X: np.ndarray):
+        start_time = time.perf_counter()
         self.index = faiss.IndexFlatL2(X.shape[-1])
         self.index.add(X)
+        self.build_times = {"add": time.perf_counter() - start_time}
+
+    def add(self, X: np.ndarray):
+        self.index.add(X)
 
     def query(self, q: np.ndarray, k: int):
         distances, indices = self.index.search(q, k)
         return distances[0], indices[0]
 
+    def query_batch(self, Q: np.ndarray, k: int, allowed_ids: Optional[np.ndarray] = None):
+        if allowed_ids is None:
+            return self.index.search(Q, k)
+        id_selector, _bitmap = _create_id_selector(allowed_ids)
+        return self.index.search(Q, k, params=faiss.SearchParameters(sel=id_selector))
+
     @classmethod
-    def load(cls, file_path: str):
-        faiss.read_index(str(file_path))
+    def load(cls, file_path: str, mmap: bool = False):
+        obj = cls()
+        obj.index = _read_faiss_index(file_path, mmap)
+        return obj
 
     def serialize(self, file_path: str):
         faiss.write_index(self.index, str(file_path))
@@ -70,33 +150,66 @@ class FastIndex(_BaseIndex):
 
 class MemoryEfficientIndex(_BaseIndex):
 
-    def __init__(self):
+    def __init__(self, recall_target: Optional[float] = None, latency_budget: Optional[float] = None):
+        """
+        Args:
+            recall_target: if set, then the IVF-PQ parameters are tuned to reach this recall@10 (measured on a sample
+                of the data), otherwise the default parameters are used
+            latency_budget: maximum latency of a query (in seconds) for the tuning
+        """
+
         super().__init__()
+        self.recall_target = recall_target
+        self.latency_budget = latency_budget
+        # Parameters of the created index (nlist, m, nbits, nprobe and the tuning results)
+        self.params = None
 
     def create(self, X: np.ndarray):
-        d = X.shape[-1]
-        # TODO: refine this as this is just a dummy selection for "m"
-        if d % 4 == 0:
-            m = 4
-        elif d % 5 == 0:
-            m = 5
-        elif d % 2 == 0:
-            m = 2
+        start_time = time.perf_counter()
+        if self.recall_target is not None:
+            self.params = tune_ivfpq_parameters(X, recall_target=self.recall_target, latency_budget=self.latency_budget)
         else:
-            raise ValueError("This is not handled, can not find a good value for m")
-        quantizer = faiss.IndexFlatL2(d)
-        self.index = faiss.IndexIVFPQ(quantizer, d, 100, m, 8)
+            self.params = default_ivfpq_parameters(*X.shape)
+        tune_time = time.perf_counter()
+        self.index = create_ivfpq_index(X.shape[-1], self.params["nlist"], self.params["m"], self.params["nbits"])
         self.index.train(X)
+        train_time = time.perf_counter()
         self.index.add(X)
+        self.index.nprobe = self.params["nprobe"]
+        self.build_times = {"tune": tune_time - start_time,
+                            "train": train_time - tune_time,
+                            "add": time.perf_counter() - train_time}
+
+    def add(self, X: np.ndarray):
+        # The already trained quantizers are used for the new rows
+        self.index.add(X)
+
+    def replace(self, ids: np.ndarray, X: np.ndarray):
+        # The inverted lists store the ids, so the rows can be removed and added again with the same ids
+        ids = np.asarray(ids, dtype=np.int64)
+        self.index.remove_ids(faiss.IDSelectorArray(len(ids), faiss.swig_ptr(ids)))
+        self.index.add_with_ids(X, ids)
 
     def query(self, q: np.ndarray, k: int):
         distances, indices = self.index.search(q, k)
         return distances[0], indices[0]
 
+    def query_batch(self, Q: np.ndarray, k: int, allowed_ids: Optional[np.ndarray] = None):
+        if allowed_ids is None:
+            return self.index.search(Q, k)
+        id_selector, _bitmap = _create_id_selector(allowed_ids)
+        # The probed lists contain only a few allowed ids if the filter is selective (e.g. a single symbol), so more
+        # lists are probed: as many allowed ids are expected as in the lists of an unfiltered search
+        nb_allowed_ids = max(int(np.count_nonzero(allowed_ids)), 1)
+        nprobe = min(self.index.nlist, int(np.ceil(self.index.nprobe * self.index.ntotal / nb_allowed_ids)))
+        # The search parameters override the ones of the index, so nprobe is set as well
+        params = faiss.SearchParametersIVF(sel=id_selector, nprobe=nprobe)
+        return self.index.search(Q, k, params=params)
+
     @classmethod
-    def load(cls, file_path: str):
+    def load(cls, file_path: str, mmap: bool = False):
         obj = cls()
-        obj.index = faiss.read_index(str(file_path))
+        obj.index = _read_faiss_index(file_path, mmap)
         return obj
 
     def serialize(self, file_path: str):
@@ -109,14 +222,27 @@ class cKDTreeIndex(_BaseIndex):
         super().__init__()
 
     def create(self, X: np.ndarray):
+        start_time = time.perf_counter()
         self.index = cKDTree(data=X)
+        self.build_times = {"add": time.perf_counter() - start_time}
+
+    def add(self, X: np.ndarray):
+        raise NotImplementedError("cKDTree can not be extended, it needs to be created again")
 
     def query(self, q: np.ndarray, k: int):
         top_k_distances, top_k_indices = self.index.query(x=q, k=k)
         return top_k_distances, top_k_indices
 
+    def query_batch(self, Q: np.ndarray, k: int, allowed_ids: Optional[np.ndarray] = None):
+        if allowed_ids is not None:
+            raise NotImplementedError("cKDTree does not support filtered search")
+        top_k_distances, top_k_indices = self.index.query(x=Q, k=k)
+        # With k=1 the results are not 2 dimensional
+        return top_k_distances.reshape(len(Q), k), top_k_indices.reshape(len(Q), k)
+
     @classmethod
-    def load(cls, file_path: str):
+    def load(cls, file_path: str, mmap: bool = False):
+        # The pickled tree can not be memory mapped, mmap is ignored
         obj = cls()
         with open(file_path, "rb") as f:
             obj.index = pickle.load(f)
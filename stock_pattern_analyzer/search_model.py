@@ -1,71 +1,189 @@
-import pickle
+import json
+import os
+import shutil
+import time
 from datetime import datetime
 from pathlib import Path
+from typing import Dict, Optional, Sequence, Tuple
 
 import numpy as np
-from sklearn.preprocessing import minmax_scale
 
-from .data import RawStockDataHolder
-from .search_index import MemoryEfficientIndex
+from .data import (MANIFEST_FILE_NAME, VALUE_COLUMN, RawStockDataHolder, concatenate_ranges, find_latest_serialized,
+                   to_day_numbers)
+from .dtw import DTWSearchStats, dtw_distances, get_band, to_time_major
+from .reduction import create_paa_windows, paa_transform
+from .search_index import FastIndex, MemoryEfficientIndex, cKDTreeIndex
 
 MINIMUM_WINDOW_SIZE = 5
+# With a reduced index, this many times more candidates are searched than requested, and they are re-ranked
+DEFAULT_OVERFETCH_FACTOR = 10
+# Width of the Sakoe-Chiba band of the DTW search, as a fraction of the window size
+DEFAULT_DTW_BAND_FRACTION = 0.1
+# Filtered searches with at most this many allowed windows (e.g. a few symbols) are exact searches over the allowed
+# windows, instead of an index search
+EXACT_FILTERED_SEARCH_MAX_IDS = 20000
+
+INDEX_FILE_NAME = "index.bin"
+INDEX_CLASSES = {index_class.__name__: index_class for index_class in (FastIndex, MemoryEfficientIndex, cKDTreeIndex)}
+
+
+def _minmax_scale_rows(X: np.ndarray) -> np.ndarray:
+    """
+    In-place min-max scaling of every row to the [0, 1] range. Constant rows become all zeros
+    Args:
+        X: Data [n_rows, n_features]
+
+    Returns:
+        the scaled X
+    """
+
+    mins = X.min(axis=1, keepdims=True)
+    ranges = X.max(axis=1, keepdims=True) - mins
+    ranges[ranges == 0] = 1
+    X -= mins
+    X /= ranges
+    return X
+
+
+def _minmax_scale_channels(X: np.ndarray, nb_channels: int) -> np.ndarray:
+    """
+    Min-max scaling of every channel of the rows separately (see _minmax_scale_rows), in-place if X is contiguous
+    Args:
+        X: Data [n_rows, nb_channels * n_features], the channels are concatenated
+        nb_channels: number of channels
+
+    Returns:
+        the scaled X
+    """
+
+    return _minmax_scale_rows(X.reshape(len(X) * nb_channels, -1)).reshape(X.shape)
+
+
+def _get_channels(channels: Optional[Sequence[str]]) -> Tuple[str, ...]:
+    return tuple(channels) if channels else (VALUE_COLUMN,)
 
 
 class SearchModel:
-    def __init__(self, data_holder: RawStockDataHolder, window_size: int):
+    def __init__(self,
+                 data_holder: RawStockDataHolder,
+                 window_size: int,
+                 recall_target: Optional[float] = None,
+                 latency_budget: Optional[float] = None,
+                 nb_segments: Optional[int] = None,
+                 overfetch_factor: int = DEFAULT_OVERFETCH_FACTOR,
+                 channels: Optional[Sequence[str]] = None):
+        """
+        Args:
+            data_holder: the data holder which is searched
+            window_size: size of the search windows
+            recall_target: if set, then the index parameters are tuned for it (see MemoryEfficientIndex)
+            latency_budget: maximum latency of a query (in seconds) for the tuning
+            nb_segments: if set, then the index stores the Piecewise Aggregate Approximation of the windows with this
+                many segments instead of the windows (reduced index), and the candidates of the search are re-ranked
+                with the exact distances. This makes the index of long windows much smaller
+            overfetch_factor: with a reduced index, overfetch_factor * k candidates are re-ranked
+            channels: columns of the data holder (e.g. Close and Volume) which are matched. Every channel of a window is
+                min-max scaled separately, and the index stores the concatenated channels. Only the Close column if
+                not set
+        """
+
         if window_size < MINIMUM_WINDOW_SIZE:
             raise ValueError(f"Window size is too small. Minimum is {MINIMUM_WINDOW_SIZE}")
+        if (nb_segments is not None) and not (1 <= nb_segments <= window_size):
+            raise ValueError(f"Number of segments should be between 1 and the window size ({window_size})")
+        channels = _get_channels(channels)
+        if len(set(channels)) != len(channels):
+            raise ValueError(f"Channels should be unique: {channels}")
 
         self.window_size = window_size
         self._data_holder = data_holder
+        self.recall_target = recall_target
+        self.latency_budget = latency_budget
+        self.nb_segments = nb_segments
+        self.overfetch_factor = overfetch_factor
+        self.channels = channels
 
         # This is the object we can use for querying
         self.index = None
-        # TODO: solve this more efficiently without wasting memory
-        # This stores the start and end indices in the original array of the windows
-        self.start_end_indices_in_original_array = None
-        # This stores the ticket symbol label associated with every window
-        self.labels = None
+        # Windows are added to the index in blocks (the first one is the whole build, then the incremental updates).
+        # Inside a block the windows are stored label after label, so window_offsets[block, label] is the index of the
+        # first window of the given label (and window_offsets[block, label + 1] is the end). Labels and start/end
+        # indices are computed from this, together with the number of valid values at the time of the block creation
+        self.window_offsets = None
+        self.nb_of_valid_values_at_build = None
         # This shows if the index is created or not
         self.is_built = False
+        # Folder of the serialized model (set by serialize and load)
+        self.file_path = None
+        # Stage (windowing, and the stages of the index, e.g. train, add) -> seconds of the last build or update, it is
+        # empty if the model was only loaded
+        self.build_times: Dict[str, float] = {}
+
+    def _get_nb_windows_per_label(self) -> np.ndarray:
+        nb_of_valid_values = self._data_holder.nb_of_valid_values.astype(np.int64)
+        return np.maximum(nb_of_valid_values - self.window_size + 1, 0)
 
-    def _create_windows(self):
+    def _create_windows(self, nb_windows_per_label: np.ndarray):
         """
-        Create the sliding windows from the stock dara
+        Create the sliding windows from the stock data
+        Args:
+            nb_windows_per_label: number of (most recent) windows to create for every label
+
         Returns:
-            windows as a numpy array [n_samples, window_size]
+            windows as a numpy array [n_samples, nb_channels * window_size]
         """
 
         if not self._data_holder.is_filled:
             raise ValueError("Data holder needs to be filled first")
 
-        windows = []
-        self.start_end_indices_in_original_array = []
-        self.labels = []
-
-        # TODO: this for-loop should be vectorized
-        for symbol in self._data_holder.ticker_symbols:
-            label = self._data_holder.symbol_to_label[symbol]
-            nb_valid_values = self._data_holder.nb_of_valid_values[label]
-
-            symbol_values = self._data_holder.values[label][:nb_valid_values]
-            # Vectorized sliding window creation
-            window_indices = np.arange(symbol_values.shape[0] - self.window_size + 1)[:, None] + np.arange(
-                self.window_size)
-            windows.extend(symbol_values[window_indices])
-            self.start_end_indices_in_original_array.extend(window_indices[:, (0, -1)])
-            self.labels.extend([label] * len(window_indices))
+        # Positions (in the concatenated values) of the requested windows, which are the most recent windows of every
+        # label, so they never reach into the next row
+        positions = concatenate_ranges(self._data_holder.offsets[:-1], nb_windows_per_label)
+        if len(positions) == 0:
+            return np.zeros((0, len(self.channels) * self.window_size), dtype=np.float32)
+
+        windows = None
+        for i, channel in enumerate(self.channels):
+            # Strided view (no copy) with every possible window of the concatenated values [n_positions, window_size]
+            all_windows = np.lib.stride_tricks.sliding_window_view(self._data_holder.get_column(channel),
+                                                                   self.window_size)
+            if len(self.channels) == 1:
+                windows = all_windows[positions].astype(np.float32, copy=False)
+            else:
+                if windows is None:
+                    windows = np.empty((len(positions), len(self.channels) * self.window_size), dtype=np.float32)
+                windows[:, i * self.window_size:(i + 1) * self.window_size] = all_windows[positions]
 
-        self.start_end_indices_in_original_array = np.array(self.start_end_indices_in_original_array)
-        self.labels = np.array(self.labels)
-
-        windows = np.array(windows)
         # Separate windows should be normalized, so it is comparable within a given window size (time-frame)
-        windows = minmax_scale(windows, feature_range=(0, 1), axis=1)
-        windows = np.nan_to_num(windows)
+        windows = _minmax_scale_channels(windows, len(self.channels))
+        # Same as np.nan_to_num, but without its (window matrix sized) temporary arrays
+        np.copyto(windows, 0, where=np.isnan(windows))
 
         return windows
 
+    def _create_index_vectors(self, nb_windows_per_label: np.ndarray) -> np.ndarray:
+        # These are the vectors which are stored in the index
+        if self.nb_segments is None:
+            return self._create_windows(nb_windows_per_label)
+
+        if not self._data_holder.is_filled:
+            raise ValueError("Data holder needs to be filled first")
+        return np.hstack([create_paa_windows(self._data_holder.get_column(channel), self._data_holder.offsets,
+                                             self.window_size, self.nb_segments, nb_windows_per_label)
+                          for channel in self.channels])
+
+    def _add_window_block(self, nb_windows_per_label: np.ndarray):
+        block_start_index = 0 if self.window_offsets is None else self.window_offsets[-1, -1]
+        window_offsets = block_start_index + np.concatenate([[0], np.cumsum(nb_windows_per_label)])
+        nb_of_valid_values = self._data_holder.nb_of_valid_values.astype(np.int64)
+
+        if self.window_offsets is None:
+            self.window_offsets = window_offsets[None]
+            self.nb_of_valid_values_at_build = nb_of_valid_values[None]
+        else:
+            self.window_offsets = np.vstack([self.window_offsets, window_offsets])
+            self.nb_of_valid_values_at_build = np.vstack([self.nb_of_valid_values_at_build, nb_of_valid_values])
+
     def build_index(self):
         """
         Build the search index
@@ -74,98 +192,597 @@ class SearchModel:
             None
         """
 
-        X = self._create_windows()
-        self.index = MemoryEfficientIndex()
-        self.index.create(X.astype(np.float32))
+        start_time = time.perf_counter()
+        nb_windows_per_label = self._get_nb_windows_per_label()
+        X = self._create_index_vectors(nb_windows_per_label)
+        windowing_time = time.perf_counter() - start_time
+        self.index = MemoryEfficientIndex(recall_target=self.recall_target, latency_budget=self.latency_budget)
+        self.index.create(X)
+        self.window_offsets = None
+        self._add_window_block(nb_windows_per_label)
         self.is_built = True
+        self.build_times = {"windowing": windowing_time, **self.index.build_times}
+
+    def _get_window_ids(self, label: int, start_indices: np.ndarray) -> np.ndarray:
+        # Inverse of get_window_labels_and_start_indices for the indexed windows of a label (-1 if not indexed)
+        ids = np.full(len(start_indices), -1, dtype=np.int64)
+        nb_of_valid_values = int(self._data_holder.nb_of_valid_values[label])
+        for block in range(len(self.window_offsets)):
+            block_start_indices = start_indices - (nb_of_valid_values - self.nb_of_valid_values_at_build[block, label])
+            nb_block_windows = self.window_offsets[block, label + 1] - self.window_offsets[block, label]
+            is_in_block = (block_start_indices >= 0) & (block_start_indices < nb_block_windows)
+            ids[is_in_block] = self.window_offsets[block, label] + block_start_indices[is_in_block]
+        return ids
+
+    def _replace_revised_windows(self) -> int:
+        """
+        Re-creates the indexed windows which contain a revised value of the data holder (see
+        RawStockDataHolder.revised_bars), and replaces them in the index
+
+        Returns:
+            number of replaced windows
+        """
+
+        nb_windows_per_label = self._get_nb_windows_per_label()
+        labels = []
+        start_indices = []
+        for label, day in sorted(self._data_holder.revised_bars.items()):
+            positions = np.flatnonzero(self._data_holder.get_row_dates(label) == day)
+            if len(positions) == 0:
+                continue
+            # Windows starting at most window_size - 1 values before the revised value contain it
+            label_start_indices = np.arange(max(positions[0] - self.window_size + 1, 0),
+                                            min(positions[0] + 1, nb_windows_per_label[label]))
+            labels.append(np.full(len(label_start_indices), label))
+            start_indices.append(label_start_indices)
+        if len(labels) == 0:
+            return 0
+
+        labels = np.concatenate(labels)
+        start_indices = np.concatenate(start_indices)
+        ids = np.concatenate([self._get_window_ids(label, start_indices[labels == label])
+                              for label in np.unique(labels)])
+        # The windows which are not indexed yet are added as new windows
+        is_indexed = ids >= 0
+        if not np.any(is_indexed):
+            return 0
+
+        # The most recent windows of the labels are created (up to the oldest revised one), they are label after label,
+        # in the order of the start indices
+        nb_created_windows = np.zeros(len(nb_windows_per_label), dtype=np.int64)
+        np.maximum.at(nb_created_windows, labels, start_indices + 1)
+        X = self._create_index_vectors(nb_created_windows)
+        rows = np.concatenate([[0], np.cumsum(nb_created_windows)])[labels] + start_indices
+        self.index.replace(ids[is_indexed], X[rows[is_indexed]])
+        return int(np.count_nonzero(is_indexed))
+
+    def add_new_windows(self) -> int:
+        """
+        Adds the windows of the new values (after the data holder is updated) to the already built index. The indexed
+        windows with revised values (see RawStockDataHolder.revised_bars) are replaced
 
-    def search(self, values: np.ndarray, k: int = 5) -> tuple:
+        Returns:
+            number of added windows
+        """
+
+        if not self.is_built:
+            raise ValueError("You need to build the search tree first")
+
+        nb_indexed_windows_per_label = np.diff(self.window_offsets, axis=1).sum(axis=0)
+        nb_new_windows_per_label = self._get_nb_windows_per_label() - nb_indexed_windows_per_label
+        if np.any(nb_new_windows_per_label < 0):
+            raise ValueError("The data holder has less windows than the index, the index needs to be built again")
+
+        start_time = time.perf_counter()
+        nb_replaced_windows = self._replace_revised_windows()
+        replace_time = time.perf_counter() - start_time
+        if nb_replaced_windows > 0:
+            print(f"{nb_replaced_windows} windows with revised values are replaced (size {self.window_size})")
+
+        if nb_new_windows_per_label.sum() == 0:
+            self.build_times = {"replace": replace_time}
+            return 0
+
+        start_time = time.perf_counter()
+        X = self._create_index_vectors(nb_new_windows_per_label)
+        add_start_time = time.perf_counter()
+        self.index.add(X)
+        self._add_window_block(nb_new_windows_per_label)
+        self.build_times = {"replace": replace_time,
+                            "windowing": add_start_time - start_time,
+                            "add": time.perf_counter() - add_start_time}
+        return len(X)
+
+    def get_query_values(self, labels: np.ndarray) -> np.ndarray:
+        """
+        Most recent windows of the labels, which can be used as queries
+        Args:
+            labels: labels of the queries
+
+        Returns:
+            values [n_labels, nb_channels * window_size] (the channels are concatenated), not scaled
+        """
+
+        return np.hstack([self._data_holder.get_most_recent_values(labels, self.window_size, column=channel)
+                          for channel in self.channels])
+
+    def search(self, values: np.ndarray, k: int = 5, allowed_ids: Optional[np.ndarray] = None) -> tuple:
         """
         Search in the data
         Args:
-            values: "query" data - not (min-max) scaled
+            values: "query" data (with every channel, see get_query_values) - not (min-max) scaled
             k: This is how many matches will be returned
+            allowed_ids: boolean mask of the windows which can be matches (see get_allowed_window_ids)
 
         Returns:
-            tuple: indices, distances
+            tuple: indices, distances (if there are less than k allowed matches, then they are shorter)
+        """
+
+        top_k_indices, top_k_distances = self.search_batch(values=values, k=k, allowed_ids=allowed_ids)
+        is_found = top_k_indices[0] >= 0
+        return top_k_indices[0][is_found], top_k_distances[0][is_found]
+
+    def search_batch(self,
+                     values: np.ndarray,
+                     k: int = 5,
+                     allowed_ids: Optional[np.ndarray] = None,
+                     stage_times: Optional[Dict[str, float]] = None) -> tuple:
+        """
+        Search with multiple queries at once (with a single index query)
+        Args:
+            values: "query" data [n_queries, nb_channels * window_size] (see get_query_values) - not (min-max)
+                scaled
+            k: This is how many matches will be returned for every query
+            allowed_ids: boolean mask of the windows which can be matches (see get_allowed_window_ids)
+            stage_times: if set, then the seconds of the normalize and index_search stages are added to it
+
+        Returns:
+            tuple: indices [n_queries, k], distances [n_queries, k] (missing matches have -1 indices)
         """
 
         if not self.is_built:
             raise ValueError("You need to build thh search tree first")
 
-        values = minmax_scale(values, feature_range=(0, 1))
-        if len(values.shape) == 1:
-            values = values.reshape(1, -1)
-        values = values.astype(np.float32)
+        start_time = time.perf_counter()
+        values = self._scale_queries(values)
+        if (allowed_ids is not None) and (np.count_nonzero(allowed_ids) <= EXACT_FILTERED_SEARCH_MAX_IDS):
+            # The approximate index would find only a few of the allowed windows with a selective filter
+            normalize_time = time.perf_counter()
+            top_k_indices, top_k_distances = self._search_allowed_windows(values, np.flatnonzero(allowed_ids), k)
+        elif self.nb_segments is None:
+            normalize_time = time.perf_counter()
+            top_k_distances, top_k_indices = self.index.query_batch(Q=values, k=k, allowed_ids=allowed_ids)
+        else:
+            # The candidates are searched with the reduced windows, then they are re-ranked with the exact distances
+            reduced_values = paa_transform(values.reshape(len(values) * len(self.channels), self.window_size),
+                                           self.nb_segments).reshape(len(values), -1)
+            normalize_time = time.perf_counter()
+            _, candidate_indices = self.index.query_batch(Q=reduced_values,
+                                                          k=k * self.overfetch_factor,
+                                                          allowed_ids=allowed_ids)
+            top_k_indices, top_k_distances = self._rerank(values, candidate_indices, k)
+
+        if stage_times is not None:
+            stage_times["normalize"] = stage_times.get("normalize", 0.0) + normalize_time - start_time
+            stage_times["index_search"] = (stage_times.get("index_search", 0.0) + time.perf_counter()
+                                           - normalize_time)
+        return top_k_indices, top_k_distances
+
+    def _search_allowed_windows(self, Q: np.ndarray, allowed_indices: np.ndarray, k: int) -> tuple:
+        """
+        Exact search in the given windows, the windows are created from the values of the data holder
+        Args:
+            Q: min-max scaled queries [n_queries, nb_channels * window_size]
+            allowed_indices: window indices which can be matched
+            k: number of matches
 
-        top_k_distances, top_k_indices = self.index.query(q=values, k=k)
-        top_k_distances = top_k_distances.ravel()
-        top_k_indices = top_k_indices.ravel()
+        Returns:
+            tuple: indices [n_queries, k], distances [n_queries, k] (missing matches have -1 indices)
+        """
 
+        windows = self._get_scaled_windows(allowed_indices)
+        distances = (np.sum(Q ** 2, axis=1)[:, None] - 2 * Q @ windows.T + np.sum(windows ** 2, axis=1)[None, :])
+        np.maximum(distances, 0, out=distances)
+
+        top_k_indices = np.full((len(Q), k), -1, dtype=np.int64)
+        top_k_distances = np.full((len(Q), k), np.finfo(np.float32).max, dtype=np.float32)
+        nb_matches = min(k, len(allowed_indices))
+        if nb_matches == 0:
+            return top_k_indices, top_k_distances
+        match_ids = np.argpartition(distances, nb_matches - 1, axis=1)[:, :nb_matches]
+        match_distances = np.take_along_axis(distances, match_ids, axis=1)
+        order = np.argsort(match_distances, axis=1, kind="stable")
+        top_k_indices[:, :nb_matches] = allowed_indices[np.take_along_axis(match_ids, order, axis=1)]
+        top_k_distances[:, :nb_matches] = np.take_along_axis(match_distances, order, axis=1)
         return top_k_indices, top_k_distances
 
-    def get_window_symbol_label(self, index: int):
-        return self.labels[index]
+    def _scale_queries(self, values: np.ndarray) -> np.ndarray:
+        # Copy is needed, as the values can be a view of the data holder arrays
+        values = np.array(values, dtype=np.float32, ndmin=2)
+        if values.shape[1] != len(self.channels) * self.window_size:
+            raise ValueError(f"Queries should have {len(self.channels)} * {self.window_size} values")
+        values = _minmax_scale_channels(values, len(self.channels))
+        # Missing values (e.g. of an extra column) are handled as in the windows
+        np.copyto(values, 0, where=np.isnan(values))
+        return values
+
+    def _get_scaled_windows(self, indices: np.ndarray) -> np.ndarray:
+        # Same windows as in the index (see _create_windows), but they are created from the values of the data holder
+        labels, start_indices = self.get_window_labels_and_start_indices(indices)
+        windows = np.hstack([self._data_holder.get_windows_values(labels, start_indices, self.window_size,
+                                                                  column=channel)[0]
+                             for channel in self.channels])
+        windows = _minmax_scale_channels(windows, len(self.channels))
+        np.copyto(windows, 0, where=np.isnan(windows))
+        return windows
+
+    def search_dtw_batch(self,
+                         values: np.ndarray,
+                         k: int = 5,
+                         allowed_ids: Optional[np.ndarray] = None,
+                         band_fraction: float = DEFAULT_DTW_BAND_FRACTION,
+                         overfetch_factor: int = DEFAULT_OVERFETCH_FACTOR,
+                         stats: Optional[DTWSearchStats] = None) -> tuple:
+        """
+        Search with the DTW distance (with a Sakoe-Chiba band), so the matches can be slightly shifted in time. The
+        candidates are the overfetch_factor * k nearest windows of the index, and they are re-ranked with the DTW
+        distance (of every candidate, without pruning, see dtw_distances). The channels share the warping path
+        Args:
+            values: "query" data [n_queries, nb_channels * window_size] (see get_query_values) - not (min-max)
+                scaled
+            k: This is how many matches will be returned for every query
+            allowed_ids: boolean mask of the windows which can be matches (see get_allowed_window_ids)
+            band_fraction: width of the band, as a fraction of the window size
+            overfetch_factor: number of candidates per match
+            stats: if set, then the counters and stage times of the search are added to it
+
+        Returns:
+            tuple: indices [n_queries, k], DTW distances [n_queries, k] (missing matches have -1 indices)
+        """
+
+        stats = stats if stats is not None else DTWSearchStats()
+        start_time = time.perf_counter()
+        candidate_indices, _ = self.search_batch(values, k=k * overfetch_factor, allowed_ids=allowed_ids)
+        Q = self._scale_queries(values).reshape(len(candidate_indices), len(self.channels), self.window_size)
+        is_found = candidate_indices >= 0
+        windows = self._get_scaled_windows(candidate_indices[is_found])
+        windows = windows.reshape(len(windows), len(self.channels), self.window_size)
+        dtw_start_time = time.perf_counter()
+        stats.stage_times["candidates"] += dtw_start_time - start_time
+
+        band = get_band(self.window_size, band_fraction)
+        top_k_indices = np.full((len(Q), k), -1, dtype=np.int64)
+        top_k_distances = np.full((len(Q), k), np.finfo(np.float32).max, dtype=np.float32)
+        stats.nb_queries += len(Q)
+        # The candidates of every query are processed together
+        distances = np.full(candidate_indices.shape, np.inf)
+        distances[is_found] = dtw_distances(to_time_major(np.repeat(Q, is_found.sum(axis=1), axis=0)),
+                                            to_time_major(windows), band)
+        order = np.argsort(distances, axis=1, kind="stable")[:, :k]
+        top_k_indices[:, :order.shape[1]] = np.take_along_axis(np.where(is_found, candidate_indices, -1), order, axis=1)
+        is_match = top_k_indices[:, :order.shape[1]] >= 0
+        top_k_distances[:, :order.shape[1]][is_match] = np.take_along_axis(distances, order, axis=1)[is_match]
+        stats.nb_candidates += len(windows)
+        stats.stage_times["dtw"] += time.perf_counter() - dtw_start_time
+        return top_k_indices, top_k_distances
+
+    def _rerank(self, Q: np.ndarray, candidate_indices: np.ndarray, k: int) -> tuple:
+        """
+        Re-ranks the candidates with the exact distances, which are calculated from the values of the data holder
+        Args:
+            Q: min-max scaled queries [n_queries, nb_channels * window_size]
+            candidate_indices: window indices of the candidates [n_queries, n_candidates] (missing ones are -1)
+            k: number of matches to keep
+
+        Returns:
+            tuple: indices [n_queries, k], distances [n_queries, k] (missing matches have -1 indices)
+        """
+
+        is_found = candidate_indices >= 0
+        windows = self._get_scaled_windows(np.maximum(candidate_indices, 0).ravel())
+
+        distances = np.sum((windows.reshape(candidate_indices.shape + (Q.shape[1],)) - Q[:, None, :]) ** 2, axis=2)
+        # Missing matches get the same distance as from faiss
+        distances[~is_found] = np.finfo(np.float32).max
+        order = np.argsort(distances, axis=1, kind="stable")[:, :k]
+        top_k_indices = np.take_along_axis(np.where(is_found, candidate_indices, -1), order, axis=1)
+        return top_k_indices, np.take_along_axis(distances, order, axis=1)
+
+    def get_allowed_window_ids(self,
+                               labels: Optional[np.ndarray] = None,
+                               start_date: Optional[np.datetime64] = None,
+                               end_date: Optional[np.datetime64] = None) -> Optional[np.ndarray]:
+        """
+        Creates the filter of the filtered search. The windows of a label are stored contiguously (in every block), and
+        the windows within a date range are contiguous too, so the filter is a set of window index ranges
+        Args:
+            labels: labels of the symbols which can be matched, all of them if not set
+            start_date: the windows have to start on or after this date
+            end_date: the windows have to end on or before this date
+
+        Returns:
+            boolean mask of the allowed windows, or None if there is no filtering
+        """
+
+        if (labels is None) and (start_date is None) and (end_date is None):
+            return None
+
+        nb_labels = self.window_offsets.shape[1] - 1
+        nb_of_valid_values = self._data_holder.nb_of_valid_values.astype(np.int64)
+        is_allowed_label = np.ones(nb_labels, dtype=bool)
+        if labels is not None:
+            is_allowed_label = np.isin(np.arange(nb_labels), labels)
+
+        # Allowed start indices (relative to the most recent value) for every label, the dates are in descending order
+        min_start_indices = np.zeros(nb_labels, dtype=np.int64)
+        max_start_indices = nb_of_valid_values - self.window_size
+        if (start_date is not None) or (end_date is not None):
+            dates = np.asarray(self._data_holder.dates)
+            offsets = np.asarray(self._data_holder.offsets)
+            counts = np.zeros(len(dates) + 1, dtype=np.int64)
+            if end_date is not None:
+                # The most recent value of a window is at its start index
+                np.cumsum(dates > to_day_numbers(end_date), out=counts[1:])
+                min_start_indices = counts[offsets[1:]] - counts[offsets[:-1]]
+            if start_date is not None:
+                np.cumsum(dates >= to_day_numbers(start_date), out=counts[1:])
+                nb_values_from_start_date = counts[offsets[1:]] - counts[offsets[:-1]]
+                max_start_indices = np.minimum(max_start_indices, nb_values_from_start_date - self.window_size)
+
+        # Start indices are shifted by the values which were added since the block was created
+        shifts = nb_of_valid_values[None, :] - self.nb_of_valid_values_at_build
+        nb_windows = np.diff(self.window_offsets, axis=1)
+        first_windows = np.maximum(min_start_indices[None, :] - shifts, 0)
+        last_windows = np.minimum(max_start_indices[None, :] - shifts, nb_windows - 1)
+        is_allowed_range = is_allowed_label[None, :] & (first_windows <= last_windows)
+
+        range_starts = (self.window_offsets[:, :-1] + first_windows)[is_allowed_range]
+        range_ends = (self.window_offsets[:, :-1] + last_windows + 1)[is_allowed_range]
+        # The ranges do not overlap, so the mask is the cumulative sum of the range starts and ends
+        changes = np.zeros(self.window_offsets[-1, -1] + 1, dtype=np.int8)
+        changes[range_starts] += 1
+        changes[range_ends] -= 1
+        return np.cumsum(changes[:-1], dtype=np.int8) > 0
+
+    def get_window_labels_and_start_indices(self, indices: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Vectorized version of get_window_label_and_start_index
+        Args:
+            indices: window indices (from the search)
+
+        Returns:
+            tuple: labels, start indices (in the data holder rows)
+        """
+
+        indices = np.asarray(indices, dtype=np.int64)
+        nb_labels = self.window_offsets.shape[1] - 1
+        # The end of a block is the start of the next one, so without the ends the offsets are sorted (block by block)
+        flat_window_offsets = self.window_offsets[:, :-1].ravel()
+        positions = np.searchsorted(flat_window_offsets, indices, side="right") - 1
+        blocks, labels = np.divmod(positions, nb_labels)
+
+        start_indices = indices - flat_window_offsets[positions]
+        # The start index is relative to the most recent value, which changes when new values are added
+        start_indices += self._data_holder.nb_of_valid_values[labels] - self.nb_of_valid_values_at_build[blocks, labels]
+        return labels, start_indices
+
+    def get_windows_data(self, indices: np.ndarray, future_length: int = 0) -> tuple:
+        """
+        Vectorized version of the window accessors (get_window_symbol_label, get_start_end_date, get_window_values)
+        Args:
+            indices: window indices (from the search)
+            future_length: number of future values before the windows
+
+        Returns:
+            tuple: labels, start indices, start dates, end dates, window values with future values
+            [n_windows, future_length + window_size] (padded as RawStockDataHolder.get_windows_values), number of future
+            values
+        """
+
+        labels, start_indices = self.get_window_labels_and_start_indices(indices)
+        start_dates, end_dates = self._data_holder.get_windows_start_end_dates(labels, start_indices, self.window_size)
+        values, nb_future_values = self._data_holder.get_windows_values(labels, start_indices, self.window_size,
+                                                                        future_length)
+        return labels, start_indices, start_dates, end_dates, values, nb_future_values
+
+    def get_window_label_and_start_index(self, index: int) -> Tuple[int, int]:
+        labels, start_indices = self.get_window_labels_and_start_indices(np.array([index]))
+        return int(labels[0]), int(start_indices[0])
+
+    def get_window_symbol_label(self, index: int) -> int:
+        label, _ = self.get_window_label_and_start_index(index)
+        return label
 
     def get_window_symbol(self, index: int) -> str:
         label = self.get_window_symbol_label(index)
         return self._data_holder.label_to_symbol[label]
 
-    def _get_label_and_start_end_indices(self, index: int, future_length: int):
-        start_index, end_index = self.start_end_indices_in_original_array[index]
-        label = self.get_window_symbol_label(index)
-
-        if future_length > 0:
-            start_index -= future_length
-            if start_index < 0:
-                start_index = 0
-        return label, start_index, end_index
-
     def get_window_dates(self, index: int, future_length: int = 0) -> np.ndarray:
-        label, start_index, end_index = self._get_label_and_start_end_indices(index, future_length)
-        dates = self._data_holder.dates[label][start_index:end_index + 1]
-        return dates
+        label, start_index = self.get_window_label_and_start_index(index)
+        return self._data_holder.get_window_dates(label, start_index, self.window_size, future_length)
 
     def get_window_values(self, index: int, future_length: int = 0):
-        label, start_index, end_index = self._get_label_and_start_end_indices(index, future_length)
-        values = self._data_holder.values[label][start_index:end_index + 1]
-        return values
+        label, start_index = self.get_window_label_and_start_index(index)
+        return self._data_holder.get_window_values(label, start_index, self.window_size, future_length)
 
     def get_start_end_date(self, index: int, future_length: int = 0) -> tuple:
         dates = self.get_window_dates(index, future_length)
         return dates[0], dates[-1]
 
+    def get_index_nbytes(self) -> Optional[int]:
+        """
+        Returns:
+            size of the serialized index in bytes (a memory mapped index uses this much memory at most), None if the
+            model is not serialized
+        """
+
+        if self.file_path is None:
+            return None
+        return (Path(self.file_path) / INDEX_FILE_NAME).stat().st_size
+
     def create_filename_for_today(self) -> str:
         current_date = datetime.now().strftime("%Y_%m_%d")
-        file_name = f"search_tree_{self.window_size}win_{current_date}.pk"
+        file_name = f"search_tree_{self.window_size}win_{current_date}"
         return file_name
 
+    def create_file_pattern(self) -> str:
+        return f"search_tree_{self.window_size}win_*"
+
     def serialize(self) -> str:
+        """
+        Saves the search model as a folder: the index is written with its own serialization method (faiss.write_index
+        for the faiss based indices), the window offsets are stored as a numpy sidecar and the rest in a json manifest.
+        The data holder is not part of it, that is serialized separately
+        Returns:
+            path of the created folder
+        """
+
         if not self.is_built:
             raise ValueError("You need to build the tree first")
 
-        file_name = self.create_filename_for_today()
-        with open(file_name, "wb") as f:
-            pickle.dump(self, f)
+        folder_path = Path(self.create_filename_for_today())
+        # Everything is written to a temporary folder first, so other processes never see a half-written model
+        tmp_folder_path = folder_path.with_name(f"{folder_path.name}.tmp{os.getpid()}")
+        tmp_folder_path.mkdir()
 
-        return file_name
+        self.index.serialize(str(tmp_folder_path / INDEX_FILE_NAME))
+        np.save(tmp_folder_path / "window_offsets.npy", self.window_offsets)
+        np.save(tmp_folder_path / "nb_of_valid_values_at_build.npy", self.nb_of_valid_values_at_build)
+
+        manifest = {"window_size": self.window_size,
+                    "index_class": type(self.index).__name__,
+                    "data_holder_filled_at": self._data_holder.filled_at,
+                    "index_params": getattr(self.index, "params", None),
+                    "nb_segments": self.nb_segments,
+                    "overfetch_factor": self.overfetch_factor,
+                    "channels": list(self.channels)}
+        (tmp_folder_path / MANIFEST_FILE_NAME).write_text(json.dumps(manifest))
+
+        if folder_path.exists():
+            shutil.rmtree(folder_path)
+        tmp_folder_path.rename(folder_path)
+
+        self.file_path = str(folder_path)
+        return str(folder_path)
 
     @staticmethod
-    def load(file_name: str) -> "SearchModel":
-        with open(file_name, "rb") as f:
-            obj = pickle.load(f)
+    def load(file_name: str, data_holder: RawStockDataHolder, mmap: bool = True) -> "SearchModel":
+        """
+        Loads a serialized search model
+        Args:
+            file_name: folder created with the serialize method
+            data_holder: the data holder which was used to build the model
+            mmap: memory map the index (faiss IO_FLAG_MMAP) instead of reading it to the memory
+
+        Returns:
+            the loaded search model
+        """
+
+        folder_path = Path(file_name)
+        manifest = json.loads((folder_path / MANIFEST_FILE_NAME).read_text())
+        if manifest.get("data_holder_filled_at") != data_holder.filled_at:
+            raise ValueError("The search model was built with a different data holder")
+
+        obj = SearchModel(data_holder=data_holder,
+                          window_size=manifest["window_size"],
+                          nb_segments=manifest.get("nb_segments"),
+                          overfetch_factor=manifest.get("overfetch_factor", DEFAULT_OVERFETCH_FACTOR),
+                          channels=manifest.get("channels"))
+        index_class = INDEX_CLASSES[manifest["index_class"]]
+        obj.index = index_class.load(str(folder_path / INDEX_FILE_NAME), mmap=mmap)
+        if manifest.get("index_params") is not None:
+            obj.index.params = manifest["index_params"]
+            obj.index.index.nprobe = manifest["index_params"]["nprobe"]
+        obj.window_offsets = np.load(folder_path / "window_offsets.npy")
+        obj.nb_of_valid_values_at_build = np.load(folder_path / "nb_of_valid_values_at_build.npy")
+        obj.is_built = True
+        obj.file_path = str(folder_path)
         return obj
 
 
-def initialize_search_tree(data_holder: RawStockDataHolder, window_size: int, force_update: bool = False):
-    search_tree = SearchModel(data_holder=data_holder, window_size=window_size)
+def initialize_search_tree(data_holder: RawStockDataHolder,
+                           window_size: int,
+                           force_update: bool = False,
+                           recall_target: Optional[float] = None,
+                           latency_budget: Optional[float] = None,
+                           nb_segments: Optional[int] = None,
+                           channels: Optional[Sequence[str]] = None):
+    search_tree = SearchModel(data_holder=data_holder,
+                              window_size=window_size,
+                              recall_target=recall_target,
+                              latency_budget=latency_budget,
+                              nb_segments=nb_segments,
+                              channels=channels)
 
     file_path = Path(search_tree.create_filename_for_today())
 
     if (not file_path.exists()) or force_update:
         search_tree.build_index()
-        # TODO: implement serialization
-        # search_tree.serialize()
+        search_tree.serialize()
     else:
-        search_tree = SearchModel.load(str(file_path))
+        try:
+            loaded_search_tree = SearchModel.load(str(file_path), data_holder=data_holder)
+            if loaded_search_tree.nb_segments != nb_segments:
+                raise ValueError("The search model was built with a different number of segments")
+            if loaded_search_tree.channels != search_tree.channels:
+                raise ValueError("The search model was built with different channels")
+            search_tree = loaded_search_tree
+        except ValueError as e:
+            print(f"Search tree can not be loaded, it is built again: {e}")
+            search_tree.build_index()
+            search_tree.serialize()
     return search_tree
+
+
+def update_search_tree(data_holder: RawStockDataHolder,
+                       window_size: int,
+                       recall_target: Optional[float] = None,
+                       latency_budget: Optional[float] = None,
+                       nb_segments: Optional[int] = None,
+                       channels: Optional[Sequence[str]] = None) -> Tuple[SearchModel, int]:
+    """
+    Incremental version of initialize_search_tree: the windows of the new values (of an updated data holder) are added
+    to the most recent serialized search model, which is then serialized for today. If there is nothing to start
+    from (or the index can not be extended) then it is built from scratch
+    Args:
+        data_holder: the updated data holder
+        window_size: size of the search windows
+        recall_target: recall target of the index parameter tuning, used only if the index is built from scratch
+        latency_budget: latency budget of the index parameter tuning
+        nb_segments: number of PAA segments of a reduced index (see SearchModel), the index is built from scratch if
+            the previous one was built with a different value
+        channels: matched columns of the data holder (see SearchModel), the index is built from scratch if the
+            previous one was built with different channels
+
+    Returns:
+        the search model and the number of added windows
+    """
+
+    search_tree = SearchModel(data_holder=data_holder, window_size=window_size, channels=channels)
+    channels = search_tree.channels
+    latest_file_path = find_latest_serialized(search_tree.create_file_pattern())
+
+    if latest_file_path is not None:
+        try:
+            # Memory mapped indices can not be extended, so it is read to the memory
+            search_tree = SearchModel.load(str(latest_file_path), data_holder=data_holder, mmap=False)
+            if search_tree.nb_segments != nb_segments:
+                raise ValueError("the previous search model was built with a different number of segments")
+            if search_tree.channels != channels:
+                raise ValueError("the previous search model was built with different channels")
+            nb_added_windows = search_tree.add_new_windows()
+            file_path = search_tree.serialize()
+            loaded_search_tree = SearchModel.load(file_path, data_holder=data_holder)
+            loaded_search_tree.build_times = search_tree.build_times
+            return loaded_search_tree, nb_added_windows
+        except (ValueError, NotImplementedError) as e:
+            print(f"Incremental update is not possible for size {window_size}: {e}")
+
+    search_tree = initialize_search_tree(data_holder=data_holder,
+                                         window_size=window_size,
+                                         force_update=True,
+                                         recall_target=recall_target,
+                                         latency_budget=latency_budget,
+                                         nb_segments=nb_segments,
+                                         channels=channels)
+    return search_tree, int(search_tree.window_offsets[-1, -1])
@@ -1,4 +1,7 @@
-from typing import List, Tuple
+from collections import OrderedDict
+import hashlib
+import threading
+from typing import Hashable, List, Optional, Tuple
 
 import numpy as np
 from plotly import graph_objs
@@ -7,28 +10,71 @@ from sklearn.preprocessing import minmax_scale
 FIG_BG_COLOR = "#F9F9F9"
 ANCHOR_COLOR = "#FF372D"
 VALUES_COLOR = "#89D4F5"
+# All the matches are a single trace in the fast mode, so they have the same opacity
+FAST_MODE_OPACITY = 0.6
+HOVER_TEMPLATE = "<b>%{meta}</b><br>Norm. val.: %{y:.2f}<br>Value: %{customdata:.2f}$<extra></extra>"
 
 
-def visualize_graph(match_values_list: List[np.ndarray],
-                    match_symbols: List[str],
-                    match_str_dates: List[Tuple[str, str]],
-                    window_size: int,
-                    future_size: int,
-                    anchor_symbol: str,
-                    anchor_values: np.ndarray,
-                    show_legend: bool = True,
-                    offset_traces: bool = False) -> graph_objs.Figure:
-    nb_matches = len(match_symbols)
-    opacity_values = np.linspace(0.2, 1.0, nb_matches)[::-1]
+class FigureCache:
+    """
+    Bounded LRU cache of the figures. The key should be the hash of the shown content (see get_content_hash) and the
+    rendering options, so e.g. toggling an option back and forth does not build the figure again.
+    The cached figures are shared, they should not be modified
+    """
 
-    anchor_original_values = anchor_values[::-1]
-    minmax_anchor_values = minmax_scale(anchor_original_values)
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._figures: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
 
-    fig = graph_objs.Figure()
+    def get(self, key: Hashable) -> Optional[graph_objs.Figure]:
+        with self._lock:
+            fig = self._figures.get(key)
+            if fig is not None:
+                self._figures.move_to_end(key)
+            return fig
 
-    assert len(match_values_list) == len(match_symbols), "Something is fishy"
+    def put(self, key: Hashable, fig: graph_objs.Figure):
+        with self._lock:
+            self._figures[key] = fig
+            self._figures.move_to_end(key)
+            while len(self._figures) > self.max_size:
+                self._figures.popitem(last=False)
+
+
+def get_content_hash(match_values_list: List[np.ndarray],
+                     match_symbols: List[str],
+                     match_str_dates: List[Tuple[str, str]],
+                     anchor_symbol: str,
+                     anchor_values: np.ndarray) -> str:
+    h = hashlib.sha1()
+    h.update(repr((list(match_symbols), [tuple(x) for x in match_str_dates], anchor_symbol)).encode("utf-8"))
+    h.update(np.asarray(anchor_values, dtype=np.float64).tobytes())
+    for match_values in match_values_list:
+        # The lengths are hashed too, as the values of the matches are concatenated
+        h.update(np.asarray([len(match_values)], dtype=np.int64).tobytes())
+        h.update(np.asarray(match_values, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+def _minmax_scale_padded_rows(X: np.ndarray) -> np.ndarray:
+    # Same as the minmax_scale of every row, but the rows are padded with NaNs
+    row_min = np.nanmin(X, axis=1, keepdims=True)
+    row_range = np.nanmax(X, axis=1, keepdims=True) - row_min
+    row_range[row_range == 0] = 1
+    return (X - row_min) / row_range
+
+
+def _add_match_traces(fig: graph_objs.Figure,
+                      match_values_list: List[np.ndarray],
+                      match_symbols: List[str],
+                      match_str_dates: List[Tuple[str, str]],
+                      window_size: int,
+                      minmax_anchor_values: np.ndarray,
+                      offset_traces: bool):
+    nb_matches = len(match_symbols)
+    opacity_values = np.linspace(0.2, 1.0, nb_matches)[::-1]
 
-    # Draw all matches
     for i in range(nb_matches):
         match_values = match_values_list[i]
         match_symbol = match_symbols[i]
@@ -49,20 +95,111 @@ def visualize_graph(match_values_list: List[np.ndarray],
                                    line=dict(color=VALUES_COLOR),
                                    opacity=opacity_values[i],
                                    customdata=original_values,
-                                   hovertemplate="<b>%{meta}</b><br>Norm. val.: %{y:.2f}<br>Value: %{customdata:.2f}$<extra></extra>")
+                                   hovertemplate=HOVER_TEMPLATE)
         fig.add_trace(trace)
 
+
+def _add_match_traces_fast(fig: graph_objs.Figure,
+                           match_values_list: List[np.ndarray],
+                           match_symbols: List[str],
+                           match_str_dates: List[Tuple[str, str]],
+                           window_size: int,
+                           minmax_anchor_values: np.ndarray,
+                           offset_traces: bool):
+    nb_matches = len(match_symbols)
+    if nb_matches == 0:
+        return
+
+    # Matches are rows of a matrix (in chronological order), the ones without all the future values are padded at the
+    # end. An extra NaN column separates the matches in the single trace
+    lengths = np.array([len(x) for x in match_values_list])
+    max_length = lengths.max()
+    original_values = np.full((nb_matches, max_length + 1), np.nan)
+    is_value = np.arange(max_length + 1)[None, :] < lengths[:, None]
+    original_values[is_value] = np.concatenate([np.asarray(x, dtype=np.float64)[::-1] for x in match_values_list])
+
+    minmax_matched_values = _minmax_scale_padded_rows(original_values)
+    if offset_traces:
+        diff = minmax_anchor_values[window_size - 1] - minmax_matched_values[:, window_size - 1]
+        minmax_matched_values = minmax_matched_values + diff[:, None]
+
+    # The hover shows the number of the match (as in the table of the matches) instead of the name, so the names are
+    # not repeated for every point
+    x = np.where(is_value, np.arange(1, max_length + 2)[None, :], np.nan)
+    match_numbers = np.repeat(np.arange(1, nb_matches + 1, dtype=np.float32)[:, None], max_length + 1, axis=1)
+    customdata = np.stack([original_values.ravel(), match_numbers.ravel()], axis=1).astype(np.float32)
+    trace = graph_objs.Scattergl(x=x.ravel().astype(np.float32),
+                                 y=minmax_matched_values.ravel().astype(np.float32),
+                                 name=f"Matches ({nb_matches})",
+                                 mode="lines",
+                                 line=dict(color=VALUES_COLOR),
+                                 opacity=FAST_MODE_OPACITY,
+                                 connectgaps=False,
+                                 customdata=customdata,
+                                 hovertemplate="<b>Match %{customdata[1]}</b><br>Norm. val.: %{y:.2f}<br>"
+                                               "Value: %{customdata[0]:.2f}$<extra></extra>")
+    fig.add_trace(trace)
+
+
+def visualize_graph(match_values_list: List[np.ndarray],
+                    match_symbols: List[str],
+                    match_str_dates: List[Tuple[str, str]],
+                    window_size: int,
+                    future_size: int,
+                    anchor_symbol: str,
+                    anchor_values: np.ndarray,
+                    show_legend: bool = True,
+                    offset_traces: bool = False,
+                    fast: bool = False) -> graph_objs.Figure:
+    """
+    Visualizes the matches and the anchor (search) values
+    Args:
+        match_values_list: values of the matches (most recent first) with the future values
+        match_symbols: symbols of the matches
+        match_str_dates: start and end dates of the matches
+        window_size: size of the search window
+        future_size: number of future values
+        anchor_symbol: symbol of the anchor
+        anchor_values: values of the anchor (most recent first)
+        show_legend: show the legend of the traces
+        offset_traces: the matches are shifted to the anchor at the last market close
+        fast: all the matches are normalized at once and drawn as a single WebGL trace (NaN separated), so the figure
+            is fast to build and to render even with a lot of matches. The matches can not be distinguished by
+            opacity in this mode, they have a single legend entry and the hover shows the (1-based) number of the match
+
+    Returns:
+        the figure
+    """
+
+    assert len(match_values_list) == len(match_symbols), "Something is fishy"
+
+    anchor_original_values = np.asarray(anchor_values)[::-1]
+    minmax_anchor_values = minmax_scale(anchor_original_values)
+
+    fig = graph_objs.Figure()
+
+    # Draw all matches
+    add_match_traces = _add_match_traces_fast if fast else _add_match_traces
+    add_match_traces(fig=fig,
+                     match_values_list=match_values_list,
+                     match_symbols=match_symbols,
+                     match_str_dates=match_str_dates,
+                     window_size=window_size,
+                     minmax_anchor_values=minmax_anchor_values,
+                     offset_traces=offset_traces)
+
     # Draw the anchor series
     x = list(range(1, len(anchor_values) + 1))
     trace_name = f"Anchor ({anchor_symbol})"
-    trace = graph_objs.Scatter(x=x,
-                               y=minmax_anchor_values,
-                               name=trace_name,
-                               meta=trace_name,
-                               mode="lines+markers",
-                               line=dict(color=ANCHOR_COLOR),
-                               customdata=anchor_original_values,
-                               hovertemplate="<b>%{meta}</b><br>Norm. val.: %{y:.2f}<br>Value: %{customdata:.2f}$<extra></extra>")
+    scatter_class = graph_objs.Scattergl if fast else graph_objs.Scatter
+    trace = scatter_class(x=x,
+                          y=minmax_anchor_values,
+                          name=trace_name,
+                          meta=trace_name,
+                          mode="lines+markers",
+                          line=dict(color=ANCHOR_COLOR),
+                          customdata=anchor_original_values,
+                          hovertemplate=HOVER_TEMPLATE)
     fig.add_trace(trace)
 
     # Add "last market close" line
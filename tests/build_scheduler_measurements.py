@@ -0,0 +1,66 @@
+import concurrent.futures
+import json
+import resource
+import time
+
+import psutil
+
+import stock_pattern_analyzer as spa
+from window_creation_measurements import create_data_holder
+
+WINDOW_SIZES = [5, 10, 20, 30, 40]
+
+
+def measure_single_build(window_size: int) -> dict:
+    """
+    Runs in a separate process, so the peak RSS of the builds does not affect each other
+    """
+
+    data_holder = create_data_holder()
+    scheduler = spa.SearchTreeBuildScheduler(data_holder=data_holder)
+
+    rss_before = psutil.Process().memory_info().rss
+    start_time = time.time()
+    spa.SearchModel(data_holder=data_holder, window_size=window_size).build_index()
+    build_time = time.time() - start_time
+    # ru_maxrss is in kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    return {"build_time": build_time,
+            "peak_rss_increase": peak_rss - rss_before,
+            "estimated_peak_memory": scheduler.estimate_peak_memory(window_size)}
+
+
+def measure_scheduled_builds(memory_budget: int) -> float:
+    data_holder = create_data_holder()
+    scheduler = spa.SearchTreeBuildScheduler(data_holder=data_holder, memory_budget=memory_budget)
+
+    start_time = time.time()
+    scheduler.run(WINDOW_SIZES, lambda w: spa.SearchModel(data_holder=data_holder, window_size=w).build_index())
+    return time.time() - start_time
+
+
+def perform_measurements():
+    res_dict = {"single": {}}
+
+    for window_size in WINDOW_SIZES:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1) as pool:
+            res = pool.submit(measure_single_build, window_size).result()
+        res_dict["single"][window_size] = res
+        print(f"Window size {window_size}: {res}")
+
+    # With a budget of the smallest build the builds run one after another
+    sequential_budget = min(res["estimated_peak_memory"] for res in res_dict["single"].values())
+    unlimited_budget = sum(res["estimated_peak_memory"] for res in res_dict["single"].values())
+    for name, memory_budget in [("sequential", sequential_budget), ("parallel", unlimited_budget)]:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1) as pool:
+            res_dict[name] = pool.submit(measure_scheduled_builds, memory_budget).result()
+        print(f"{name} total build time: {res_dict[name]:.2f} secs")
+    print(f"Slowest single build: {max(res['build_time'] for res in res_dict['single'].values()):.2f} secs")
+
+    with open("build_scheduler_measurement_results.json", "w") as f:
+        json.dump(res_dict, f)
+
+
+if __name__ == "__main__":
+    perform_measurements()
@@ -0,0 +1,84 @@
+import concurrent.futures
+import json
+import os
+import tempfile
+import time
+
+import numpy as np
+import psutil
+
+import stock_pattern_analyzer as spa
+from window_creation_measurements import create_data_holder
+
+EXTRA_COLUMNS = ["Open", "High", "Low", "Volume"]
+WINDOW_SIZE = 20
+
+
+def create_serialized_data_holders(folder_path: str) -> dict:
+    """
+    Serializes the same data holder with and without the extra (OHLCV) columns
+    """
+
+    data_holder = create_data_holder()
+    file_paths = {}
+    os.chdir(folder_path)
+    os.mkdir("close_only")
+    os.chdir("close_only")
+    file_paths["close_only"] = os.path.abspath(data_holder.serialize())
+
+    rng = np.random.default_rng(42)
+    columns = {}
+    for label, symbol in enumerate(data_holder.ticker_symbols):
+        values = data_holder.get_row_values(label)
+        columns[symbol] = {x: values + rng.normal(size=len(values)) for x in EXTRA_COLUMNS}
+        columns[symbol]["Volume"] = rng.integers(10 ** 5, 10 ** 7, len(values))
+    data = {x: (data_holder.get_row_values(i), data_holder.get_row_dates(i))
+            for i, x in enumerate(data_holder.ticker_symbols)}
+    data_holder.set_data(data, columns)
+    os.chdir(folder_path)
+    os.mkdir("ohlcv")
+    os.chdir("ohlcv")
+    file_paths["ohlcv"] = os.path.abspath(data_holder.serialize())
+    return file_paths
+
+
+def measure_load(file_path: str, channels: list) -> dict:
+    """
+    Runs in a separate process, so the page cache of the previous loads is not counted in the RSS
+    """
+
+    rss_before = psutil.Process().memory_info().rss
+    start_time = time.time()
+    data_holder = spa.RawStockDataHolder.load(file_path)
+    model = spa.SearchModel(data_holder=data_holder, window_size=WINDOW_SIZE, channels=channels)
+    # Every window is read once, as the build of a search tree does
+    windows = model._create_windows(model._get_nb_windows_per_label())
+    load_time = time.time() - start_time
+
+    return {"load_and_window_time": load_time,
+            "rss_increase": psutil.Process().memory_info().rss - rss_before,
+            "nb_windows": len(windows),
+            "loaded_extra_columns": sorted(data_holder._extra_columns.keys())}
+
+
+def perform_measurements():
+    res_dict = {}
+    cases = [("close_only", ["Close"]), ("ohlcv", ["Close"]), ("ohlcv", ["Close", "Volume"])]
+
+    with tempfile.TemporaryDirectory() as folder_path:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=1) as pool:
+            file_paths = pool.submit(create_serialized_data_holders, folder_path).result()
+
+        for data_holder_name, channels in cases:
+            name = f"{data_holder_name} data holder, {'+'.join(channels)} channels"
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1) as pool:
+                res = pool.submit(measure_load, file_paths[data_holder_name], channels).result()
+            res_dict[name] = res
+            print(f"{name}: {res}")
+
+    with open("column_loading_measurement_results.json", "w") as f:
+        json.dump(res_dict, f)
+
+
+if __name__ == "__main__":
+    perform_measurements()
@@ -0,0 +1,67 @@
+import json
+import time
+
+import numpy as np
+
+import stock_pattern_analyzer as spa
+from stock_pattern_analyzer.dtw import DTWSearchStats
+from window_creation_measurements import create_data_holder
+
+WINDOW_SIZES = [10, 20, 45]
+NB_QUERIES = 100
+TOP_K = 10
+OVERFETCH_FACTORS = [10, 50]
+BAND_FRACTION = 0.1
+
+
+def measure(model: spa.SearchModel, queries: np.ndarray, overfetch_factor: int) -> dict:
+    start_time = time.time()
+    euclidean_indices, _ = model.search_batch(queries, k=TOP_K)
+    euclidean_time = (time.time() - start_time) / len(queries)
+
+    # Measured end to end (with the candidate search), query by query as in the API
+    stats = DTWSearchStats()
+    start_time = time.time()
+    dtw_indices = np.vstack([model.search_dtw_batch(q[None], k=TOP_K, band_fraction=BAND_FRACTION,
+                                                    overfetch_factor=overfetch_factor, stats=stats)[0]
+                             for q in queries])
+    dtw_time = (time.time() - start_time) / len(queries)
+
+    start_time = time.time()
+    model.search_dtw_batch(queries, k=TOP_K, band_fraction=BAND_FRACTION, overfetch_factor=overfetch_factor)
+    batch_dtw_time = (time.time() - start_time) / len(queries)
+
+    overlap = np.mean([len(np.intersect1d(x, y)) / TOP_K for x, y in zip(euclidean_indices, dtw_indices)])
+    return {"euclidean_query_time": euclidean_time,
+            "dtw_query_time": dtw_time,
+            "dtw_stage_times": {stage: t / len(queries) for stage, t in stats.stage_times.items()},
+            "batch_dtw_query_time": batch_dtw_time,
+            "nb_candidates_per_query": stats.nb_candidates / len(queries),
+            "euclidean_overlap": overlap}
+
+
+def perform_measurements():
+    data_holder = create_data_holder()
+    rng = np.random.default_rng(0)
+
+    res_dict = {}
+    for window_size in WINDOW_SIZES:
+        model = spa.SearchModel(data_holder=data_holder, window_size=window_size)
+        model.build_index()
+        labels = rng.integers(0, len(data_holder.ticker_symbols), size=NB_QUERIES)
+        queries = model.get_query_values(labels)
+        # Warm-up
+        model.search_dtw_batch(queries[:10], k=TOP_K)
+
+        res_dict[window_size] = {}
+        for overfetch_factor in OVERFETCH_FACTORS:
+            res = measure(model, queries, overfetch_factor)
+            res_dict[window_size][overfetch_factor] = res
+            print(f"Window size {window_size}, overfetch factor {overfetch_factor}: {res}")
+
+    with open("dtw_measurement_results.json", "w") as f:
+        json.dump(res_dict, f)
+
+
+if __name__ == "__main__":
+    perform_measurements()
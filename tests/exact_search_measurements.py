@@ -0,0 +1,82 @@
+import json
+import time
+
+import numpy as np
+
+import stock_pattern_analyzer as spa
+from window_creation_measurements import create_data_holder
+
+INDEXED_WINDOW_SIZES = [5, 20, 45]
+EXACT_ONLY_WINDOW_SIZES = [60, 120, 250]
+NB_QUERIES = 10
+TOP_K = 10
+
+
+def measure_fast_index(data_holder: spa.RawStockDataHolder, window_size: int, queries: list) -> dict:
+    model = spa.SearchModel(data_holder=data_holder, window_size=window_size)
+
+    start_time = time.time()
+    X = model._create_windows(model._get_nb_windows_per_label())
+    model.index = spa.FastIndex()
+    model.index.create(X)
+    model._add_window_block(model._get_nb_windows_per_label())
+    model.is_built = True
+    build_time = time.time() - start_time
+
+    start_time = time.time()
+    results = [model.search(q, k=TOP_K) for q in queries]
+    query_time = (time.time() - start_time) / len(queries)
+
+    return {"build_time": build_time,
+            "query_time": query_time,
+            "index_size": X.nbytes,
+            "distances": [distances.tolist() for _, distances in results]}
+
+
+def measure_exact_search(data_holder: spa.RawStockDataHolder, queries: list) -> dict:
+    model = spa.ExactSearchModel(data_holder=data_holder)
+
+    # The FFT of the values is calculated only once, and it is shared between all window sizes
+    start_time = time.time()
+    model._prepare()
+    prepare_time = time.time() - start_time
+
+    start_time = time.time()
+    results = [model.search(q, k=TOP_K) for q in queries]
+    query_time = (time.time() - start_time) / len(queries)
+
+    return {"prepare_time": prepare_time,
+            "query_time": query_time,
+            "distances": [distances.tolist() for _, _, distances in results]}
+
+
+def perform_measurements():
+    data_holder = create_data_holder()
+    rng = np.random.default_rng(0)
+
+    res_dict = {}
+
+    for window_size in INDEXED_WINDOW_SIZES + EXACT_ONLY_WINDOW_SIZES:
+        labels = rng.integers(0, len(data_holder.ticker_symbols), size=NB_QUERIES)
+        queries = list(data_holder.get_most_recent_values(labels, window_size))
+
+        res_dict[window_size] = {"ExactSearchModel": measure_exact_search(data_holder, queries)}
+        if window_size in INDEXED_WINDOW_SIZES:
+            fast_index_res = measure_fast_index(data_holder, window_size, queries)
+            res_dict[window_size]["FastIndex"] = fast_index_res
+            # Both of them are exact, so the distances should be the same
+            res_dict[window_size]["max_distance_difference"] = float(
+                np.max(np.abs(np.array(fast_index_res["distances"]) -
+                              np.array(res_dict[window_size]["ExactSearchModel"]["distances"]))))
+
+        for name, res in res_dict[window_size].items():
+            if isinstance(res, dict):
+                print(f"Window size {window_size}, {name}: "
+                      f"{ {k: v for k, v in res.items() if k != 'distances'} }")
+
+    with open("exact_search_measurement_results.json", "w") as f:
+        json.dump(res_dict, f)
+
+
+if __name__ == "__main__":
+    perform_measurements()
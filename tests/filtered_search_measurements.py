@@ -0,0 +1,69 @@
+import json
+import time
+
+import numpy as np
+
+import stock_pattern_analyzer as spa
+from window_creation_measurements import create_data_holder
+
+WINDOW_SIZES = [10, 20, 45]
+NB_QUERIES = 100
+TOP_K = 10
+# Single symbol filters are searched exactly, the larger ones with the index
+NB_FILTER_SYMBOLS = [1, 20]
+
+
+def measure(model: spa.SearchModel, labels: np.ndarray, filter_labels: np.ndarray) -> dict:
+    # The matches of every query are searched in the windows of the filter symbols [n_queries, n_filter_symbols]
+    queries = model.get_query_values(labels)
+    nb_found = []
+    recalls = []
+    search_time = 0.0
+    for query, filter_label in zip(queries, filter_labels):
+        allowed_ids = model.get_allowed_window_ids(labels=filter_label)
+        start_time = time.time()
+        indices, _ = model.search_batch(query[None], k=TOP_K, allowed_ids=allowed_ids)
+        search_time += time.time() - start_time
+
+        # Exact results: distances to every allowed window
+        allowed_indices = np.flatnonzero(allowed_ids)
+        q = model._scale_queries(query)
+        exact_distances = np.sum((model._get_scaled_windows(allowed_indices) - q) ** 2, axis=1)
+        kth_exact_distance = np.sort(exact_distances)[min(TOP_K, len(exact_distances)) - 1]
+        found_indices = indices[0][indices[0] >= 0]
+        found_distances = np.sum((model._get_scaled_windows(found_indices) - q) ** 2, axis=1)
+        # Distance based recall, as in the index tuning
+        nb_found.append(len(found_indices))
+        recalls.append(np.count_nonzero(found_distances <= kth_exact_distance * (1 + 1e-5) + 1e-6)
+                       / min(TOP_K, len(exact_distances)))
+
+    return {"query_time": search_time / len(labels),
+            "nb_found": float(np.mean(nb_found)),
+            "min_nb_found": int(np.min(nb_found)),
+            "recall": float(np.mean(recalls))}
+
+
+def perform_measurements():
+    data_holder = create_data_holder()
+    rng = np.random.default_rng(0)
+
+    res_dict = {}
+    for window_size in WINDOW_SIZES:
+        model = spa.SearchModel(data_holder=data_holder, window_size=window_size)
+        model.build_index()
+        labels = rng.integers(0, len(data_holder.ticker_symbols), size=NB_QUERIES)
+
+        res_dict[window_size] = {}
+        for nb_filter_symbols in NB_FILTER_SYMBOLS:
+            filter_labels = np.array([rng.choice(len(data_holder.ticker_symbols), nb_filter_symbols, replace=False)
+                                      for _ in range(NB_QUERIES)])
+            res = measure(model, labels, filter_labels)
+            res_dict[window_size][nb_filter_symbols] = res
+            print(f"Window size {window_size}, {nb_filter_symbols} filter symbols: {res}")
+
+    with open("filtered_search_measurement_results.json", "w") as f:
+        json.dump(res_dict, f)
+
+
+if __name__ == "__main__":
+    perform_measurements()
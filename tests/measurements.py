@@ -1,78 +1,239 @@
-import os
-import time
-import json
-
-import numpy as np
-from tqdm import tqdm
-
-import stock_pattern_analyzer as spa
+"""
+Benchmark of the search indices and the search model
 
-NB_STOCKS = 100
-NB_DAYS_PER_STOCK = 5 * 365
-WINDOW_SIZES = [5, 10, 20, 50, 100]
+Every index implementation (and the SearchModel end to end, with and without the reduced PAA index) is measured in a
+separate process on synthetic random walk data: build time, peak and steady RSS, single query latency (p50, p99),
+batched query throughput and recall@k against exact brute force search.
 
+Usage:
+    python measurements.py [--output results.json] [--window-sizes 5 20 45 60] [--nb-segments 16]
+    python measurements.py --compare baseline.json results.json [--tolerance 0.1]
+"""
 
-def create_windows(X, window_size: int):
-    window_indices = np.arange(X.shape[0] - window_size + 1)[:, None] + np.arange(window_size)
-    return X[window_indices]
+import argparse
+import concurrent.futures
+import json
+import platform
+import resource
+import sys
+import time
 
+import faiss
+import numpy as np
+import psutil
 
-def over_estimate_memory_footprint(model):
+import stock_pattern_analyzer as spa
+import window_creation_measurements
+from window_creation_measurements import create_data_holder
+
+WINDOW_SIZES = [5, 10, 20, 45]
+INDEX_CLASSES = [spa.FastIndex, spa.MemoryEfficientIndex, spa.cKDTreeIndex]
+SEARCH_MODEL_NAME = "SearchModel"
+# SearchModel with a reduced (PAA) index, it is measured only for the window sizes which are not smaller than the
+# number of segments
+REDUCED_SEARCH_MODEL_NAME = "SearchModelPAA"
+NB_SEGMENTS = 16
+NB_QUERIES = 200
+BATCH_SIZE = 100
+TOP_K = 10
+
+# Direction of the metrics (for the comparison): True if the larger value is better
+METRIC_DIRECTIONS = {"build_time": False,
+                     "peak_rss_increase": False,
+                     "steady_rss_increase": False,
+                     "latency_p50": False,
+                     "latency_p99": False,
+                     "throughput": True,
+                     "recall": True}
+# Recall is compared with an absolute tolerance, the rest with a relative one
+RECALL_TOLERANCE = 0.01
+
+
+def _get_rss() -> int:
+    return psutil.Process().memory_info().rss
+
+
+def _reset_peak_rss():
+    # Linux only: the peak RSS (VmHWM) is reset to the current RSS, so the preparation of the data is not measured
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def _get_peak_rss() -> int:
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def calculate_recall(X: np.ndarray, Q: np.ndarray, indices: np.ndarray, exact_distances: np.ndarray) -> float:
     """
-    A good over-approximation for the memory footprint is the file size of the pickled object
-    Based on https://stackoverflow.com/a/565382/5108062
+    Recall@k based on the distances: a result is a hit if its exact distance is not larger than the k-th exact
+    distance, so matches with the same distance (e.g. the same shape at a different date) are not counted as misses
     """
 
-    tmp_filename = "test.pk"
-    model.serialize(tmp_filename)
-    size_of_the_file = os.path.getsize(tmp_filename)
-    os.remove(tmp_filename)
-    return size_of_the_file
+    is_found = indices >= 0
+    true_distances = np.sum((X[np.maximum(indices, 0)] - Q[:, None, :]) ** 2, axis=2)
+    is_hit = is_found & (true_distances <= exact_distances[:, -1:] * (1 + 1e-5) + 1e-6)
+    return float(is_hit.mean())
 
 
-def measure_build_time(model_class, windowed_data):
-    start_time = time.time()
-    model = model_class()
-    model.create(windowed_data)
-    end_time = time.time()
-    build_time = end_time - start_time
-    return model, build_time
-
+def _measure_queries(query_func, batch_query_func, Q: np.ndarray) -> dict:
+    latencies = []
+    for q in Q:
+        start_time = time.perf_counter()
+        query_func(q)
+        latencies.append(time.perf_counter() - start_time)
 
-def estimate_query_speed(model, windowed_data, N: int):
-    query = windowed_data[0]
-    start_time = time.time()
-    for i in range(N):
-        _ = model.query(query, k=10)
-    end_time = time.time()
-    query_time = (end_time - start_time) / N
-    return query_time
+    start_time = time.perf_counter()
+    for batch_start in range(0, len(Q), BATCH_SIZE):
+        batch_query_func(Q[batch_start:batch_start + BATCH_SIZE])
+    batch_time = time.perf_counter() - start_time
 
+    return {"latency_p50": float(np.percentile(latencies, 50)),
+            "latency_p99": float(np.percentile(latencies, 99)),
+            "throughput": len(Q) / batch_time}
 
-def perform_measurements():
-    max_values = NB_STOCKS * NB_DAYS_PER_STOCK
-    X = np.random.random(max_values)
 
-    res_dict = {}
-
-    for model_class in tqdm([spa.cKDTreeIndex, spa.FastIndex, spa.MemoryEfficientIndex]):
-        res_dict[model_class.__name__] = {}
-        for window_size in WINDOW_SIZES:
-            res_dict[model_class.__name__][window_size] = {}
-            data = create_windows(X, window_size)
+def measure(name: str, window_size: int, nb_segments: int = NB_SEGMENTS) -> dict:
+    """
+    Runs in a separate process, so the RSS of the different measurements does not affect each other
+    """
 
-            model, build_time = measure_build_time(model_class, data)
-            res_dict[model_class.__name__][window_size]["build_time"] = build_time
+    data_holder = create_data_holder()
+    model = spa.SearchModel(data_holder=data_holder, window_size=window_size)
+    X = model._create_windows(model._get_nb_windows_per_label())
 
-            memory_footprint = over_estimate_memory_footprint(model)
-            res_dict[model_class.__name__][window_size]["memory_footprint"] = memory_footprint
+    rng = np.random.default_rng(window_size)
+    query_ids = rng.choice(len(X), size=NB_QUERIES, replace=False)
+    Q = X[query_ids]
+    # Exact brute force search, without copying the windows to an index
+    exact_distances, _ = faiss.knn(Q, X, TOP_K)
 
-            query_speed = estimate_query_speed(model, data, 10)
-            res_dict[model_class.__name__][window_size]["query_speed"] = query_speed
+    _reset_peak_rss()
+    rss_before = _get_rss()
+    start_time = time.time()
+    if name in (SEARCH_MODEL_NAME, REDUCED_SEARCH_MODEL_NAME):
+        # End to end: window creation, normalization and index build
+        if name == REDUCED_SEARCH_MODEL_NAME:
+            model = spa.SearchModel(data_holder=data_holder, window_size=window_size, nb_segments=nb_segments)
+        model.build_index()
+    else:
+        index = [c for c in INDEX_CLASSES if c.__name__ == name][0]()
+        index.create(X)
+    build_time = time.time() - start_time
+    peak_rss = _get_peak_rss()
+    steady_rss = _get_rss()
+
+    if name in (SEARCH_MODEL_NAME, REDUCED_SEARCH_MODEL_NAME):
+        # The queries are the raw (not normalized) values of the windows
+        labels, start_indices = model.get_window_labels_and_start_indices(query_ids)
+        raw_Q = np.stack([data_holder.get_window_values(label, start_index, window_size)
+                          for label, start_index in zip(labels, start_indices)])
+        res = _measure_queries(lambda q: model.search(q, k=TOP_K),
+                               lambda batch: model.search_batch(batch, k=TOP_K),
+                               raw_Q)
+        indices, _ = model.search_batch(raw_Q, k=TOP_K)
+    else:
+        res = _measure_queries(lambda q: index.query(q[None], k=TOP_K),
+                               lambda batch: index.query_batch(batch, k=TOP_K),
+                               Q)
+        _, indices = index.query_batch(Q, k=TOP_K)
+
+    res.update({"build_time": build_time,
+                "peak_rss_increase": peak_rss - rss_before,
+                "steady_rss_increase": steady_rss - rss_before,
+                "recall": calculate_recall(X, Q, np.asarray(indices), exact_distances),
+                "nb_windows": len(X)})
+    return res
+
+
+def perform_measurements(output_file_path: str, window_sizes: list, nb_segments: int):
+    res_dict = {"meta": {"created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+                         "platform": platform.platform(),
+                         "nb_cpus": psutil.cpu_count(),
+                         "nb_stocks": window_creation_measurements.NB_STOCKS,
+                         "period_years": window_creation_measurements.PERIOD_YEARS,
+                         "nb_queries": NB_QUERIES,
+                         "top_k": TOP_K,
+                         "nb_segments": nb_segments},
+                "results": {}}
+
+    for name in [c.__name__ for c in INDEX_CLASSES] + [SEARCH_MODEL_NAME, REDUCED_SEARCH_MODEL_NAME]:
+        res_dict["results"][name] = {}
+        for window_size in window_sizes:
+            if (name == REDUCED_SEARCH_MODEL_NAME) and (window_size < nb_segments):
+                continue
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1) as pool:
+                res = pool.submit(measure, name, window_size, nb_segments).result()
+            res_dict["results"][name][str(window_size)] = res
+            print(f"{name}, window size {window_size}: {res}")
+
+    with open(output_file_path, "w") as f:
+        json.dump(res_dict, f, indent=2)
+
+
+def compare_measurements(baseline_file_path: str, file_path: str, tolerance: float) -> list:
+    """
+    Compares two measurement results
+    Args:
+        baseline_file_path: results of the baseline run
+        file_path: results of the new run
+        tolerance: allowed relative change (in the wrong direction) of the time and memory metrics
+
+    Returns:
+        list of the regressions (as strings)
+    """
 
-    with open("measurement_results.json", "w") as f:
-        json.dump(res_dict, f)
+    with open(baseline_file_path) as f:
+        baseline = json.load(f)["results"]
+    with open(file_path) as f:
+        results = json.load(f)["results"]
+
+    regressions = []
+    for name, window_size_results in results.items():
+        for window_size, res in window_size_results.items():
+            baseline_res = baseline.get(name, {}).get(window_size)
+            if baseline_res is None:
+                continue
+            for metric, is_larger_better in METRIC_DIRECTIONS.items():
+                old_value, new_value = baseline_res[metric], res[metric]
+                change = (new_value - old_value) if is_larger_better else (old_value - new_value)
+                if metric == "recall":
+                    is_regression = change < -RECALL_TOLERANCE
+                else:
+                    is_regression = change < -tolerance * abs(old_value)
+                line = f"{name:>20} {window_size:>4} {metric:>20}: {old_value:.6g} -> {new_value:.6g}"
+                if is_regression:
+                    regressions.append(line)
+                    line += "  <-- REGRESSION"
+                print(line)
+    return regressions
 
 
 if __name__ == "__main__":
-    perform_measurements()
+    parser = argparse.ArgumentParser(description="Benchmark of the search indices")
+    parser.add_argument("--output", default="measurement_results.json", help="Output file of the measurements")
+    parser.add_argument("--window-sizes", type=int, nargs="+", default=WINDOW_SIZES)
+    parser.add_argument("--nb-segments", type=int, default=NB_SEGMENTS,
+                        help="Number of PAA segments of the reduced index")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "RESULTS"),
+                        help="Compare two results instead of measuring")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="Allowed relative regression of the time, memory and throughput metrics")
+    args = parser.parse_args()
+
+    if args.compare:
+        found_regressions = compare_measurements(*args.compare, tolerance=args.tolerance)
+        print(f"{len(found_regressions)} regressions found")
+        sys.exit(1 if found_regressions else 0)
+    else:
+        perform_measurements(args.output, args.window_sizes, args.nb_segments)
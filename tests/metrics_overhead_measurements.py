@@ -0,0 +1,57 @@
+import json
+import time
+
+import numpy as np
+
+import stock_pattern_analyzer as spa
+from window_creation_measurements import create_data_holder
+
+WINDOW_SIZE = 20
+NB_QUERIES = 1000
+NB_OBSERVATIONS = 100000
+
+
+def measure_observe() -> dict:
+    registry = spa.MetricsRegistry()
+    registry.describe("stage_seconds", spa.metrics.HISTOGRAM, "Stage durations")
+
+    start_time = time.perf_counter()
+    for _ in range(NB_OBSERVATIONS):
+        registry.observe("stage_seconds", 0.001, endpoint="recent", stage="index_search")
+    observe_time = (time.perf_counter() - start_time) / NB_OBSERVATIONS
+
+    start_time = time.perf_counter()
+    registry.render()
+    return {"observe_time": observe_time, "render_time": time.perf_counter() - start_time}
+
+
+def measure_search(model: spa.SearchModel, queries: np.ndarray, with_stage_times: bool) -> float:
+    # Single query searches, as the requests which are not batched
+    start_time = time.perf_counter()
+    for q in queries:
+        stage_times = {} if with_stage_times else None
+        model.search_batch(q[None], k=6, stage_times=stage_times)
+    return (time.perf_counter() - start_time) / len(queries)
+
+
+def perform_measurements():
+    data_holder = create_data_holder()
+    model = spa.SearchModel(data_holder=data_holder, window_size=WINDOW_SIZE)
+    model.build_index()
+    rng = np.random.default_rng(0)
+    queries = model.get_query_values(rng.integers(0, len(data_holder.ticker_symbols), size=NB_QUERIES))
+
+    # Warm-up
+    measure_search(model, queries[:100], with_stage_times=False)
+    res_dict = {"build_times": model.build_times,
+                **measure_observe(),
+                "search_time": measure_search(model, queries, with_stage_times=False),
+                "search_time_with_stage_times": measure_search(model, queries, with_stage_times=True)}
+    print(res_dict)
+
+    with open("metrics_overhead_measurement_results.json", "w") as f:
+        json.dump(res_dict, f)
+
+
+if __name__ == "__main__":
+    perform_measurements()
@@ -0,0 +1,104 @@
+import concurrent.futures
+import json
+import resource
+import time
+
+import numpy as np
+import psutil
+from sklearn.preprocessing import minmax_scale
+
+import stock_pattern_analyzer as spa
+
+NB_STOCKS = 500
+PERIOD_YEARS = 20
+NB_TRADING_DAYS_PER_YEAR = 252
+WINDOW_SIZES = [5, 10, 20, 45]
+
+
+def create_data_holder() -> spa.RawStockDataHolder:
+    symbols = [f"SYM{i}" for i in range(NB_STOCKS)]
+    data_holder = spa.RawStockDataHolder(ticker_symbols=symbols, period_years=PERIOD_YEARS, interval=1)
+
+    rng = np.random.default_rng(42)
+    max_nb_values = PERIOD_YEARS * NB_TRADING_DAYS_PER_YEAR
+    nb_of_valid_values = rng.integers(max_nb_values // 2, max_nb_values, size=NB_STOCKS)
+    most_recent_date = np.datetime64("2021-01-01")
+    data = {}
+    for symbol, nb_values in zip(symbols, nb_of_valid_values):
+        random_walk = 100 + np.cumsum(rng.normal(size=nb_values))
+        data[symbol] = (random_walk, most_recent_date - np.arange(nb_values))
+    data_holder.set_data(data)
+    data_holder.is_filled = True
+    return data_holder
+
+
+def legacy_create_windows(data_holder: spa.RawStockDataHolder, window_size: int) -> np.ndarray:
+    """
+    Previous (per symbol, python list based) window creation, kept here as the baseline of the measurements
+    """
+
+    windows = []
+    start_end_indices_in_original_array = []
+    labels = []
+
+    for symbol in data_holder.ticker_symbols:
+        label = data_holder.symbol_to_label[symbol]
+        nb_valid_values = data_holder.nb_of_valid_values[label]
+
+        symbol_values = data_holder.get_row_values(label)[:nb_valid_values]
+        window_indices = np.arange(symbol_values.shape[0] - window_size + 1)[:, None] + np.arange(window_size)
+        windows.extend(symbol_values[window_indices])
+        start_end_indices_in_original_array.extend(window_indices[:, (0, -1)])
+        labels.extend([label] * len(window_indices))
+
+    _ = np.array(start_end_indices_in_original_array)
+    _ = np.array(labels)
+
+    windows = np.array(windows)
+    windows = minmax_scale(windows, feature_range=(0, 1), axis=1)
+    windows = np.nan_to_num(windows)
+    return windows
+
+
+def vectorized_create_windows(data_holder: spa.RawStockDataHolder, window_size: int) -> np.ndarray:
+    model = spa.SearchModel(data_holder=data_holder, window_size=window_size)
+    return model._create_windows(model._get_nb_windows_per_label())
+
+
+def measure(method_name: str, window_size: int) -> dict:
+    """
+    Runs in a separate process, so the peak RSS of the different methods does not affect each other
+    """
+
+    data_holder = create_data_holder()
+    method = {"legacy": legacy_create_windows, "vectorized": vectorized_create_windows}[method_name]
+
+    rss_before = psutil.Process().memory_info().rss
+    start_time = time.time()
+    windows = method(data_holder, window_size)
+    build_time = time.time() - start_time
+    # ru_maxrss is in kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    return {"build_time": build_time,
+            "peak_rss_increase": peak_rss - rss_before,
+            "nb_windows": len(windows)}
+
+
+def perform_measurements():
+    res_dict = {}
+
+    for window_size in WINDOW_SIZES:
+        res_dict[window_size] = {}
+        for method_name in ["legacy", "vectorized"]:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1) as pool:
+                res = pool.submit(measure, method_name, window_size).result()
+            res_dict[window_size][method_name] = res
+            print(f"Window size {window_size}, {method_name}: {res}")
+
+    with open("window_creation_measurement_results.json", "w") as f:
+        json.dump(res_dict, f)
+
+
+if __name__ == "__main__":
+    perform_measurements()